@@ -1,10 +1,11 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-import requests
 from datetime import datetime, timedelta, time
 import pytz
 from streamlit_autorefresh import st_autorefresh
+from medux_api import compactar_tipos, decodificar_json, pagina_a_bloque, post_api
+from medux_store import obtener_resultados
 
 # ===========================================================
 # 🧠 CONFIGURACIÓN INICIAL
@@ -106,53 +107,23 @@ body = {
 # 🔹 FUNCIONES DE CONSULTA Y NORMALIZACIÓN API
 # ===========================================================
 
-@st.cache_data(ttl=1800)
 def obtener_datos_pag(url, headers, body):
-    """Consulta la API paginada y almacena todos los resultados."""
-    todos_los_resultados = {}
-    pagina = 1
-    total = 0
-
-    while True:
-        st.info(f"📡 Descargando página {pagina}...")
-        r = requests.post(url, headers=headers, json=body)
-
-        if r.status_code != 200:
-            st.error(f"❌ Error API: {r.status_code}")
-            break
-
-        data = r.json()
-        results = data.get("results")
-
-        # 🔹 Caso 1: "results" es lista (p. ej. network)
-        if isinstance(results, list):
-            todos_los_resultados.setdefault("network", []).extend(results)
-            total += len(results)
-
-        # 🔹 Caso 2: "results" es dict (p. ej. ping-test, ftp-upload)
-        elif isinstance(results, dict):
-            for prog, res in results.items():
-                if isinstance(res, list):
-                    todos_los_resultados.setdefault(prog, []).extend(res)
-                    total += len(res)
-
-        next_data = data.get("next_pagination_data")
-        if not next_data:
-            break
-
-        body["pagination_data"] = next_data
-        pagina += 1
-
-    st.success(f"✅ {total:,} registros descargados en {pagina} página(s).")
-    return todos_los_resultados
+    """Descarga historica (paginada) via el store en disco (medux_store):
+    lo ya bajado antes se lee de disco y a la API solo se le piden los
+    huecos del rango y la ultima hora. Sin @st.cache_data: cacheaba por el
+    body literal, asi que mover el fin un minuto o sacar un program volvia
+    a bajar todo, y dejaba una segunda copia en memoria por 30 min."""
+    df, resumen = obtener_resultados(url, headers, body)
+    st.success(f"✅ Descarga completa: {len(df):,} registros ({resumen['filas_store']:,} desde el store local).")
+    return df
 
 
 def obtener_datos_pag_no_cache(url, headers, body):
     """Consulta la API sin caché (modo tiempo real)."""
     try:
-        r = requests.post(url, headers=headers, json=body)
+        r = post_api(url, headers, body)
         if r.status_code == 200:
-            return r.json()
+            return decodificar_json(r)
         st.warning(f"⚠️ Error API: {r.status_code}")
         return None
     except Exception as e:
@@ -161,52 +132,81 @@ def obtener_datos_pag_no_cache(url, headers, body):
 
 
 def flatten_results(raw_json):
-    """Normaliza cualquier respuesta de la API, incluyendo combinaciones de dict y list."""
-    filas = []
-
-    def extraer_filas(obj, program=None):
-        """Función recursiva para explorar y extraer dicts con datos."""
-        if isinstance(obj, dict):
-            # Caso: diccionario con clave 'results'
-            if "results" in obj:
-                extraer_filas(obj["results"], program)
-            else:
-                # Caso: diccionario con listas de programas (ping-test, ftp-upload, etc.)
-                tiene_lista = False
-                for k, v in obj.items():
-                    if isinstance(v, list):
-                        tiene_lista = True
-                        extraer_filas(v, k)
-                if not tiene_lista:
-                    # Caso: dict plano → fila directa
-                    fila = obj.copy()
-                    if program:
-                        fila["program"] = fila.get("program", program)
-                    filas.append(fila)
-
-        elif isinstance(obj, list):
-            # Caso: lista → iterar y procesar elementos
-            for item in obj:
-                extraer_filas(item, program)
-
-    # 🔹 Inicia el proceso con el JSON raíz
-    extraer_filas(raw_json)
-
-    # 🔹 Normalización final
-    if not filas:
-        print("⚠️ No se extrajeron filas del JSON.")
-        return pd.DataFrame()
-
-    df = pd.DataFrame(filas)
+    """Aplana una respuesta de /api/results (results -> program -> filas)
+    con el aplanador por columnas de medux_api."""
+    return normalizar_resultados(pagina_a_bloque(raw_json))
 
+
+def normalizar_resultados(df):
+    """Asegura la columna 'program' sobre el DataFrame plano (una fila por
+    muestra) que arma medux_store o flatten_results."""
+    if df.empty:
+        return df
     # Asegurar columna 'program' aunque no exista
     if "program" not in df.columns:
         df["program"] = "network"
 
-    return df
+    # Tipos compactos una sola vez (category/float32) para el df que queda
+    # en session_state.
+    return compactar_tipos(df)
 
 
 
+# ===========================================================
+# ⚡ MODO DELTA (solo realtime)
+# ===========================================================
+# En realtime NO se vuelven a pedir las 6 h completas en cada refresco: se
+# piden solo los resultados posteriores al ultimo dateStart que ya esta en
+# st.session_state.df (menos un pequeño solape, para no perder muestras que
+# la sonda sube con algo de retraso), se agregan al df existente y se
+# descartan las filas que ya salieron de la ventana. El boton
+# "Consultar API" siempre hace la descarga completa.
+DELTA_SOLAPE_SEG = 120
+# Una sonda que sube con retraso (resultados en buffer) queda atras de las
+# demas: el delta arranca en el ultimo dateStart de la sonda MAS atrasada,
+# pero nunca mas de DELTA_ATRASO_MAX_SEG antes del mas nuevo (una sonda
+# apagada no debe volver descarga completa cada refresco). Lo que llegue
+# aun mas tarde lo recupera la descarga completa que se fuerza cada
+# DELTA_CICLOS_RESYNC refrescos delta.
+DELTA_ATRASO_MAX_SEG = 30 * 60
+DELTA_CICLOS_RESYNC = 10
+COLUMNAS_CLAVE_DELTA = ["probeId", "program", "test", "dateStart"]
+
+
+def ts_inicio_delta(df_prev, ts_inicio_ventana):
+    """tsStart (ms) para pedir solo lo nuevo (desde la sonda mas atrasada,
+    ver DELTA_ATRASO_MAX_SEG), o None si no hay un df previo con dateStart
+    valido (en ese caso toca descarga completa)."""
+    if df_prev.empty or "dateStart" not in df_prev.columns:
+        return None
+    fechas = pd.to_datetime(df_prev["dateStart"], errors="coerce", utc=True)
+    ultimo = fechas.max()
+    if pd.isna(ultimo):
+        return None
+    if "probeId" in df_prev.columns:
+        mas_atrasada = fechas.groupby(df_prev["probeId"], observed=True).max().min()
+        if not pd.isna(mas_atrasada):
+            ultimo = max(mas_atrasada, ultimo - pd.Timedelta(seconds=DELTA_ATRASO_MAX_SEG))
+    ts = int(ultimo.timestamp() * 1000) - DELTA_SOLAPE_SEG * 1000
+    return max(ts, ts_inicio_ventana)
+
+
+def fusionar_delta(df_prev, df_delta, ts_inicio_ventana):
+    """Agrega las filas nuevas al df previo, elimina las repetidas por el
+    solape (misma sonda/program/test/dateStart) y descarta las que quedaron
+    antes del inicio de la ventana."""
+    df = pd.concat([df_prev, df_delta], ignore_index=True) if not df_delta.empty else df_prev
+    if df.empty or "dateStart" not in df.columns:
+        return df
+    fechas = pd.to_datetime(df["dateStart"], errors="coerce", utc=True)
+    df = df[fechas >= pd.Timestamp(ts_inicio_ventana, unit="ms", tz="UTC")]
+    clave = [c for c in COLUMNAS_CLAVE_DELTA if c in df.columns]
+    if clave:
+        df = df.drop_duplicates(subset=clave, keep="last")
+    # El concat de dos df con categorias distintas vuelve a object.
+    return compactar_tipos(df.reset_index(drop=True))
+
+
 # ===========================================================
 # 🚀 CONSULTAR API Y ACTUALIZAR DATOS
 # ===========================================================
@@ -214,19 +214,35 @@ def flatten_results(raw_json):
 if "df" not in st.session_state:
     st.session_state.df = pd.DataFrame()
 
-if st.sidebar.button("🚀 Consultar API") or usar_real_time:
+manual_trigger = st.sidebar.button("🚀 Consultar API")
+
+# 🔹 Si cambian los programas, el df previo ya no sirve como base del delta
+clave_delta = tuple(programas)
+ts_delta = None
+if usar_real_time and not manual_trigger and st.session_state.get("delta_clave") == clave_delta \
+        and st.session_state.get("delta_ciclos", 0) < DELTA_CICLOS_RESYNC:
+    ts_delta = ts_inicio_delta(st.session_state.df, ts_start)
+
+if ts_delta is not None:
+    # 🔹 Solo lo nuevo desde el ultimo dateStart ya cargado
+    raw = obtener_datos_pag_no_cache(url, headers, {**body, "tsStart": ts_delta})
+    df_delta = flatten_results(raw) if raw else pd.DataFrame()
+    df = fusionar_delta(st.session_state.df, df_delta, ts_start)
+    st.session_state.delta_ciclos = st.session_state.get("delta_ciclos", 0) + 1
+    st.session_state.df = df
+    st.caption(f"🔁 Delta: +{len(df_delta)} filas nuevas ({len(df)} filas en la ventana).")
+
+elif manual_trigger or usar_real_time:
     # 🔹 Obtener datos según modo
+    # 🔹 Convertir a DataFrame plano (el historico ya llega plano del store)
     if usar_real_time:
         raw = obtener_datos_pag_no_cache(url, headers, body)
+        if not raw:
+            st.warning("⚠️ No se recibieron datos de la API.")
+            st.stop()
+        df = flatten_results(raw)
     else:
-        raw = obtener_datos_pag(url, headers, body)
-
-    if not raw:
-        st.warning("⚠️ No se recibieron datos de la API.")
-        st.stop()
-
-    # 🔹 Convertir a DataFrame plano
-    df = flatten_results(raw)
+        df = normalizar_resultados(obtener_datos_pag(url, headers, body))
 
     if df.empty:
         st.warning("⚠️ No se recibieron datos.")
@@ -234,6 +250,8 @@ if st.sidebar.button("🚀 Consultar API") or usar_real_time:
 
     # 🔹 Guardar en sesión
     st.session_state.df = df
+    st.session_state.delta_clave = clave_delta
+    st.session_state.delta_ciclos = 0
     st.success(f"✅ Datos cargados correctamente ({len(df)} filas).")
 
 else:
@@ -261,7 +279,7 @@ if "df" in st.session_state and not st.session_state.df.empty:
         # Último registro por sonda
         df_last = (
             df_resumen.sort_values(by=col_time)
-            .groupby(col_probe)
+            .groupby(col_probe, observed=True)
             .tail(1)
             .reset_index(drop=True)
         )
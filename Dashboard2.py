@@ -1,10 +1,11 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-import requests
 from datetime import datetime, timedelta, time
 import pytz
 from streamlit_autorefresh import st_autorefresh
+from medux_api import decodificar_json, pagina_a_bloque, post_api
+from medux_store import obtener_resultados
 
 # ===========================================================
 # 🧠 CONFIGURACIÓN INICIAL
@@ -108,67 +109,21 @@ body = {
 # ===========================================================
 # 🔹 FUNCIONES DE CONSULTA Y NORMALIZACIÓN API
 # ===========================================================
-@st.cache_data(ttl=1800)
 def obtener_datos_pag(url, headers, body):
-    todos_los_resultados = {}
-    pagina = 1
-    total = 0
-
-    # Asegurar que se habilite la paginación
-    payload = body.copy()
-    payload["paginate"] = True
-
-    pit = None
-    search_after = None
-
-    while True:
-        if pit:
-            payload["pit"] = pit
-        if search_after:
-            payload["search_after"] = search_after
-
-        st.info(f"📡 Descargando página {pagina}...")
-        r = requests.post(url, headers=headers, json=payload)
-        if r.status_code != 200:
-            st.error(f"❌ Error API: {r.status_code}")
-            break
-
-        data = r.json()
-
-        # Extraer resultados
-        results = data.get("results", {})
-        if isinstance(results, list):
-            todos_los_resultados.setdefault("network", []).extend(results)
-            total += len(results)
-        elif isinstance(results, dict):
-            for prog, res in results.items():
-                if isinstance(res, list):
-                    todos_los_resultados.setdefault(prog, []).extend(res)
-                    total += len(res)
-
-        st.write(f"📄 Página {pagina}: {len(results) if isinstance(results, list) else sum(len(v) for v in results.values())} registros")
-
-        # Actualizar cursores de paginación
-        pit = data.get("pit")
-        search_after = data.get("search_after")
-
-        # Si no hay más cursores, terminamos
-        if not search_after or not pit:
-            st.success(f"✅ Descarga completa: {total:,} registros en {pagina} páginas.")
-            break
-
-        pagina += 1
-        if pagina > 100:  # seguridad
-            st.warning("⚠️ Se alcanzó el límite máximo de 100 páginas.")
-            break
-
-    return todos_los_resultados
+    """Descarga historica (paginada) via el store en disco (medux_store):
+    lo ya bajado antes se lee de disco y a la API solo se le piden los
+    huecos del rango y la ultima hora. Sin @st.cache_data: cacheaba por el
+    body literal, asi que mover el fin un minuto o sacar un program volvia
+    a bajar todo, y dejaba una segunda copia en memoria por 30 min."""
+    df, resumen = obtener_resultados(url, headers, body)
+    st.success(f"✅ Descarga completa: {len(df):,} registros ({resumen['filas_store']:,} desde el store local).")
+    return df
 
 def obtener_datos_pag_no_cache(url, headers, body):
     try:
-        r = requests.post(url, headers=headers, json=body)
+        r = post_api(url, headers, body)
         if r.status_code == 200:
-            return r.json()
+            return decodificar_json(r)
         st.warning(f"⚠️ Error API: {r.status_code}")
         return None
     except Exception as e:
@@ -176,29 +131,16 @@ def obtener_datos_pag_no_cache(url, headers, body):
         return None
 
 def flatten_results(raw_json):
-    filas = []
-    def extraer_filas(obj, program=None):
-        if isinstance(obj, dict):
-            if "results" in obj:
-                extraer_filas(obj["results"], program)
-            else:
-                tiene_lista = False
-                for k, v in obj.items():
-                    if isinstance(v, list):
-                        tiene_lista = True
-                        extraer_filas(v, k)
-                if not tiene_lista:
-                    fila = obj.copy()
-                    if program:
-                        fila["program"] = fila.get("program", program)
-                    filas.append(fila)
-        elif isinstance(obj, list):
-            for item in obj:
-                extraer_filas(item, program)
-    extraer_filas(raw_json)
-    if not filas:
-        return pd.DataFrame()
-    df = pd.DataFrame(filas)
+    """Aplana una respuesta de /api/results (results -> program -> filas)
+    con el aplanador por columnas de medux_api."""
+    return normalizar_resultados(pagina_a_bloque(raw_json))
+
+def normalizar_resultados(df):
+    """Completa 'program' y pasa las columnas de fecha a texto en hora
+    local, sobre el DataFrame plano (una fila por muestra) que arma
+    medux_store o flatten_results."""
+    if df.empty:
+        return df
     if "program" not in df.columns:
         df["program"] = "network"
     # 🔹 Convertir campos de fecha detectados a zona Las Vegas
@@ -214,11 +156,14 @@ if "df" not in st.session_state:
     st.session_state.df = pd.DataFrame()
 
 if st.sidebar.button("🚀 Consultar API") or usar_real_time:
-    raw = obtener_datos_pag_no_cache(url, headers, body) if usar_real_time else obtener_datos_pag(url, headers, body)
-    if not raw:
-        st.warning("⚠️ No se recibieron datos de la API.")
-        st.stop()
-    df = flatten_results(raw)
+    if usar_real_time:
+        raw = obtener_datos_pag_no_cache(url, headers, body)
+        if not raw:
+            st.warning("⚠️ No se recibieron datos de la API.")
+            st.stop()
+        df = flatten_results(raw)
+    else:
+        df = normalizar_resultados(obtener_datos_pag(url, headers, body))
     if df.empty:
         st.warning("⚠️ No se recibieron datos.")
         st.stop()
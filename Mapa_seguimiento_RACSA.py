@@ -41,13 +41,27 @@ Requisitos adicionales sobre el dashboard original (agregar a requirements.txt):
     jinja2>=3.1.2   # requerido por pandas Styler (resaltado verde/rojo de la tabla)
 
 Notas de rendimiento:
-    - Los poligonos se simplifican y se cachean 24h (no se recalculan en cada rerun).
+    - Los poligonos se guardan en disco (medux_geo) y cada nivel de
+      simplificacion se calcula una sola vez, sobre los arcos compartidos de la
+      topologia: volver a un nivel del slider de detalle no recalcula nada.
+    - Las manchas del KMZ subdivididas por distrito (interseccion exacta, lo
+      mas pesado de GEOS en este mapa) se calculan una vez por version del
+      KMZ y de los distritos y quedan en disco: un rerun no interseca nada.
+    - Las manchas y sus pedazos por distrito viajan al navegador en UNA
+      topologia (TopoJSON, medux_mapa.topojson): los bordes que comparten
+      van una sola vez, cuantizados y delta-codificados. Los distritos igual.
     - El spatial join (punto-en-poligono) del MAPA es vectorizado (shapely.points +
       STRtree.query con array, sin loop en Python por fila) -- ~30,000 muestras
       pasan de varios segundos a milisegundos.
     - El mapa se dibuja como UNA sola capa GeoJson (494 features en un solo layer)
       en vez de 494 capas individuales, y se renderiza con components.html en vez
       de streamlit-folium (evita el puente bidireccional que agrega latencia).
+    - La descarga paginada (medux_api) corre un cursor PIT por program en
+      paralelo, todos bajo un unico limite compartido de ~1 req/s.
+    - Lo descargado queda en un store Parquet en disco (medux_store): un rango
+      ya bajado (aunque sea parte de otro, o de antes de un redeploy) se lee
+      de disco y a la API solo se le piden los huecos y la ultima hora (de
+      la que, si se acaba de consultar, solo se pide el borde nuevo).
     - La TABLA se arma con un simple groupby sobre el df raw ya en memoria
       (mismo que usa el mapa) -- no hace falta ninguna consulta adicional.
 
@@ -65,7 +79,8 @@ dashboard Sutel original):
       que vienen de un archivo KMZ exportado de Google Earth
       ("Poligonos de medicion PROD Mayo 2026.kmz"), con un unico Placemark
       por poligono y un nombre numerico (2..24). Se parsean con
-      zipfile+ElementTree (sin dependencias nuevas), se simplifican igual
+      zipfile+ElementTree.iterparse (sin dependencias nuevas; lo parseado
+      queda en disco con el hash del KMZ), se simplifican igual
       que los distritos (son MUCHO mas densos: ~140k vertices en total) y
       se dibujan en una capa GeoJson aparte, con estilo distinto (borde azul
       punteado, sin relleno) para no confundirlos con el choropleth de
@@ -91,24 +106,23 @@ from datetime import datetime, timedelta
 import numpy as np
 import pandas as pd
 import pytz
-import requests
 import streamlit as st
 import streamlit.components.v1 as components
 import folium
 import branca.colormap as cm
-from shapely.geometry import shape, mapping, Polygon, MultiPolygon
-from shapely import points as shapely_points
-from shapely.strtree import STRtree
-from shapely.ops import transform as shapely_transform
-from pyproj import Transformer
-
-# ===========================================================
-# CONFIGURACION WFS (poligonos de distritos)
-# ===========================================================
-WFS_URL = "https://geos.snitcr.go.cr/be/IGN_5_CO/wfs"
-WFS_LAYER = "IGN_5_CO:limitedistrital_5k"
-WFS_SRS_NATIVE = "EPSG:8908"   # CR-SIRGAS / CRTM05 (metros)
-WFS_SRS_OUTPUT = "EPSG:4326"   # WGS84 lat/lon (lo que trae la API MedUX)
+import shapely
+from shapely.geometry import MultiPolygon
+from medux_api import LIMITADOR_API, compactar_tipos, decodificar_json, pagina_a_bloque, peticion, post_api
+from medux_geo import (
+    DIRECTORIO_GEO, NIVELES_MANCHAS_M, IndiceEspacial, Topologia,
+    actualizar_distritos, asignar_distritos, asignar_poligonos, distritos_version, guardar_geometrias,
+    huella_archivo, indice_distritos, leer_geometrias, version_distritos,
+)
+from medux_mapa import (
+    LIMITE_PUNTOS_WEBGL, agregar_celdas, agregar_distritos, agregar_puntos, agregar_puntos_webgl,
+    agregar_topologia, geometria_distritos, renderizar_mapa, topojson,
+)
+from medux_store import obtener_resultados
 
 # ===========================================================
 # ISP (ajustar segun los codigos reales que devuelva tu perfil,
@@ -148,6 +162,11 @@ DIRECTORIO_SCRIPT = os.path.dirname(os.path.abspath(__file__))
 KMZ_MANCHAS_PATH = os.path.join(DIRECTORIO_SCRIPT, "Poligonos de medicion PROD Mayo 2026.kmz")
 RADIOBASES_XLSX_PATH = os.path.join(DIRECTORIO_SCRIPT, "Listado Nodos RACSA 5G_con_poligonos.xlsx")
 KML_NS = {"kml": "http://www.opengis.net/kml/2.2"}
+KML_PLACEMARK = "{%s}Placemark" % KML_NS["kml"]
+# Columnas de cada mancha parseada del KMZ guardada en disco.
+CAMPOS_MANCHA = ("nombre",)
+# Columnas de cada pieza (mancha, distrito) guardada en disco.
+CAMPOS_PIEZA_MANCHA = ("nombre", "distrito", "canton", "provincia", "codigo_dta")
 
 # ===========================================================
 # CONFIGURACION INICIAL STREAMLIT
@@ -174,33 +193,17 @@ except Exception as e:
 # mas abajo, se pueda reacomodar libremente sin preocuparse por dependencias)
 # ===========================================================
 def flatten_results(raw_json):
-    """Aplana la respuesta anidada de /api/results en un DataFrame."""
-    filas = []
+    """Aplana una respuesta de /api/results (results -> program -> filas)
+    con el aplanador por columnas de medux_api."""
+    return normalizar_resultados(pagina_a_bloque(raw_json))
 
-    def extraer_filas(obj, program=None):
-        if isinstance(obj, dict):
-            if "results" in obj:
-                extraer_filas(obj["results"], program)
-            else:
-                tiene_lista = False
-                for k, v in obj.items():
-                    if isinstance(v, list):
-                        tiene_lista = True
-                        extraer_filas(v, k)
-                if not tiene_lista:
-                    fila = obj.copy()
-                    if program:
-                        fila["program"] = fila.get("program", program)
-                    filas.append(fila)
-        elif isinstance(obj, list):
-            for item in obj:
-                extraer_filas(item, program)
-
-    extraer_filas(raw_json)
-    if not filas:
-        return pd.DataFrame()
 
-    df = pd.DataFrame(filas)
+def normalizar_resultados(df):
+    """Completa program/test y convierte las fechas a la zona local sobre
+    el DataFrame plano (una fila por muestra) que arma medux_store o
+    flatten_results."""
+    if df.empty:
+        return df
     if "program" not in df.columns:
         df["program"] = "network"
     if "test" not in df.columns:
@@ -212,115 +215,16 @@ def flatten_results(raw_json):
     return df
 
 
-def _descargar_paginado(url, headers, body, debug=False, limite_filas=0):
-    """Loop de paginacion PIT/search_after (doc oficial: paginate:true en la
-    primera peticion; la respuesta trae next_pagination_data.pit/search_after;
-    esos dos valores se reenvian tal cual, junto con paginate:true, hasta que
-    ya no venga pit o la pagina llegue vacia).
-
-    limite_filas: si es > 0, corta la descarga apenas se alcanza ese total
-    (evita quedarse minutos trayendo cientos de miles de filas crudas para
-    rangos de fecha muy amplios). 0 = sin limite.
-    """
-    todos_los_resultados = {}
-    pagina = 1
-    total_acumulado = 0
-    total_reportado_api = None
-    payload = body.copy()
-    payload["paginate"] = True
-    payload.setdefault("size", 10000)
-    pit = None
-    search_after = None
-
-    diag = st.empty() if debug else None
-    barra = st.progress(0, text="Descargando...") if debug else None
-    inicio_descarga = time.time()
-    ultima_peticion_ts = 0.0
-
-    while True:
-        if pit:
-            payload["pit"] = pit
-        if search_after:
-            payload["search_after"] = search_after
-
-        # La API limita a ~1 req/s. Se mide desde el INICIO de la peticion
-        # anterior (no desde que termino): si una pagina de 10,000 filas ya
-        # tardo >=1s en responder -- lo normal -- no hace falta esperar nada
-        # antes de pedir la siguiente. Un sleep fijo de 1.05s DESPUES de cada
-        # respuesta (como antes) suma tiempo muerto innecesario encima del
-        # que ya tardo la propia peticion.
-        espera = 1.02 - (time.time() - ultima_peticion_ts)
-        if espera > 0:
-            time.sleep(espera)
-
-        t0 = time.time()
-        ultima_peticion_ts = t0
-        r = requests.post(url, headers=headers, json=payload, timeout=60)
-        duracion_peticion = time.time() - t0
-        if r.status_code != 200:
-            st.error(f"Error API en pagina {pagina}: {r.status_code} — {r.text[:500]}")
-            break
-
-        data = r.json()
-        total_reportado_api = data.get("total", total_reportado_api)
-        results = data.get("results", {})
-        pagina_vacia = True
-        filas_en_pagina = 0
-        if isinstance(results, list):
-            filas_en_pagina = len(results)
-            if results:
-                pagina_vacia = False
-            todos_los_resultados.setdefault("network", []).extend(results)
-        elif isinstance(results, dict):
-            for prog, res in results.items():
-                if isinstance(res, list):
-                    filas_en_pagina += len(res)
-                    if res:
-                        pagina_vacia = False
-                    todos_los_resultados.setdefault(prog, []).extend(res)
-        total_acumulado += filas_en_pagina
-
-        # El cursor de paginacion viene ANIDADO en "next_pagination_data".
-        cursor = data.get("next_pagination_data") or {}
-        pit = cursor.get("pit")
-        search_after = cursor.get("search_after")
-
-        if diag is not None:
-            transcurrido = time.time() - inicio_descarga
-            velocidad = total_acumulado / transcurrido if transcurrido > 0 else 0
-            diag.caption(
-                f"📥 Pagina {pagina}: {filas_en_pagina} filas en {duracion_peticion:.1f}s "
-                f"(acumulado {total_acumulado:,} / total API reportado: {total_reportado_api}). "
-                f"¿vino cursor pit? {'si' if pit else 'NO'} — "
-                f"{transcurrido:.0f}s transcurridos, ~{velocidad:,.0f} filas/seg"
-            )
-        if barra is not None and total_reportado_api:
-            objetivo = min(total_reportado_api, limite_filas) if limite_filas else total_reportado_api
-            frac = min(1.0, total_acumulado / objetivo) if objetivo else 1.0
-            barra.progress(frac, text=f"{total_acumulado:,} / {objetivo:,} filas")
-
-        if limite_filas and total_acumulado >= limite_filas:
-            st.warning(
-                f"⏹️ Se alcanzo el limite de {limite_filas:,} filas configurado en el sidebar "
-                f"(la API reporta {total_reportado_api:,} filas en total para este rango). "
-                f"Angosta el rango de fechas o sube el limite para traer todo."
-            )
-            break
-        if pagina_vacia or not pit:
-            break
-        pagina += 1
-        if pagina > 100:
-            st.warning("Limite maximo de 100 paginas alcanzado.")
-            break
-
-    return todos_los_resultados
-
-
-@st.cache_data(ttl=1800)
 def obtener_datos_pag(url, headers, body, debug=False, limite_filas=0):
-    """Descarga paginada completa (cacheada 30 min: mismo rango/filtros =
-    no vuelve a golpear la API hasta que cambies algo o pase el TTL)."""
-    return _descargar_paginado(url, headers, body, debug=debug, limite_filas=limite_filas)
+    """Descarga paginada completa a traves del store (medux_store), que
+    entiende el rango y los programs: un rango mas angosto o solapado con
+    uno ya bajado, o un program menos, sale de disco/memoria y a la API
+    solo se le piden los huecos y el borde nuevo de la ultima hora (cada
+    tramo con un cursor PIT por program en paralelo, bajo ~1 req/s).
+    Sin @st.cache_data: cacheaba por el body literal, asi que mover el fin
+    un minuto o sacar un program volvia a bajar todo."""
+    df, _ = obtener_resultados(url, headers, body, zona=zona_local, debug=debug, limite_filas=limite_filas)
+    return df
 
 
 # ===========================================================
@@ -334,9 +238,9 @@ def obtener_datos_pag(url, headers, body, debug=False, limite_filas=0):
 # para pintar puntos individuales).
 @st.cache_data(ttl=1800)
 def obtener_agregado(url, headers, body):
-    r = requests.post(url, headers=headers, json=body, timeout=60)
+    r = post_api(url, headers, body)
     r.raise_for_status()
-    return r.json()
+    return decodificar_json(r)
 
 
 def _extraer_samples(leaf):
@@ -397,9 +301,10 @@ def obtener_tecnologias_perfil(api_base, headers):
     cacheada 24h). Se usa para iterar la tabla agregada una tecnologia a la
     vez (ver nota en parsear_respuesta_aggregate)."""
     try:
-        r = requests.get(f"{api_base}/api/profile/technologies", headers=headers, timeout=30)
+        r = peticion("GET", f"{api_base}/api/profile/technologies", limitador=LIMITADOR_API,
+                     headers=headers, timeout=30)
         r.raise_for_status()
-        data = r.json()
+        data = decodificar_json(r)
     except Exception:
         return []
     items = data.get("data", data) if isinstance(data, dict) else data
@@ -444,9 +349,9 @@ def resolver_ubicacion_sondas(api_url, headers, probes, ts_start, ts_end, distri
         "size": 10000,
     }
     try:
-        r = requests.post(api_url, headers=headers, json=body, timeout=timeout)
+        r = post_api(api_url, headers, body, timeout=timeout)
         r.raise_for_status()
-        data = r.json()
+        data = decodificar_json(r)
     except Exception:
         return {}, []
 
@@ -492,157 +397,45 @@ def resolver_ubicacion_sondas(api_url, headers, probes, ts_start, ts_end, distri
     return ubicacion_por_sonda, sondas_inconsistentes
 
 
-# 1 grado ~ 111,320 m cerca del ecuador (Costa Rica ~9-11N, el error de esta
-# aproximacion es minimo). "tolerancia_m" se pasa como parametro para que el
-# cache se invalide solo cuando cambia el nivel de detalle, no en cada rerun.
-METROS_POR_GRADO = 111_320
+def cargar_distritos_wfs(version=None):
+    """Distritos del IGN (copia local versionada, ver medux_geo; el WFS solo
+    se consulta si todavia no hay ninguna) con 'geometry' a precision
+    completa para el spatial join. Lo que se dibuja sale aparte, ya
+    simplificado y serializado (medux_mapa.geometria_distritos). Sin
+    @st.cache_data: es la lista de distritos_version(version), no modificar."""
+    return distritos_version(version)
 
 
-@st.cache_data(ttl=60 * 60 * 24, show_spinner="Cargando poligonos de distritos (WFS)...")
-def cargar_distritos_wfs(tolerancia_m=10):
-    tolerancia_deg = (tolerancia_m / METROS_POR_GRADO) if tolerancia_m > 0 else 0
-    params = {
-        "service": "WFS",
-        "version": "2.0.0",
-        "request": "GetFeature",
-        "typeName": WFS_LAYER,
-        "outputFormat": "application/json",
-        "srsName": WFS_SRS_OUTPUT,  # se pide directamente en WGS84
-    }
-    r = requests.get(WFS_URL, params=params, timeout=90)
-    r.raise_for_status()
-    geojson = r.json()
-
-    transformer = Transformer.from_crs(WFS_SRS_NATIVE, WFS_SRS_OUTPUT, always_xy=True)
-
-    distritos = []
-    for feat in geojson.get("features", []):
-        props = feat.get("properties", {}) or {}
-        geom = shape(feat["geometry"])
-
-        # Salvaguarda: si el servidor NO reproyecto (coords fuera de rango lat/lon),
-        # se reproyecta en el cliente desde el CRS nativo (EPSG:8908).
-        minx, miny, maxx, maxy = geom.bounds
-        if abs(minx) > 180 or abs(maxx) > 180 or abs(miny) > 90 or abs(maxy) > 90:
-            geom = shapely_transform(transformer.transform, geom)
-
-        # Version simplificada SOLO para dibujar (menos vertices = mapa mucho
-        # mas liviano). Se precalcula aqui, una sola vez, y queda cacheada.
-        # tolerancia_deg == 0 -> se usa la geometria completa (sin deformar).
-        geom_simplificado = (
-            geom.simplify(tolerancia_deg, preserve_topology=True)
-            if tolerancia_deg > 0 else geom
-        )
+def asignar_manchas(df, manchas, indice=None):
+    """Agrega la columna 'mancha' (category: nombre del poligono del KMZ en
+    el que cae cada muestra, NaN si no cae en ninguno) con el mismo spatial
+    join vectorizado que asignar_distritos. Corre UNA vez por consulta, al
+    lado de distrito/canton/provincia: todo lo que depende de la mancha de
+    cada muestra pasa a ser un isin/groupby sobre el df ya en memoria. Las
+    manchas de este KMZ no se solapan (a lo sumo comparten bordes), asi que
+    una sola mancha por muestra alcanza.
 
-        distritos.append({
-            "distrito": props.get("DISTRITO") or "N/D",
-            "canton": props.get("CANTÓN") or "N/D",
-            "provincia": props.get("PROVINCIA") or "N/D",
-            "codigo_dta": props.get("CÓDIGO_DTA"),
-            "geometry": geom,                      # precision completa (spatial join, bounds)
-            "geo": mapping(geom_simplificado),      # liviano (solo para el mapa)
-        })
-    return distritos
-
-
-def asignar_distritos(df, distritos, col_lat="latitude", col_lon="longitude"):
-    """Spatial join: asigna cada muestra a su distrito.
-
-    OPTIMIZACION: la version anterior usaba df.apply(axis=1) llamando una
-    funcion Python fila por fila -- con miles de muestras esto es lento por
-    el overhead propio de pandas (crear una Series por fila) sumado al de
-    cada llamada individual a Point()/tree.query()/.contains(). shapely>=2.0
-    permite construir TODOS los puntos de una sola vez (shapely.points, en
-    C) y consultar el STRtree con un array completo en una sola llamada
-    (tree.query(array, predicate=...)), sin loop en Python por fila. Con
-    ~30,000 muestras esto pasa de tomar varios segundos a milisegundos.
+    'indice' (indice_manchas_kmz) evita rearmar el STRtree en cada consulta.
     """
-    df = df.copy()
-    df["distrito"] = None
-    df["canton"] = None
-    df["provincia"] = None
-    df["codigo_dta"] = None
+    return asignar_poligonos(df, manchas, {"mancha": "nombre"}, indice=indice)
 
-    if df.empty or not distritos:
-        return df
-    if col_lat not in df.columns or col_lon not in df.columns:
-        return df
-
-    lat_arr = pd.to_numeric(df[col_lat], errors="coerce").to_numpy()
-    lon_arr = pd.to_numeric(df[col_lon], errors="coerce").to_numpy()
-    validos = ~pd.isna(lat_arr) & ~pd.isna(lon_arr) & ~((lat_arr == 0) & (lon_arr == 0))
-    if not validos.any():
-        return df
 
-    geoms = [d["geometry"] for d in distritos]
-    tree = STRtree(geoms)
-
-    idx_validos = np.where(validos)[0]
-    puntos = shapely_points(lon_arr[idx_validos], lat_arr[idx_validos])
-
-    # tree.query con un array de geometrias hace la consulta COMPLETA en
-    # codigo compilado (GEOS): devuelve pares (indice-en-puntos, indice-en-
-    # distritos) para todo el batch de una sola vez.
-    pares = tree.query(puntos, predicate="intersects")
-    asignado = {}
-    for i_pt, i_geom in zip(pares[0], pares[1]):
-        idx_original = idx_validos[i_pt]
-        if idx_original not in asignado:  # se queda con el primer match
-            asignado[idx_original] = i_geom
-
-    n = len(df)
-    distrito_arr = [None] * n
-    canton_arr = [None] * n
-    provincia_arr = [None] * n
-    codigo_arr = [None] * n
-    for idx_original, i_geom in asignado.items():
-        d = distritos[i_geom]
-        distrito_arr[idx_original] = d["distrito"]
-        canton_arr[idx_original] = d["canton"]
-        provincia_arr[idx_original] = d["provincia"]
-        codigo_arr[idx_original] = d["codigo_dta"]
-
-    df["distrito"] = distrito_arr
-    df["canton"] = canton_arr
-    df["provincia"] = provincia_arr
-    df["codigo_dta"] = codigo_arr
-    return df
-
-
-def manchas_con_muestras(df_puntos, manchas, col_lat="latitude", col_lon="longitude"):
+def manchas_con_muestras(df_puntos):
     """Devuelve el set de nombres de 'mancha' (poligonos del KMZ) que tienen
-    AL MENOS una muestra de df_puntos adentro -- mismo spatial join
-    vectorizado que asignar_distritos, pero contra los poligonos del KMZ en
-    vez de los distritos del IGN, y solo interesa el nombre (no hace falta
-    devolver el df completo).
+    AL MENOS una muestra de df_puntos adentro: sale de la columna 'mancha'
+    que asignar_manchas agrego al consultar, sin spatial join en cada rerun.
 
     Esto NO depende de resolver_ubicacion_sondas ni de la tabla de agregados
     (que tiene sus propios problemas con el perfil de RACSA) -- usa
     directamente los puntos crudos (lat/lon) que ya trajo la consulta del
     mapa (raw), asi que es independiente de esa otra logica.
     """
-    if df_puntos is None or df_puntos.empty or not manchas:
-        return set()
-    if col_lat not in df_puntos.columns or col_lon not in df_puntos.columns:
+    if df_puntos is None or df_puntos.empty or "mancha" not in df_puntos.columns:
         return set()
-
-    lat_arr = pd.to_numeric(df_puntos[col_lat], errors="coerce").to_numpy()
-    lon_arr = pd.to_numeric(df_puntos[col_lon], errors="coerce").to_numpy()
-    validos = ~pd.isna(lat_arr) & ~pd.isna(lon_arr) & ~((lat_arr == 0) & (lon_arr == 0))
-    if not validos.any():
-        return set()
-
-    geoms = [m["geometry"] for m in manchas]
-    tree = STRtree(geoms)
-    idx_validos = np.where(validos)[0]
-    puntos = shapely_points(lon_arr[idx_validos], lat_arr[idx_validos])
-    pares = tree.query(puntos, predicate="intersects")
-
-    nombres_con_muestras = {manchas[i_geom]["nombre"] for i_geom in pares[1]}
-    return nombres_con_muestras
+    return set(df_puntos["mancha"].dropna().unique())
 
 
-def dividir_manchas_por_distrito(manchas, distritos, tolerancia_m=30):
+def dividir_manchas_por_distrito(manchas, distritos, indice=None):
     """Subdivide cada 'mancha' (poligono KMZ) en los pedazos que caen dentro
     de cada distrito con el que se solapa, calculando la INTERSECCION
     geometrica real -- no basta con resolver un unico distrito por mancha
@@ -657,23 +450,26 @@ def dividir_manchas_por_distrito(manchas, distritos, tolerancia_m=30):
     asi que el tooltip SI cambia segun la posicion real del cursor.
 
     Devuelve una lista de "piezas": una por cada interseccion
-    (mancha, distrito) con area > 0, con las mismas claves que una mancha
-    normal (nombre, geometry, geo) mas distrito/canton/provincia/codigo_dta
-    ya resueltos para ESA pieza en particular. Si una mancha no se solapa
+    (mancha, distrito) con area > 0, con nombre y geometry (sin simplificar:
+    la version para dibujar sale de la topologia de topojson_manchas)
+    mas distrito/canton/provincia/codigo_dta ya resueltos para ESA pieza en
+    particular. Si una mancha no se solapa
     con ningun distrito cargado (por ejemplo si cae fuera de la cobertura
     del WFS), se deja igual -- sin subdividir, sin distrito -- para no
     perder el poligono del mapa.
+
+    'indice' (medux_geo.indice_distritos, misma version que 'distritos')
+    evita rearmar el STRtree de distritos.
     """
     if not manchas or not distritos:
-        return manchas
+        return [dict(m, distrito=None, canton=None, provincia=None, codigo_dta=None) for m in manchas]
 
-    tolerancia_deg = (tolerancia_m / METROS_POR_GRADO) if tolerancia_m > 0 else 0
-    geoms_distritos = [d["geometry"] for d in distritos]
-    tree = STRtree(geoms_distritos)
+    if indice is None:
+        indice = IndiceEspacial([d["geometry"] for d in distritos])
 
     piezas = []
     for m in manchas:
-        candidatos_idx = tree.query(m["geometry"], predicate="intersects")
+        candidatos_idx = indice.intersectan(m["geometry"])
         alguna_pieza = False
         for i_dist in candidatos_idx:
             d = distritos[i_dist]
@@ -695,14 +491,9 @@ def dividir_manchas_por_distrito(manchas, distritos, tolerancia_m=30):
                     interseccion = polys[0] if len(polys) == 1 else MultiPolygon(polys)
                 else:
                     continue
-            geo_simplificado = (
-                interseccion.simplify(tolerancia_deg, preserve_topology=True)
-                if tolerancia_deg > 0 else interseccion
-            )
             piezas.append({
                 "nombre": m["nombre"],
                 "geometry": interseccion,
-                "geo": mapping(geo_simplificado),
                 "distrito": d["distrito"],
                 "canton": d["canton"],
                 "provincia": d["provincia"],
@@ -714,78 +505,214 @@ def dividir_manchas_por_distrito(manchas, distritos, tolerancia_m=30):
     return piezas
 
 
-def _parse_coordenadas_kml(texto_coordenadas):
-    """Parsea el texto de un <coordinates> de KML: grupos separados por
-    espacios, cada uno 'lon,lat[,alt]' separado por comas."""
-    puntos = []
-    for grupo in texto_coordenadas.split():
-        partes = grupo.split(",")
-        lon, lat = float(partes[0]), float(partes[1])
-        puntos.append((lon, lat))
-    return puntos
+@st.cache_resource(show_spinner="Dividiendo manchas de cobertura por distrito...")
+def _piezas_manchas_por_distrito(ruta_kmz, modificado, version_dist):
+    """Piezas (mancha, distrito) de dividir_manchas_por_distrito, UNA vez
+    por (KMZ, version de distritos) y compartidas entre sesiones (no
+    modificar). Las intersecciones no dependen de la tolerancia, asi que
+    tampoco se recalculan al mover el slider. Ademas quedan en disco (CAMPOS_PIEZA_MANCHA, WKB) con el hash
+    del KMZ y la version de distritos en el nombre:
+        <DIRECTORIO_GEO>/manchas_distritos_<kmz>_<distritos>.parquet
+    asi que ni un reinicio del contenedor vuelve a intersecar."""
+    manchas, _ = _manchas_kmz(ruta_kmz, modificado)
+    distritos = distritos_version(version_dist)
+    ruta = None
+    if version_dist is not None:  # hay copia local de distritos => hay pyarrow
+        archivo = f"manchas_distritos_{huella_archivo(ruta_kmz)}_{version_dist}.parquet"
+        ruta = os.path.join(DIRECTORIO_GEO, archivo)
+    piezas = None
+    if ruta and os.path.exists(ruta):
+        try:
+            piezas = leer_geometrias(ruta, CAMPOS_PIEZA_MANCHA)
+        except Exception:
+            piezas = None
+    if piezas is None:
+        piezas = dividir_manchas_por_distrito(manchas, distritos, indice=indice_distritos(version_dist))
+        if ruta:
+            try:
+                guardar_geometrias(piezas, CAMPOS_PIEZA_MANCHA, ruta)
+            except OSError:
+                pass  # sin disco escribible: queda solo en memoria
+    return piezas
 
 
-@st.cache_data(ttl=60 * 60 * 24, show_spinner="Cargando manchas de cobertura (KMZ)...")
-def cargar_manchas_kmz(ruta_kmz, tolerancia_m=30):
-    """Extrae cada Placemark/Polygon de un KMZ (zip con un doc.kml adentro)
-    y devuelve una lista de dicts {nombre, geometry, geo} -- mismo patron que
-    cargar_distritos_wfs (geometry = precision completa, geo = version
-    simplificada ya en formato GeoJSON, lista para dibujar).
+@st.cache_resource(show_spinner="Armando la topologia y los niveles de simplificacion de las manchas...")
+def _topologia_manchas(ruta_kmz, modificado, version_dist):
+    """(Topologia, objetos) de las manchas del KMZ seguidas de sus piezas
+    por distrito (_piezas_manchas_por_distrito), en UNA sola topologia: el
+    contorno de cada mancha y el de sus pedazos comparten los arcos.
+    'objetos' = propiedades de cada geometria para medux_mapa.topojson
+    ("manchas": nombre; "piezas": nombre + distrito/canton/provincia/codigo
+    DTA, "N/D" si no hay). Una vez por (KMZ, version de distritos)."""
+    manchas, _ = _manchas_kmz(ruta_kmz, modificado)
+    piezas = _piezas_manchas_por_distrito(ruta_kmz, modificado, version_dist)
+    topologia = Topologia([g["geometry"] for g in manchas + piezas], NIVELES_MANCHAS_M)
+    objetos = {
+        "manchas": [{"nombre": m["nombre"]} for m in manchas],
+        "piezas": [
+            dict({c: p.get(c) or "N/D" for c in ("codigo_dta", "distrito", "canton", "provincia")},
+                 nombre=p["nombre"])
+            for p in piezas
+        ],
+    }
+    return topologia, objetos
 
-    Estas 'manchas' NO son distritos administrativos -- son poligonos propios
-    del proyecto RACSA (zonas de medicion), por eso se cargan y dibujan
-    aparte, con su propio estilo. Vienen mucho mas densos que los distritos
-    del IGN (miles de vertices por poligono), de ahi que la tolerancia de
-    simplificacion por defecto (30m) sea mayor a la de distritos (10m).
-    """
+
+@st.cache_resource(show_spinner=False)
+def _topojson_manchas(ruta_kmz, modificado, version_dist, nivel):
+    topologia, objetos = _topologia_manchas(ruta_kmz, modificado, version_dist)
+    return topojson(topologia, nivel, objetos)
+
+
+def topojson_manchas(ruta_kmz, tolerancia_m=30, version_dist=None):
+    """TopoJSON (texto) con los objetos "manchas" (poligono completo de
+    cada mancha) y "piezas" (subdivididas por distrito, para el tooltip) en
+    el nivel de simplificacion mas cercano a 'tolerancia_m', o None si no
+    hay KMZ. Se serializa una vez por nivel: sin @st.cache_data."""
     if not os.path.exists(ruta_kmz):
+        return None
+    modificado = os.path.getmtime(ruta_kmz)
+    if not _manchas_kmz(ruta_kmz, modificado)[0]:
+        return None
+    topologia, _ = _topologia_manchas(ruta_kmz, modificado, version_dist)
+    return _topojson_manchas(ruta_kmz, modificado, version_dist, topologia.nivel(tolerancia_m))
+
+
+def _coordenadas_kml(texto_coordenadas):
+    """Parsea el texto de un <coordinates> de KML (grupos 'lon,lat[,alt]'
+    separados por espacios) a un array (n, 2) de lon/lat: NumPy convierte
+    todos los numeros de una vez, sin un float() por coordenada. Si los
+    grupos no tienen todos la misma cantidad de componentes (unos con
+    altura y otros sin), se parte grupo por grupo como antes."""
+    grupos = texto_coordenadas.split()
+    valores = np.fromstring(texto_coordenadas.replace(",", " "), sep=" ")
+    if grupos and len(valores) % len(grupos) == 0:
+        return valores.reshape(len(grupos), -1)[:, :2]
+    return np.array([grupo.split(",")[:2] for grupo in grupos], dtype=float).reshape(-1, 2)
+
+
+def _anillo_valido(coords):
+    """Mismo criterio que Polygon(): un anillo necesita al menos 3 puntos
+    distintos (4 coordenadas una vez cerrado)."""
+    return len(coords) >= 4 or (len(coords) == 3 and (coords[0] != coords[-1]).any())
+
+
+def _leer_manchas_kml(archivo_kml):
+    """Recorre el KML con iterparse (cada Placemark se suelta apenas se lee,
+    sin armar el arbol completo en memoria) y devuelve las manchas
+    {nombre, geometry}. Las coordenadas de todos los anillos se juntan en un
+    solo array y los poligonos se arman al final con los constructores
+    vectorizados de shapely (linearrings -> polygons -> multipolygons).
+    Un poligono con algun anillo invalido se descarta; un Placemark sin
+    poligonos tambien."""
+    nombres = []
+    coords = []               # un array (n, 2) por anillo
+    poligono_de_anillo = []   # poligono al que pertenece cada anillo (el 1ro es el exterior)
+    mancha_de_poligono = []   # mancha a la que pertenece cada poligono
+    for _, elem in ET.iterparse(archivo_kml, events=("end",)):
+        if elem.tag != KML_PLACEMARK:
+            continue
+        nombre_el = elem.find("kml:name", KML_NS)
+        nombre = nombre_el.text.strip() if nombre_el is not None and nombre_el.text else "N/D"
+        i_mancha = len(nombres)
+        for poly_el in elem.iterfind(".//kml:Polygon", KML_NS):
+            outer = poly_el.find(".//kml:outerBoundaryIs/kml:LinearRing/kml:coordinates", KML_NS)
+            if outer is None or not outer.text:
+                continue
+            anillos = [_coordenadas_kml(outer.text)] + [
+                _coordenadas_kml(inner.text)
+                for inner in poly_el.iterfind(".//kml:innerBoundaryIs/kml:LinearRing/kml:coordinates", KML_NS)
+                if inner.text
+            ]
+            if not all(_anillo_valido(a) for a in anillos):
+                continue
+            i_poligono = len(mancha_de_poligono)
+            coords.extend(anillos)
+            poligono_de_anillo.extend([i_poligono] * len(anillos))
+            mancha_de_poligono.append(i_mancha)
+        if mancha_de_poligono and mancha_de_poligono[-1] == i_mancha:
+            nombres.append(nombre)
+        elem.clear()
+    if not nombres:
         return []
 
-    tolerancia_deg = (tolerancia_m / METROS_POR_GRADO) if tolerancia_m > 0 else 0
+    tamanos = np.array([len(a) for a in coords])
+    anillos = shapely.linearrings(np.concatenate(coords), indices=np.repeat(np.arange(len(coords)), tamanos))
+    poligonos = shapely.polygons(anillos, indices=poligono_de_anillo)
+    mancha_de_poligono = np.asarray(mancha_de_poligono)
+    geoms = shapely.multipolygons(poligonos, indices=mancha_de_poligono)
+    # Una mancha de un solo poligono queda como Polygon (no MultiPolygon de 1).
+    por_mancha = np.bincount(mancha_de_poligono, minlength=len(nombres))
+    primero = np.concatenate(([0], np.cumsum(por_mancha)[:-1]))
+    simples = por_mancha == 1
+    geoms[simples] = poligonos[primero[simples]]
+    invalidas = ~shapely.is_valid(geoms)
+    geoms[invalidas] = shapely.buffer(geoms[invalidas], 0)
+    return [{"nombre": nombre, "geometry": geom} for nombre, geom in zip(nombres, geoms)]
+
+
+def leer_manchas_kmz(ruta_kmz):
+    """Manchas {nombre, geometry} del KMZ. Lo parseado queda en disco como
+    Parquet/WKB con el hash del KMZ en el nombre:
+        <DIRECTORIO_GEO>/manchas_<hash>.parquet
+    asi que el KML solo se vuelve a parsear si cambia el archivo."""
+    ruta = os.path.join(DIRECTORIO_GEO, f"manchas_{huella_archivo(ruta_kmz)}.parquet")
+    try:
+        manchas = leer_geometrias(ruta, CAMPOS_MANCHA)
+    except Exception:
+        manchas = None
+    if manchas is not None:
+        return manchas
 
     with zipfile.ZipFile(ruta_kmz) as z:
         nombre_kml = next((n for n in z.namelist() if n.lower().endswith(".kml")), None)
         if nombre_kml is None:
             return []
-        kml_bytes = z.read(nombre_kml)
+        with z.open(nombre_kml) as archivo_kml:
+            manchas = _leer_manchas_kml(archivo_kml)
+    try:
+        guardar_geometrias(manchas, CAMPOS_MANCHA, ruta)
+    except OSError:
+        pass  # sin disco escribible: se vuelve a parsear en el proximo arranque
+    return manchas
 
-    root = ET.fromstring(kml_bytes)
-    manchas = []
-    for placemark in root.findall(".//kml:Placemark", KML_NS):
-        nombre_el = placemark.find("kml:name", KML_NS)
-        nombre = nombre_el.text.strip() if nombre_el is not None and nombre_el.text else "N/D"
 
-        poligonos = []
-        for poly_el in placemark.findall(".//kml:Polygon", KML_NS):
-            outer = poly_el.find(".//kml:outerBoundaryIs/kml:LinearRing/kml:coordinates", KML_NS)
-            if outer is None or not outer.text:
-                continue
-            anillo_externo = _parse_coordenadas_kml(outer.text)
-            huecos = []
-            for inner in poly_el.findall(".//kml:innerBoundaryIs/kml:LinearRing/kml:coordinates", KML_NS):
-                if inner.text:
-                    huecos.append(_parse_coordenadas_kml(inner.text))
-            try:
-                poligonos.append(Polygon(anillo_externo, huecos))
-            except Exception:
-                continue
+@st.cache_resource(show_spinner="Cargando manchas de cobertura (KMZ)...")
+def _manchas_kmz(ruta_kmz, modificado):
+    """Lee el KMZ UNA vez por archivo ('modificado' = su mtime, para
+    releerlo si cambia) y arma su indice espacial. Devuelve (manchas a
+    precision completa, indice), compartido entre sesiones: no modificar."""
+    manchas = leer_manchas_kmz(ruta_kmz)
+    if not manchas:
+        return [], None
+    return manchas, IndiceEspacial([m["geometry"] for m in manchas])
 
-        if not poligonos:
-            continue
-        geom = poligonos[0] if len(poligonos) == 1 else MultiPolygon(poligonos)
-        if not geom.is_valid:
-            geom = geom.buffer(0)
 
-        geom_simplificado = (
-            geom.simplify(tolerancia_deg, preserve_topology=True)
-            if tolerancia_deg > 0 else geom
-        )
-        manchas.append({
-            "nombre": nombre,
-            "geometry": geom,
-            "geo": mapping(geom_simplificado),
-        })
-    return manchas
+def cargar_manchas_kmz(ruta_kmz):
+    """Extrae cada Placemark/Polygon de un KMZ (zip con un doc.kml adentro)
+    y devuelve una lista de dicts {nombre, geometry} -- mismo patron que
+    cargar_distritos_wfs (geometry = precision completa, para el spatial
+    join; lo que se dibuja sale ya simplificado de topojson_manchas).
+
+    Estas 'manchas' NO son distritos administrativos -- son poligonos propios
+    del proyecto RACSA (zonas de medicion), por eso se cargan y dibujan
+    aparte, con su propio estilo. Vienen mucho mas densos que los distritos
+    del IGN (miles de vertices por poligono), de ahi que la tolerancia de
+    simplificacion por defecto (30m) sea mayor a la de distritos (10m).
+
+    El parseo se hace una sola vez por archivo (_manchas_kmz).
+    """
+    if not os.path.exists(ruta_kmz):
+        return []
+    return _manchas_kmz(ruta_kmz, os.path.getmtime(ruta_kmz))[0]
+
+
+def indice_manchas_kmz(ruta_kmz):
+    """IndiceEspacial de las manchas de cargar_manchas_kmz(ruta_kmz) (mismo
+    orden), o None si no hay KMZ."""
+    if not os.path.exists(ruta_kmz):
+        return None
+    return _manchas_kmz(ruta_kmz, os.path.getmtime(ruta_kmz))[1]
 
 
 @st.cache_data(ttl=60 * 60 * 24, show_spinner="Cargando radiobases (Excel)...")
@@ -934,7 +861,7 @@ def tabla_conteo_distrito(df, col_tech=None):
     if df_valid.empty:
         return pd.DataFrame()
 
-    df_valid["isp"] = df_valid["isp"].replace(ISP_NAME_MAP)
+    df_valid["isp"] = df_valid["isp"].map(lambda v: ISP_NAME_MAP.get(v, v))
     if "codigo_dta" in df_valid.columns:
         df_valid["codigo_dta"] = df_valid["codigo_dta"].astype("Int64")
 
@@ -942,11 +869,11 @@ def tabla_conteo_distrito(df, col_tech=None):
         else ["distrito", "canton", "provincia"]
     usar_tech = bool(col_tech and col_tech in df_valid.columns)
     if usar_tech:
-        df_valid[col_tech] = df_valid[col_tech].fillna("N/D").astype(str)
+        df_valid[col_tech] = df_valid[col_tech].astype(object).fillna("N/D").astype(str)
         index_cols = index_cols + [col_tech]
 
     conteo = (
-        df_valid.groupby(index_cols + ["isp", "test"])
+        df_valid.groupby(index_cols + ["isp", "test"], observed=True)
         .size()
         .reset_index(name="Pruebas")
     )
@@ -1055,12 +982,11 @@ def construir_tabla_agregada(api_url, headers, ts_start, ts_end, programas, prob
     return tabla, len(df_largo), conteo_targets
 
 
-def construir_mapa(distritos, conteo_por_distrito, df_puntos=None, mostrar_puntos=False,
+def construir_mapa(distritos, conteo_por_distrito, geometria, df_puntos=None, mostrar_puntos=False,
                     bounds=None, distritos_resaltados=None, paleta=None,
                     usar_escalones=False, n_escalones=6, metodo_escalon="quantiles",
                     redondear_escalones="int", manchas=None, mostrar_manchas=False,
-                    manchas_tooltip=None,
-                    radiobases=None, mostrar_radiobases=False):
+                    radiobases=None, mostrar_radiobases=False, modo_puntos="individual"):
     # prefer_canvas=True: los puntos se dibujan en un solo <canvas> en vez de
     # un nodo SVG por marcador -- clave para poder mostrar miles de muestras
     # sin que el navegador se ponga lento al hacer pan/zoom.
@@ -1087,100 +1013,35 @@ def construir_mapa(distritos, conteo_por_distrito, df_puntos=None, mostrar_punto
         colormap = paleta.scale(0, max_count if max_count > 0 else 1)
     colormap.caption = "Pruebas por distrito"
 
-    # Una sola capa GeoJson con los 494 distritos (mucho mas rapido que 494
-    # capas individuales). El color/resaltado se resuelve via style_function
-    # leyendo las properties de cada feature.
+    # Una sola capa con los 494 distritos (mucho mas rapido que 494 capas
+    # individuales). La geometria llega ya serializada ('geometria', ver
+    # medux_mapa.geometria_distritos: una vez por version y nivel de
+    # simplificacion); en cada rerun solo se arman conteo/color/resaltado por
+    # distrito.
     # OJO: la clave de conteo_por_distrito debe ser (distrito, canton, provincia).
     # Costa Rica repite nombres de distrito en varios cantones (San Rafael,
     # San Isidro, Concepcion, Mercedes, San Miguel, etc.) -- usar solo el
     # nombre pintaba de mas los distritos "tocayos" sin muestras reales.
-    features = []
-    for d in distritos:
-        clave = (d["distrito"], d["canton"], d["provincia"])
-        count = conteo_por_distrito.get(clave, 0)
-        resaltado = clave in distritos_resaltados
-        features.append({
-            "type": "Feature",
-            "geometry": d["geo"],
-            "properties": {
-                "codigo_dta": d.get("codigo_dta"),
-                "distrito": d["distrito"],
-                "canton": d["canton"],
-                "provincia": d["provincia"],
-                "count": count,
-                "resaltado": resaltado,
-            },
-        })
-    feature_collection = {"type": "FeatureCollection", "features": features}
-
-    def estilo(feat):
-        p = feat["properties"]
-        count = p["count"]
-        color = colormap(count) if count > 0 else "#eeeeee"
-        return {
-            "fillColor": color,
-            "color": "#2b6cb0" if p["resaltado"] else "#555555",
-            "weight": 3 if p["resaltado"] else 0.4,
-            "fillOpacity": 0.65 if count > 0 else 0.12,
-        }
-
-    folium.GeoJson(
-        data=feature_collection,
-        style_function=estilo,
-        tooltip=folium.GeoJsonTooltip(
-            fields=["codigo_dta", "distrito", "canton", "provincia", "count"],
-            aliases=["Codigo DTA", "Distrito", "Canton", "Provincia", "Pruebas"],
-        ),
-    ).add_to(m)
+    agregar_distritos(m, distritos, conteo_por_distrito, distritos_resaltados, colormap, geometria=geometria)
 
     if max_count > 0:
         colormap.add_to(m)
 
     if mostrar_puntos and df_puntos is not None and not df_puntos.empty:
-        # Una sola capa GeoJson para TODOS los puntos (igual optimizacion que
-        # los distritos): con miles de CircleMarker individuales, cada uno
-        # generaba su propio objeto JS -- el HTML resultante se volvia enorme
-        # y lento de construir. Con una FeatureCollection + un solo marker
-        # "molde" reutilizado por Leaflet, el mismo volumen de puntos se
-        # arma muchisimo mas rapido y pesa una fraccion del HTML.
-        punto_features = []
-        for _, row in df_puntos.iterrows():
-            lat, lon = row.get("latitude"), row.get("longitude")
-            if pd.isna(lat) or pd.isna(lon):
-                continue
-            isp_label = ISP_NAME_MAP.get(row.get("isp"), row.get("isp"))
-            punto_features.append({
-                "type": "Feature",
-                "geometry": {"type": "Point", "coordinates": [float(lon), float(lat)]},
-                "properties": {
-                    "isp": isp_label,
-                    "test": row.get("test"),
-                    "distrito": row.get("distrito"),
-                    "color": ISP_COLOR_MAP.get(isp_label, "#333333"),
-                },
-            })
-
-        if punto_features:
-            def estilo_punto(feat):
-                color = feat["properties"]["color"]
-                return {"radius": 3, "fillColor": color, "color": color, "weight": 1, "fillOpacity": 0.8}
-
-            folium.GeoJson(
-                data={"type": "FeatureCollection", "features": punto_features},
-                marker=folium.CircleMarker(radius=3, fill=True),
-                style_function=estilo_punto,
-                tooltip=folium.GeoJsonTooltip(
-                    fields=["isp", "test", "distrito"],
-                    aliases=["ISP", "Program", "Distrito"],
-                ),
-            ).add_to(m)
-
-            isps_presentes = sorted({f["properties"]["isp"] for f in punto_features if f["properties"]["isp"]})
-            _agregar_leyenda_isp(m, isps_presentes)
+        # Una sola capa para TODOS los puntos, armada por columnas con NumPy
+        # (sin un dict de GeoJSON por muestra ni style_function por feature):
+        # ver medux_mapa.agregar_puntos (o, por encima del limite de puntos,
+        # agregar_puntos_webgl, buffer binario para WebGL, o agregar_celdas,
+        # muestras agregadas en celdas hexagonales).
+        agregar = {"webgl": agregar_puntos_webgl, "celdas": agregar_celdas}.get(modo_puntos, agregar_puntos)
+        isps_presentes = agregar(m, df_puntos, ISP_NAME_MAP, ISP_COLOR_MAP)
+        _agregar_leyenda_isp(m, isps_presentes)
 
     # --- Capa de "manchas" de cobertura (KMZ, especifico de RACSA) ---------
     # Poligonos propios del proyecto, NO son distritos administrativos.
-    # Se dibujan en DOS capas GeoJson separadas:
+    # 'manchas' = topojson_manchas(...) (TopoJSON con los objetos "manchas" y
+    # "piezas": los arcos que comparten viajan una sola vez). Se dibujan en
+    # DOS capas separadas:
     #   1) VISIBLE: el poligono ORIGINAL de cada mancha (sin subdividir),
     #      un solo contorno punteado azul por mancha -- exactamente como se
     #      veia antes. Subdividir cada mancha por distrito (ver
@@ -1198,50 +1059,22 @@ def construir_mapa(distritos, conteo_por_distrito, df_puntos=None, mostrar_punto
     #      muestre el Distrito/Canton/Provincia/Codigo DTA exacto segun la
     #      posicion del cursor, sin ensuciar el dibujo de la capa 1.
     if mostrar_manchas and manchas:
-        mancha_features = [
+        agregar_topologia(m, manchas, [
             {
-                "type": "Feature",
-                "geometry": mancha["geo"],
-                "properties": {"nombre": mancha["nombre"]},
-            }
-            for mancha in manchas
-        ]
-        if mancha_features:
-            folium.GeoJson(
-                data={"type": "FeatureCollection", "features": mancha_features},
-                style_function=lambda feat: {
+                "objeto": "manchas",
+                "estilo": {
                     "fillColor": "#1f6feb",
                     "color": "#1f6feb",
                     "weight": 2,
                     "dashArray": "6, 4",
                     "fillOpacity": 0.06,
                 },
-                tooltip=folium.GeoJsonTooltip(
-                    fields=["nombre"],
-                    aliases=["Mancha (KMZ)"],
-                ),
-                name="Manchas de cobertura (KMZ)",
-            ).add_to(m)
-
-        piezas_tooltip = manchas_tooltip if manchas_tooltip is not None else manchas
-        pieza_features = [
+                "campos": ["nombre"],
+                "alias": ["Mancha (KMZ)"],
+            },
             {
-                "type": "Feature",
-                "geometry": pieza["geo"],
-                "properties": {
-                    "nombre": pieza["nombre"],
-                    "codigo_dta": pieza.get("codigo_dta") or "N/D",
-                    "distrito": pieza.get("distrito") or "N/D",
-                    "canton": pieza.get("canton") or "N/D",
-                    "provincia": pieza.get("provincia") or "N/D",
-                },
-            }
-            for pieza in piezas_tooltip
-        ]
-        if pieza_features:
-            folium.GeoJson(
-                data={"type": "FeatureCollection", "features": pieza_features},
-                style_function=lambda feat: {
+                "objeto": "piezas",
+                "estilo": {
                     "fillColor": "#1f6feb",
                     "color": "#1f6feb",
                     "weight": 0,
@@ -1249,12 +1082,10 @@ def construir_mapa(distritos, conteo_por_distrito, df_puntos=None, mostrar_punto
                     "fill": True,
                     "fillOpacity": 0.001,
                 },
-                tooltip=folium.GeoJsonTooltip(
-                    fields=["codigo_dta", "distrito", "canton", "provincia", "nombre"],
-                    aliases=["Codigo DTA", "Distrito", "Canton", "Provincia", "Mancha (KMZ)"],
-                ),
-                name="Manchas (tooltip por distrito)",
-            ).add_to(m)
+                "campos": ["codigo_dta", "distrito", "canton", "provincia", "nombre"],
+                "alias": ["Codigo DTA", "Distrito", "Canton", "Provincia", "Mancha (KMZ)"],
+            },
+        ])
 
     # --- Capa de radiobases (Excel, especifico de RACSA) -------------------
     # Solo ~200 puntos -- a diferencia de las muestras (miles), aca un
@@ -1393,7 +1224,7 @@ st.sidebar.write(f"Fin: {fin_local_str}")
 # refleja el ultimo valor elegido por el usuario.
 if "poly_simplificacion_m" not in st.session_state:
     st.session_state["poly_simplificacion_m"] = 10
-distritos = cargar_distritos_wfs(st.session_state["poly_simplificacion_m"])
+distritos = cargar_distritos_wfs(version_distritos())
 
 st.sidebar.markdown("---")
 st.sidebar.header("Filtrar por distrito")
@@ -1530,16 +1361,7 @@ operador_sel = st.sidebar.multiselect(
 # ===========================================================
 if "racsa_simplif_manchas_m" not in st.session_state:
     st.session_state["racsa_simplif_manchas_m"] = 30
-manchas_kmz = cargar_manchas_kmz(KMZ_MANCHAS_PATH, tolerancia_m=st.session_state["racsa_simplif_manchas_m"])
-# Para el tooltip del mapa, cada mancha se SUBDIVIDE segun los distritos con
-# los que se solapa (interseccion geometrica real, no un unico punto
-# representativo) -- ver docstring de dividir_manchas_por_distrito. Esta
-# version subdividida (manchas_kmz_tooltip) es SOLO para dibujar/tooltip;
-# manchas_kmz (sin dividir) se sigue usando para todo lo demas (conteo en el
-# sidebar, filtro de radiobases por nombre de mancha via manchas_con_muestras).
-manchas_kmz_tooltip = dividir_manchas_por_distrito(
-    manchas_kmz, distritos, tolerancia_m=st.session_state["racsa_simplif_manchas_m"]
-)
+manchas_kmz = cargar_manchas_kmz(KMZ_MANCHAS_PATH)
 radiobases_df, radiobases_descartadas = cargar_radiobases(RADIOBASES_XLSX_PATH)
 
 st.sidebar.markdown("---")
@@ -1617,6 +1439,21 @@ simplificacion_m = st.sidebar.slider(
     help="0 = geometria original del IGN (mas fiel, mapa mas pesado). "
          "Valores altos deforman distritos pequenos/urbanos.",
 )
+if st.sidebar.button(
+    "Actualizar poligonos (WFS)",
+    help="Vuelve a bajar los distritos del WFS del IGN. Normalmente no hace "
+         "falta: se usa la copia guardada en disco.",
+):
+    try:
+        with st.spinner("Descargando distritos del WFS del IGN..."):
+            actualizar_distritos()
+    except Exception as e:
+        st.sidebar.error(f"No se pudo bajar del WFS, se sigue usando la copia local: {e}")
+    else:
+        distritos_version.clear()
+        st.rerun()
+if version_distritos():
+    st.sidebar.caption(f"Poligonos de distritos: version {version_distritos()}")
 
 PALETAS_MAPA = {
     "Amarillo-Naranja-Rojo": "YlOrRd_09",
@@ -1658,21 +1495,24 @@ now = time.time()
 should_fetch = st.sidebar.button("🔄 Consultar Mapa y Tabla")
 
 if should_fetch:
-    raw = obtener_datos_pag(API_URL, headers, body, debug=debug_paginacion, limite_filas=limite_filas)
-    if not raw:
-        st.warning("No se recibieron datos de la API.")
-        st.stop()
-    df_nuevo = flatten_results(raw)
+    df_nuevo = obtener_datos_pag(API_URL, headers, body, debug=debug_paginacion, limite_filas=limite_filas)
     if df_nuevo.empty:
-        st.warning("No se recibieron datos.")
+        st.warning("No se recibieron datos de la API.")
         st.stop()
+    df_nuevo = normalizar_resultados(df_nuevo)
     # El spatial join corre UNA sola vez por consulta nueva (no en cada rerun:
     # cambiar el filtro de distrito o el checkbox de puntos ya no lo recalcula).
-    df_nuevo = asignar_distritos(df_nuevo, distritos)
+    df_nuevo = asignar_distritos(df_nuevo, distritos, indice=indice_distritos(version_distritos()))
+    if manchas_kmz:
+        df_nuevo = asignar_manchas(df_nuevo, manchas_kmz, indice=indice_manchas_kmz(KMZ_MANCHAS_PATH))
     # Desglosa 'ping-test' por target/IP destino (una sola vez, no en cada
     # rerun) -- la tabla de conteo mas abajo ya ve "ping-test (ip)" como si
     # fuera un program mas, sin logica especial.
     df_nuevo, _ = preparar_test_con_target(df_nuevo)
+    # Tipos compactos (category/float32) DESPUES del spatial join y del
+    # desglose de ping-test, para que distrito/canton/provincia/mancha y 'test'
+    # tambien queden como category en session_state.
+    df_nuevo = compactar_tipos(df_nuevo)
     st.session_state.poly_df = df_nuevo
     st.session_state.poly_last_fetch_ts = now
     # El filtro de "Tecnologia y Operador" (sidebar) se dibuja MAS ARRIBA en
@@ -1738,10 +1578,11 @@ else:
     elif provincia_sel != "Todos":
         st.caption(f"📍 Filtrando por provincia: **{provincia_sel}** — {len(df_filtrado)} muestras")
 
-    # Los puntos se dibujan como UNA sola capa GeoJson + canvas (no un CircleMarker
-    # por muestra), asi que el techo real subio bastante: 50,000 puntos arman el
-    # mapa en menos de 1s. Igual queda ajustable por si tu maquina/navegador
-    # prefiere un limite mas bajo.
+    # Los puntos se dibujan como UNA sola capa por columnas + canvas (no un
+    # CircleMarker ni un Feature de GeoJSON por muestra, ver medux_mapa), asi
+    # que el techo real subio bastante: 200,000 puntos arman el mapa en ~1s.
+    # Igual queda ajustable por si tu maquina/navegador prefiere un limite
+    # mas bajo.
     limite_puntos_mapa = st.sidebar.number_input(
         "Limite de puntos a dibujar en el mapa",
         min_value=1000, max_value=200_000, value=30_000, step=5_000,
@@ -1751,22 +1592,38 @@ else:
     )
     puntos_disponibles = len(df_filtrado)
     if puntos_disponibles > limite_puntos_mapa:
-        st.checkbox("Mostrar muestras individuales sobre el mapa", value=False, disabled=True)
+        # Por encima del limite las muestras se pueden ver agregadas en celdas
+        # hexagonales (conteo y desglose por operador en cada una, ver
+        # medux_mapa.agregar_celdas) o, hasta LIMITE_PUNTOS_WEBGL, una por una en
+        # modo WebGL (buffer binario, sin tooltip por muestra; ver
+        # medux_mapa.agregar_puntos_webgl).
+        modos_puntos = {
+            "No mostrar": None,
+            "Agregadas en celdas (conteo por operador)": "celdas",
+        }
+        if puntos_disponibles <= LIMITE_PUNTOS_WEBGL:
+            modos_puntos["Individuales (modo WebGL, sin tooltip)"] = "webgl"
+        modo_puntos = modos_puntos[st.radio("Muestras sobre el mapa", list(modos_puntos), horizontal=True)]
+        mostrar_puntos = modo_puntos is not None
         st.caption(
-            f"⚠️ Hay {puntos_disponibles:,} muestras en el rango/filtro actual — "
-            f"por encima de {limite_puntos_mapa:,} (configurable en el sidebar) no "
-            f"se dibujan puntos individuales. Angosta el rango de fechas o el "
-            f"filtro de distrito/canton/provincia, o sube el limite."
+            f"⚡ Hay {puntos_disponibles:,} muestras en el rango/filtro actual — por "
+            f"encima de {limite_puntos_mapa:,} (configurable en el sidebar) se muestran "
+            f"agregadas en celdas hexagonales (mas finas al hacer zoom)"
+            + (
+                " o con WebGL: solo el color por operador, sin tooltip por muestra."
+                if puntos_disponibles <= LIMITE_PUNTOS_WEBGL
+                else f"; por encima de {LIMITE_PUNTOS_WEBGL:,} no se dibujan puntos individuales."
+            )
         )
-        mostrar_puntos = False
     else:
+        modo_puntos = "individual"
         mostrar_puntos = st.checkbox("Mostrar muestras individuales sobre el mapa", value=False)
 
     conteo_por_distrito = {
         clave: cantidad
         for clave, cantidad in (
             df_filtrado.dropna(subset=["distrito"])
-            .groupby(["distrito", "canton", "provincia"])
+            .groupby(["distrito", "canton", "provincia"], observed=True)
             .size()
             .items()
         )
@@ -1777,7 +1634,7 @@ else:
     # mapa (df_filtrado, el mismo que ya se uso arriba para el choropleth de
     # distritos). Independiente de resolver_ubicacion_sondas/tabla agregada.
     if mostrar_radiobases and manchas_kmz and not radiobases_df.empty:
-        manchas_activas = manchas_con_muestras(df_filtrado, manchas_kmz)
+        manchas_activas = manchas_con_muestras(df_filtrado)
         radiobases_a_dibujar = radiobases_df[radiobases_df["poligono"].isin(manchas_activas)]
         st.caption(
             f"📡 Radiobases: mostrando {len(radiobases_a_dibujar)} de {len(radiobases_df)} "
@@ -1787,20 +1644,32 @@ else:
     else:
         radiobases_a_dibujar = radiobases_df.iloc[0:0]
 
+    # Para el tooltip del mapa, cada mancha se SUBDIVIDE segun los distritos con
+    # los que se solapa (interseccion geometrica real, no un unico punto
+    # representativo) -- ver docstring de dividir_manchas_por_distrito. Esa
+    # version subdividida (objeto "piezas" de topojson_manchas) es SOLO para
+    # dibujar/tooltip; manchas_kmz (sin dividir) se sigue usando para todo lo
+    # demas (conteo en el sidebar, columna 'mancha' de cada muestra via
+    # asignar_manchas).
+    manchas_mapa = topojson_manchas(
+        KMZ_MANCHAS_PATH, tolerancia_m=st.session_state["racsa_simplif_manchas_m"],
+        version_dist=version_distritos(),
+    ) if mostrar_manchas else None
     mapa = construir_mapa(
         distritos, conteo_por_distrito, df_puntos=df_filtrado, mostrar_puntos=mostrar_puntos,
+        modo_puntos=modo_puntos,
+        geometria=geometria_distritos(version_distritos(), st.session_state["poly_simplificacion_m"]),
         bounds=bounds_seleccion, distritos_resaltados=nombres_resaltados, paleta=paleta_mapa,
-        manchas=manchas_kmz, mostrar_manchas=mostrar_manchas,
-        manchas_tooltip=manchas_kmz_tooltip,
+        manchas=manchas_mapa, mostrar_manchas=mostrar_manchas,
         radiobases=radiobases_a_dibujar, mostrar_radiobases=mostrar_radiobases,
     )
     # components.html (en vez de st_folium) evita el puente bidireccional JS<->Python
     # que streamlit-folium reconstruye en cada rerun; aqui es solo un iframe estatico.
-    # OJO: usar get_root().render() (pagina completa) y NO _repr_html_(), que envuelve
+    # OJO: usar renderizar_mapa (get_root().render(), pagina completa) y NO _repr_html_(), que envuelve
     # el mapa en un div con "padding-bottom" de aspect-ratio fijo + un iframe anidado
     # -- esa combinacion no calzaba con el height=620 fijo y el mapa se veia
     # recortado/corrido hacia arriba, sin quedar centrado en Costa Rica.
-    components.html(mapa.get_root().render(), height=620, scrolling=False)
+    components.html(renderizar_mapa(mapa), height=620, scrolling=False)
 
     # =======================================================
     # TABLA DE CONTEO POR DISTRITO x PROGRAM x ISP -- se arma del MISMO df
@@ -23,12 +23,20 @@ Requisitos adicionales sobre el dashboard original (agregar a requirements.txt):
     jinja2>=3.1.2   # requerido por pandas Styler (resaltado verde/rojo de la tabla)
 
 Notas de rendimiento (ver seccion "OPTIMIZACION"):
-    - Los poligonos se simplifican y se cachean 24h (no se recalculan en cada rerun).
+    - Los poligonos se guardan en disco (medux_geo) y cada nivel de
+      simplificacion se calcula una sola vez, sobre los arcos compartidos de la
+      topologia: volver a un nivel del slider de detalle no recalcula nada.
     - El spatial join (punto-en-poligono) solo corre una vez por consulta nueva a la
       API, no en cada rerun/click.
     - El mapa se dibuja como UNA sola capa GeoJson (494 features en un solo layer)
       en vez de 494 capas individuales, y se renderiza con components.html en vez
       de streamlit-folium (evita el puente bidireccional que agrega latencia).
+    - La descarga paginada (medux_api) corre un cursor PIT por program en
+      paralelo, todos bajo un unico limite compartido de ~1 req/s.
+    - Lo descargado queda en un store Parquet en disco (medux_store): un rango
+      ya bajado (aunque sea parte de otro, o de antes de un redeploy) se lee
+      de disco y a la API solo se le piden los huecos y la ultima hora (de
+      la que, si se acaba de consultar, solo se pide el borde nuevo).
 
 Orden del sidebar (de arriba a abajo):
     1) Filtro Fecha
@@ -41,27 +49,21 @@ Orden del sidebar (de arriba a abajo):
 import time
 from datetime import datetime, timedelta
 
-import numpy as np
 import pandas as pd
 import pytz
-import requests
 import streamlit as st
 import streamlit.components.v1 as components
 import folium
 import branca.colormap as cm
-from shapely.geometry import shape, mapping
-from shapely import points as shapely_points
-from shapely.strtree import STRtree
-from shapely.ops import transform as shapely_transform
-from pyproj import Transformer
-
-# ===========================================================
-# CONFIGURACION WFS (poligonos de distritos)
-# ===========================================================
-WFS_URL = "https://geos.snitcr.go.cr/be/IGN_5_CO/wfs"
-WFS_LAYER = "IGN_5_CO:limitedistrital_5k"
-WFS_SRS_NATIVE = "EPSG:8908"   # CR-SIRGAS / CRTM05 (metros)
-WFS_SRS_OUTPUT = "EPSG:4326"   # WGS84 lat/lon (lo que trae la API MedUX)
+from medux_api import compactar_tipos
+from medux_geo import (
+    actualizar_distritos, asignar_distritos, distritos_version, indice_distritos, version_distritos,
+)
+from medux_mapa import (
+    LIMITE_PUNTOS_WEBGL, agregar_celdas, agregar_distritos, agregar_puntos, agregar_puntos_webgl,
+    geometria_distritos, renderizar_mapa,
+)
+from medux_store import obtener_resultados
 
 # ===========================================================
 # ISP (ajustar segun los codigos reales que devuelva tu perfil,
@@ -106,34 +108,11 @@ except Exception as e:
 # FUNCIONES (definidas todas aqui arriba para que el orden del sidebar,
 # mas abajo, se pueda reacomodar libremente sin preocuparse por dependencias)
 # ===========================================================
-def flatten_results(raw_json):
-    """Aplana la respuesta anidada de /api/results en un DataFrame."""
-    filas = []
-
-    def extraer_filas(obj, program=None):
-        if isinstance(obj, dict):
-            if "results" in obj:
-                extraer_filas(obj["results"], program)
-            else:
-                tiene_lista = False
-                for k, v in obj.items():
-                    if isinstance(v, list):
-                        tiene_lista = True
-                        extraer_filas(v, k)
-                if not tiene_lista:
-                    fila = obj.copy()
-                    if program:
-                        fila["program"] = fila.get("program", program)
-                    filas.append(fila)
-        elif isinstance(obj, list):
-            for item in obj:
-                extraer_filas(item, program)
-
-    extraer_filas(raw_json)
-    if not filas:
-        return pd.DataFrame()
-
-    df = pd.DataFrame(filas)
+def normalizar_resultados(df):
+    """Completa program/test y convierte las fechas a la zona local sobre
+    el DataFrame plano (una fila por muestra) que arma medux_store."""
+    if df.empty:
+        return df
     if "program" not in df.columns:
         df["program"] = "network"
     if "test" not in df.columns:
@@ -145,232 +124,25 @@ def flatten_results(raw_json):
     return df
 
 
-def _descargar_paginado(url, headers, body, debug=False, limite_filas=0):
-    """Loop de paginacion PIT/search_after (doc oficial: paginate:true en la
-    primera peticion; la respuesta trae next_pagination_data.pit/search_after;
-    esos dos valores se reenvian tal cual, junto con paginate:true, hasta que
-    ya no venga pit o la pagina llegue vacia).
-
-    limite_filas: si es > 0, corta la descarga apenas se alcanza ese total
-    (evita quedarse minutos trayendo cientos de miles de filas crudas para
-    rangos de fecha muy amplios). 0 = sin limite.
-    """
-    todos_los_resultados = {}
-    pagina = 1
-    total_acumulado = 0
-    total_reportado_api = None
-    payload = body.copy()
-    payload["paginate"] = True
-    payload.setdefault("size", 10000)
-    pit = None
-    search_after = None
-
-    diag = st.empty() if debug else None
-    barra = st.progress(0, text="Descargando...") if debug else None
-    inicio_descarga = time.time()
-    ultima_peticion_ts = 0.0
-
-    while True:
-        if pit:
-            payload["pit"] = pit
-        if search_after:
-            payload["search_after"] = search_after
-
-        # La API limita a ~1 req/s. Se mide desde el INICIO de la peticion
-        # anterior (no desde que termino): si una pagina de 10,000 filas ya
-        # tardo >=1s en responder -- lo normal -- no hace falta esperar nada
-        # antes de pedir la siguiente. Un sleep fijo de 1.05s DESPUES de cada
-        # respuesta (como antes) suma tiempo muerto innecesario encima del
-        # que ya tardo la propia peticion.
-        espera = 1.02 - (time.time() - ultima_peticion_ts)
-        if espera > 0:
-            time.sleep(espera)
-
-        t0 = time.time()
-        ultima_peticion_ts = t0
-        r = requests.post(url, headers=headers, json=payload, timeout=60)
-        duracion_peticion = time.time() - t0
-        if r.status_code != 200:
-            st.error(f"Error API en pagina {pagina}: {r.status_code} — {r.text[:500]}")
-            break
-
-        data = r.json()
-        total_reportado_api = data.get("total", total_reportado_api)
-        results = data.get("results", {})
-        pagina_vacia = True
-        filas_en_pagina = 0
-        if isinstance(results, list):
-            filas_en_pagina = len(results)
-            if results:
-                pagina_vacia = False
-            todos_los_resultados.setdefault("network", []).extend(results)
-        elif isinstance(results, dict):
-            for prog, res in results.items():
-                if isinstance(res, list):
-                    filas_en_pagina += len(res)
-                    if res:
-                        pagina_vacia = False
-                    todos_los_resultados.setdefault(prog, []).extend(res)
-        total_acumulado += filas_en_pagina
-
-        # El cursor de paginacion viene ANIDADO en "next_pagination_data".
-        cursor = data.get("next_pagination_data") or {}
-        pit = cursor.get("pit")
-        search_after = cursor.get("search_after")
-
-        if diag is not None:
-            transcurrido = time.time() - inicio_descarga
-            velocidad = total_acumulado / transcurrido if transcurrido > 0 else 0
-            diag.caption(
-                f"📥 Pagina {pagina}: {filas_en_pagina} filas en {duracion_peticion:.1f}s "
-                f"(acumulado {total_acumulado:,} / total API reportado: {total_reportado_api}). "
-                f"¿vino cursor pit? {'si' if pit else 'NO'} — "
-                f"{transcurrido:.0f}s transcurridos, ~{velocidad:,.0f} filas/seg"
-            )
-        if barra is not None and total_reportado_api:
-            objetivo = min(total_reportado_api, limite_filas) if limite_filas else total_reportado_api
-            frac = min(1.0, total_acumulado / objetivo) if objetivo else 1.0
-            barra.progress(frac, text=f"{total_acumulado:,} / {objetivo:,} filas")
-
-        if limite_filas and total_acumulado >= limite_filas:
-            st.warning(
-                f"⏹️ Se alcanzo el limite de {limite_filas:,} filas configurado en el sidebar "
-                f"(la API reporta {total_reportado_api:,} filas en total para este rango). "
-                f"Angosta el rango de fechas o sube el limite para traer todo."
-            )
-            break
-        if pagina_vacia or not pit:
-            break
-        pagina += 1
-        if pagina > 100:
-            st.warning("Limite maximo de 100 paginas alcanzado.")
-            break
-
-    return todos_los_resultados
-
-
-@st.cache_data(ttl=1800)
 def obtener_datos_pag(url, headers, body, debug=False, limite_filas=0):
-    """Descarga paginada completa (cacheada 30 min: mismo rango/filtros =
-    no vuelve a golpear la API hasta que cambies algo o pase el TTL)."""
-    return _descargar_paginado(url, headers, body, debug=debug, limite_filas=limite_filas)
-
-
-# 1 grado ~ 111,320 m cerca del ecuador (Costa Rica ~9-11N, el error de esta
-# aproximacion es minimo). "tolerancia_m" se pasa como parametro para que el
-# cache se invalide solo cuando cambia el nivel de detalle, no en cada rerun.
-METROS_POR_GRADO = 111_320
-
-
-@st.cache_data(ttl=60 * 60 * 24, show_spinner="Cargando poligonos de distritos (WFS)...")
-def cargar_distritos_wfs(tolerancia_m=10):
-    tolerancia_deg = (tolerancia_m / METROS_POR_GRADO) if tolerancia_m > 0 else 0
-    params = {
-        "service": "WFS",
-        "version": "2.0.0",
-        "request": "GetFeature",
-        "typeName": WFS_LAYER,
-        "outputFormat": "application/json",
-        "srsName": WFS_SRS_OUTPUT,  # se pide directamente en WGS84
-    }
-    r = requests.get(WFS_URL, params=params, timeout=90)
-    r.raise_for_status()
-    geojson = r.json()
-
-    transformer = Transformer.from_crs(WFS_SRS_NATIVE, WFS_SRS_OUTPUT, always_xy=True)
-
-    distritos = []
-    for feat in geojson.get("features", []):
-        props = feat.get("properties", {}) or {}
-        geom = shape(feat["geometry"])
-
-        # Salvaguarda: si el servidor NO reproyecto (coords fuera de rango lat/lon),
-        # se reproyecta en el cliente desde el CRS nativo (EPSG:8908).
-        minx, miny, maxx, maxy = geom.bounds
-        if abs(minx) > 180 or abs(maxx) > 180 or abs(miny) > 90 or abs(maxy) > 90:
-            geom = shapely_transform(transformer.transform, geom)
-
-        # Version simplificada SOLO para dibujar (menos vertices = mapa mucho
-        # mas liviano). Se precalcula aqui, una sola vez, y queda cacheada.
-        # tolerancia_deg == 0 -> se usa la geometria completa (sin deformar).
-        geom_simplificado = (
-            geom.simplify(tolerancia_deg, preserve_topology=True)
-            if tolerancia_deg > 0 else geom
-        )
-
-        distritos.append({
-            "distrito": props.get("DISTRITO") or "N/D",
-            "canton": props.get("CANTÓN") or "N/D",
-            "provincia": props.get("PROVINCIA") or "N/D",
-            "codigo_dta": props.get("CÓDIGO_DTA"),
-            "geometry": geom,                      # precision completa (spatial join, bounds)
-            "geo": mapping(geom_simplificado),      # liviano (solo para el mapa)
-        })
-    return distritos
-
-
-def asignar_distritos(df, distritos, col_lat="latitude", col_lon="longitude"):
-    """Spatial join: asigna cada muestra a su distrito.
-
-    OPTIMIZACION: la version anterior usaba df.apply(axis=1) llamando una
-    funcion Python fila por fila -- con miles de muestras esto es lento por
-    el overhead propio de pandas (crear una Series por fila) sumado al de
-    cada llamada individual a Point()/tree.query()/.contains(). shapely>=2.0
-    permite construir TODOS los puntos de una sola vez (shapely.points, en
-    C) y consultar el STRtree con un array completo en una sola llamada
-    (tree.query(array, predicate=...)), sin loop en Python por fila. Con
-    ~30,000 muestras esto pasa de tomar varios segundos a milisegundos.
-    """
-    df = df.copy()
-    df["distrito"] = None
-    df["canton"] = None
-    df["provincia"] = None
-    df["codigo_dta"] = None
-
-    if df.empty or not distritos:
-        return df
-    if col_lat not in df.columns or col_lon not in df.columns:
-        return df
+    """Descarga paginada completa a traves del store (medux_store), que
+    entiende el rango y los programs: un rango mas angosto o solapado con
+    uno ya bajado, o un program menos, sale de disco/memoria y a la API
+    solo se le piden los huecos y el borde nuevo de la ultima hora (cada
+    tramo con un cursor PIT por program en paralelo, bajo ~1 req/s).
+    Sin @st.cache_data: cacheaba por el body literal, asi que mover el fin
+    un minuto o sacar un program volvia a bajar todo."""
+    df, _ = obtener_resultados(url, headers, body, zona=zona_local, debug=debug, limite_filas=limite_filas)
+    return df
 
-    lat_arr = pd.to_numeric(df[col_lat], errors="coerce").to_numpy()
-    lon_arr = pd.to_numeric(df[col_lon], errors="coerce").to_numpy()
-    validos = ~pd.isna(lat_arr) & ~pd.isna(lon_arr) & ~((lat_arr == 0) & (lon_arr == 0))
-    if not validos.any():
-        return df
 
-    geoms = [d["geometry"] for d in distritos]
-    tree = STRtree(geoms)
-
-    idx_validos = np.where(validos)[0]
-    puntos = shapely_points(lon_arr[idx_validos], lat_arr[idx_validos])
-
-    # tree.query con un array de geometrias hace la consulta COMPLETA en
-    # codigo compilado (GEOS): devuelve pares (indice-en-puntos, indice-en-
-    # distritos) para todo el batch de una sola vez.
-    pares = tree.query(puntos, predicate="intersects")
-    asignado = {}
-    for i_pt, i_geom in zip(pares[0], pares[1]):
-        idx_original = idx_validos[i_pt]
-        if idx_original not in asignado:  # se queda con el primer match
-            asignado[idx_original] = i_geom
-
-    n = len(df)
-    distrito_arr = [None] * n
-    canton_arr = [None] * n
-    provincia_arr = [None] * n
-    codigo_arr = [None] * n
-    for idx_original, i_geom in asignado.items():
-        d = distritos[i_geom]
-        distrito_arr[idx_original] = d["distrito"]
-        canton_arr[idx_original] = d["canton"]
-        provincia_arr[idx_original] = d["provincia"]
-        codigo_arr[idx_original] = d["codigo_dta"]
-
-    df["distrito"] = distrito_arr
-    df["canton"] = canton_arr
-    df["provincia"] = provincia_arr
-    df["codigo_dta"] = codigo_arr
-    return df
+def cargar_distritos_wfs(version=None):
+    """Distritos del IGN (copia local versionada, ver medux_geo; el WFS solo
+    se consulta si todavia no hay ninguna) con 'geometry' a precision
+    completa para el spatial join. Lo que se dibuja sale aparte, ya
+    simplificado y serializado (medux_mapa.geometria_distritos). Sin
+    @st.cache_data: es la lista de distritos_version(version), no modificar."""
+    return distritos_version(version)
 
 
 def preparar_test_con_target(df):
@@ -454,7 +226,7 @@ def tabla_conteo_distrito(df, col_tech=None):
     if df_valid.empty:
         return pd.DataFrame()
 
-    df_valid["isp"] = df_valid["isp"].replace(ISP_NAME_MAP)
+    df_valid["isp"] = df_valid["isp"].map(lambda v: ISP_NAME_MAP.get(v, v))
     if "codigo_dta" in df_valid.columns:
         df_valid["codigo_dta"] = df_valid["codigo_dta"].astype("Int64")
 
@@ -462,11 +234,11 @@ def tabla_conteo_distrito(df, col_tech=None):
         else ["distrito", "canton", "provincia"]
     usar_tech = bool(col_tech and col_tech in df_valid.columns)
     if usar_tech:
-        df_valid[col_tech] = df_valid[col_tech].fillna("N/D").astype(str)
+        df_valid[col_tech] = df_valid[col_tech].astype(object).fillna("N/D").astype(str)
         index_cols = index_cols + [col_tech]
 
     conteo = (
-        df_valid.groupby(index_cols + ["isp", "test"])
+        df_valid.groupby(index_cols + ["isp", "test"], observed=True)
         .size()
         .reset_index(name="Pruebas")
     )
@@ -503,10 +275,10 @@ def tabla_conteo_distrito(df, col_tech=None):
     return pivot
 
 
-def construir_mapa(distritos, conteo_por_distrito, df_puntos=None, mostrar_puntos=False,
+def construir_mapa(distritos, conteo_por_distrito, geometria, df_puntos=None, mostrar_puntos=False,
                     bounds=None, distritos_resaltados=None, paleta=None,
                     usar_escalones=False, n_escalones=6, metodo_escalon="quantiles",
-                    redondear_escalones="int"):
+                    redondear_escalones="int", modo_puntos="individual"):
     # prefer_canvas=True: los puntos se dibujan en un solo <canvas> en vez de
     # un nodo SVG por marcador -- clave para poder mostrar miles de muestras
     # sin que el navegador se ponga lento al hacer pan/zoom.
@@ -533,96 +305,29 @@ def construir_mapa(distritos, conteo_por_distrito, df_puntos=None, mostrar_punto
         colormap = paleta.scale(0, max_count if max_count > 0 else 1)
     colormap.caption = "Pruebas por distrito"
 
-    # Una sola capa GeoJson con los 494 distritos (mucho mas rapido que 494
-    # capas individuales). El color/resaltado se resuelve via style_function
-    # leyendo las properties de cada feature.
+    # Una sola capa con los 494 distritos (mucho mas rapido que 494 capas
+    # individuales). La geometria llega ya serializada ('geometria', ver
+    # medux_mapa.geometria_distritos: una vez por version y nivel de
+    # simplificacion); en cada rerun solo se arman conteo/color/resaltado por
+    # distrito.
     # OJO: la clave de conteo_por_distrito debe ser (distrito, canton, provincia).
     # Costa Rica repite nombres de distrito en varios cantones (San Rafael,
     # San Isidro, Concepcion, Mercedes, San Miguel, etc.) -- usar solo el
     # nombre pintaba de mas los distritos "tocayos" sin muestras reales.
-    features = []
-    for d in distritos:
-        clave = (d["distrito"], d["canton"], d["provincia"])
-        count = conteo_por_distrito.get(clave, 0)
-        resaltado = clave in distritos_resaltados
-        features.append({
-            "type": "Feature",
-            "geometry": d["geo"],
-            "properties": {
-                "codigo_dta": d.get("codigo_dta"),
-                "distrito": d["distrito"],
-                "canton": d["canton"],
-                "provincia": d["provincia"],
-                "count": count,
-                "resaltado": resaltado,
-            },
-        })
-    feature_collection = {"type": "FeatureCollection", "features": features}
-
-    def estilo(feat):
-        p = feat["properties"]
-        count = p["count"]
-        color = colormap(count) if count > 0 else "#eeeeee"
-        return {
-            "fillColor": color,
-            "color": "#2b6cb0" if p["resaltado"] else "#555555",
-            "weight": 3 if p["resaltado"] else 0.4,
-            "fillOpacity": 0.65 if count > 0 else 0.12,
-        }
-
-    folium.GeoJson(
-        data=feature_collection,
-        style_function=estilo,
-        tooltip=folium.GeoJsonTooltip(
-            fields=["codigo_dta", "distrito", "canton", "provincia", "count"],
-            aliases=["Codigo DTA", "Distrito", "Canton", "Provincia", "Pruebas"],
-        ),
-    ).add_to(m)
+    agregar_distritos(m, distritos, conteo_por_distrito, distritos_resaltados, colormap, geometria=geometria)
 
     if max_count > 0:
         colormap.add_to(m)
 
     if mostrar_puntos and df_puntos is not None and not df_puntos.empty:
-        # Una sola capa GeoJson para TODOS los puntos (igual optimizacion que
-        # los distritos): con miles de CircleMarker individuales, cada uno
-        # generaba su propio objeto JS -- el HTML resultante se volvia enorme
-        # y lento de construir. Con una FeatureCollection + un solo marker
-        # "molde" reutilizado por Leaflet, el mismo volumen de puntos se
-        # arma muchisimo mas rapido y pesa una fraccion del HTML.
-        punto_features = []
-        for _, row in df_puntos.iterrows():
-            lat, lon = row.get("latitude"), row.get("longitude")
-            if pd.isna(lat) or pd.isna(lon):
-                continue
-            isp_label = ISP_NAME_MAP.get(row.get("isp"), row.get("isp"))
-            punto_features.append({
-                "type": "Feature",
-                "geometry": {"type": "Point", "coordinates": [float(lon), float(lat)]},
-                "properties": {
-                    "isp": isp_label,
-                    "test": row.get("test"),
-                    "distrito": row.get("distrito"),
-                    "color": ISP_COLOR_MAP.get(isp_label, "#333333"),
-                },
-            })
-
-        if punto_features:
-            def estilo_punto(feat):
-                color = feat["properties"]["color"]
-                return {"radius": 3, "fillColor": color, "color": color, "weight": 1, "fillOpacity": 0.8}
-
-            folium.GeoJson(
-                data={"type": "FeatureCollection", "features": punto_features},
-                marker=folium.CircleMarker(radius=3, fill=True),
-                style_function=estilo_punto,
-                tooltip=folium.GeoJsonTooltip(
-                    fields=["isp", "test", "distrito"],
-                    aliases=["ISP", "Program", "Distrito"],
-                ),
-            ).add_to(m)
-
-            isps_presentes = sorted({f["properties"]["isp"] for f in punto_features if f["properties"]["isp"]})
-            _agregar_leyenda_isp(m, isps_presentes)
+        # Una sola capa para TODOS los puntos, armada por columnas con NumPy
+        # (sin un dict de GeoJSON por muestra ni style_function por feature):
+        # ver medux_mapa.agregar_puntos (o, por encima del limite de puntos,
+        # agregar_puntos_webgl, buffer binario para WebGL, o agregar_celdas,
+        # muestras agregadas en celdas hexagonales).
+        agregar = {"webgl": agregar_puntos_webgl, "celdas": agregar_celdas}.get(modo_puntos, agregar_puntos)
+        isps_presentes = agregar(m, df_puntos, ISP_NAME_MAP, ISP_COLOR_MAP)
+        _agregar_leyenda_isp(m, isps_presentes)
 
     if bounds:
         m.fit_bounds(bounds)
@@ -743,7 +448,7 @@ st.sidebar.write(f"Fin: {fin_local_str}")
 # refleja el ultimo valor elegido por el usuario.
 if "poly_simplificacion_m" not in st.session_state:
     st.session_state["poly_simplificacion_m"] = 10
-distritos = cargar_distritos_wfs(st.session_state["poly_simplificacion_m"])
+distritos = cargar_distritos_wfs(version_distritos())
 
 st.sidebar.markdown("---")
 st.sidebar.header("Filtrar por distrito")
@@ -917,6 +622,21 @@ simplificacion_m = st.sidebar.slider(
     help="0 = geometria original del IGN (mas fiel, mapa mas pesado). "
          "Valores altos deforman distritos pequenos/urbanos.",
 )
+if st.sidebar.button(
+    "Actualizar poligonos (WFS)",
+    help="Vuelve a bajar los distritos del WFS del IGN. Normalmente no hace "
+         "falta: se usa la copia guardada en disco.",
+):
+    try:
+        with st.spinner("Descargando distritos del WFS del IGN..."):
+            actualizar_distritos()
+    except Exception as e:
+        st.sidebar.error(f"No se pudo bajar del WFS, se sigue usando la copia local: {e}")
+    else:
+        distritos_version.clear()
+        st.rerun()
+if version_distritos():
+    st.sidebar.caption(f"Poligonos de distritos: version {version_distritos()}")
 
 PALETAS_MAPA = {
     "Amarillo-Naranja-Rojo": "YlOrRd_09",
@@ -958,17 +678,17 @@ now = time.time()
 should_fetch = st.sidebar.button("Consultar API")
 
 if should_fetch:
-    raw = obtener_datos_pag(API_URL, headers, body, debug=debug_paginacion, limite_filas=limite_filas)
-    if not raw:
-        st.warning("No se recibieron datos de la API.")
-        st.stop()
-    df_nuevo = flatten_results(raw)
+    df_nuevo = obtener_datos_pag(API_URL, headers, body, debug=debug_paginacion, limite_filas=limite_filas)
     if df_nuevo.empty:
-        st.warning("No se recibieron datos.")
+        st.warning("No se recibieron datos de la API.")
         st.stop()
+    df_nuevo = normalizar_resultados(df_nuevo)
     # El spatial join corre UNA sola vez por consulta nueva (no en cada rerun:
     # cambiar el filtro de distrito o el checkbox de puntos ya no lo recalcula).
-    df_nuevo = asignar_distritos(df_nuevo, distritos)
+    df_nuevo = asignar_distritos(df_nuevo, distritos, indice=indice_distritos(version_distritos()))
+    # Tipos compactos (category/float32) DESPUES del spatial join, para que
+    # distrito/canton/provincia tambien queden como category en session_state.
+    df_nuevo = compactar_tipos(df_nuevo)
     st.session_state.poly_df = df_nuevo
     st.session_state.poly_last_fetch_ts = now
     # El filtro de "Tecnologia y Operador" (sidebar) se dibuja MAS ARRIBA en
@@ -1039,10 +759,11 @@ elif provincia_sel != "Todos":
 # ===========================================================
 st.markdown("#### 🗺️ Mapa por Distrito")
 
-# Los puntos se dibujan como UNA sola capa GeoJson + canvas (no un CircleMarker
-# por muestra), asi que el techo real subio bastante: 50,000 puntos arman el
-# mapa en menos de 1s. Igual queda ajustable por si tu maquina/navegador
-# prefiere un limite mas bajo.
+# Los puntos se dibujan como UNA sola capa por columnas + canvas (no un
+# CircleMarker ni un Feature de GeoJSON por muestra, ver medux_mapa), asi
+# que el techo real subio bastante: 200,000 puntos arman el mapa en ~1s.
+# Igual queda ajustable por si tu maquina/navegador prefiere un limite
+# mas bajo.
 limite_puntos_mapa = st.sidebar.number_input(
     "Limite de puntos a dibujar en el mapa",
     min_value=1000, max_value=200_000, value=30_000, step=5_000,
@@ -1052,37 +773,55 @@ limite_puntos_mapa = st.sidebar.number_input(
 )
 puntos_disponibles = len(df_filtrado)
 if puntos_disponibles > limite_puntos_mapa:
-    st.checkbox("Mostrar muestras individuales sobre el mapa", value=False, disabled=True)
+    # Por encima del limite las muestras se pueden ver agregadas en celdas
+    # hexagonales (conteo y desglose por operador en cada una, ver
+    # medux_mapa.agregar_celdas) o, hasta LIMITE_PUNTOS_WEBGL, una por una en
+    # modo WebGL (buffer binario, sin tooltip por muestra; ver
+    # medux_mapa.agregar_puntos_webgl).
+    modos_puntos = {
+        "No mostrar": None,
+        "Agregadas en celdas (conteo por operador)": "celdas",
+    }
+    if puntos_disponibles <= LIMITE_PUNTOS_WEBGL:
+        modos_puntos["Individuales (modo WebGL, sin tooltip)"] = "webgl"
+    modo_puntos = modos_puntos[st.radio("Muestras sobre el mapa", list(modos_puntos), horizontal=True)]
+    mostrar_puntos = modo_puntos is not None
     st.caption(
-        f"⚠️ Hay {puntos_disponibles:,} muestras en el rango/filtro actual — "
-        f"por encima de {limite_puntos_mapa:,} (configurable en el sidebar) no "
-        f"se dibujan puntos individuales. Angosta el rango de fechas o el "
-        f"filtro de distrito/canton/provincia, o sube el limite."
+        f"⚡ Hay {puntos_disponibles:,} muestras en el rango/filtro actual — por "
+        f"encima de {limite_puntos_mapa:,} (configurable en el sidebar) se muestran "
+        f"agregadas en celdas hexagonales (mas finas al hacer zoom)"
+        + (
+            " o con WebGL: solo el color por operador, sin tooltip por muestra."
+            if puntos_disponibles <= LIMITE_PUNTOS_WEBGL
+            else f"; por encima de {LIMITE_PUNTOS_WEBGL:,} no se dibujan puntos individuales."
+        )
     )
-    mostrar_puntos = False
 else:
+    modo_puntos = "individual"
     mostrar_puntos = st.checkbox("Mostrar muestras individuales sobre el mapa", value=False)
 
 conteo_por_distrito = {
     clave: cantidad
     for clave, cantidad in (
         df_filtrado.dropna(subset=["distrito"])
-        .groupby(["distrito", "canton", "provincia"])
+        .groupby(["distrito", "canton", "provincia"], observed=True)
         .size()
         .items()
     )
 }
 mapa = construir_mapa(
     distritos, conteo_por_distrito, df_puntos=df_filtrado, mostrar_puntos=mostrar_puntos,
+    modo_puntos=modo_puntos,
+    geometria=geometria_distritos(version_distritos(), st.session_state["poly_simplificacion_m"]),
     bounds=bounds_seleccion, distritos_resaltados=nombres_resaltados, paleta=paleta_mapa,
 )
 # components.html (en vez de st_folium) evita el puente bidireccional JS<->Python
 # que streamlit-folium reconstruye en cada rerun; aqui es solo un iframe estatico.
-# OJO: usar get_root().render() (pagina completa) y NO _repr_html_(), que envuelve
+# OJO: usar renderizar_mapa (get_root().render(), pagina completa) y NO _repr_html_(), que envuelve
 # el mapa en un div con "padding-bottom" de aspect-ratio fijo + un iframe anidado
 # -- esa combinacion no calzaba con el height=620 fijo y el mapa se veia
 # recortado/corrido hacia arriba, sin quedar centrado en Costa Rica.
-components.html(mapa.get_root().render(), height=620, scrolling=False)
+components.html(renderizar_mapa(mapa), height=620, scrolling=False)
 
 # ===========================================================
 # TABLA DE CONTEO POR DISTRITO x PROGRAM x ISP
@@ -1,10 +1,11 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-import requests
 from datetime import datetime, timedelta, time
 import pytz
 from streamlit_autorefresh import st_autorefresh
+from medux_api import CAMPOS_KPI, compactar_tipos, decodificar_json, pagina_a_bloque, post_api
+from medux_store import obtener_resultados
 import time
 
 #-------------------------------------
@@ -222,67 +223,21 @@ body = {
 # ===========================================================
 # 🔹 FUNCIONES DE CONSULTA Y NORMALIZACIÓN API
 # ===========================================================
-@st.cache_data(ttl=1800)
 def obtener_datos_pag(url, headers, body):
-    todos_los_resultados = {}
-    pagina = 1
-    total = 0
-
-    # Asegurar que se habilite la paginación
-    payload = body.copy()
-    payload["paginate"] = True
-
-    pit = None
-    search_after = None
-
-    while True:
-        if pit:
-            payload["pit"] = pit
-        if search_after:
-            payload["search_after"] = search_after
-
-        st.info(f" Downloading page {pagina}...")
-        r = requests.post(url, headers=headers, json=payload)
-        if r.status_code != 200:
-            st.error(f"❌ Error API: {r.status_code}")
-            break
-
-        data = r.json()
-
-        # Extraer resultados
-        results = data.get("results", {})
-        if isinstance(results, list):
-            todos_los_resultados.setdefault("network", []).extend(results)
-            total += len(results)
-        elif isinstance(results, dict):
-            for prog, res in results.items():
-                if isinstance(res, list):
-                    todos_los_resultados.setdefault(prog, []).extend(res)
-                    total += len(res)
-
-        st.write(f"📄 Página {pagina}: {len(results) if isinstance(results, list) else sum(len(v) for v in results.values())} registros")
-
-        # Actualizar cursores de paginación
-        pit = data.get("pit")
-        search_after = data.get("search_after")
-
-        # Si no hay más cursores, terminamos
-        if not search_after or not pit:
-            st.success(f"✅ Download complete: {total:,} registers in {pagina} pages.")
-            break
-
-        pagina += 1
-        if pagina > 100:  # seguridad
-            st.warning("⚠️ limit max of 100 pages.")
-            break
-
-    return todos_los_resultados
+    """Descarga historica (paginada) via el store en disco (medux_store):
+    lo ya bajado antes se lee de disco y a la API solo se le piden los
+    huecos del rango y la ultima hora. Sin @st.cache_data: cacheaba por el
+    body literal, asi que mover el fin un minuto o sacar un program volvia
+    a bajar todo, y dejaba una segunda copia en memoria por 30 min."""
+    df, resumen = obtener_resultados(url, headers, body)
+    st.success(f"✅ Download complete: {len(df):,} registers ({resumen['filas_store']:,} from local store).")
+    return df
 
 def obtener_datos_pag_no_cache(url, headers, body):
     try:
-        r = requests.post(url, headers=headers, json=body)
+        r = post_api(url, headers, body)
         if r.status_code == 200:
-            return r.json()
+            return decodificar_json(r)
         st.warning(f"⚠️ Error API: {r.status_code}")
         return None
     except Exception as e:
@@ -290,35 +245,15 @@ def obtener_datos_pag_no_cache(url, headers, body):
         return None
 
 def flatten_results(raw_json):
-    filas = []
-
-    def extraer_filas(obj, program=None):
-        if isinstance(obj, dict):
-            if "results" in obj:
-                extraer_filas(obj["results"], program)
-            else:
-                tiene_lista = False
-                for k, v in obj.items():
-                    if isinstance(v, list):
-                        tiene_lista = True
-                        extraer_filas(v, k)
-                if not tiene_lista:
-                    fila = obj.copy()
-                    if program:
-                        fila["program"] = fila.get("program", program)
-                    filas.append(fila)
-
-        elif isinstance(obj, list):
-            for item in obj:
-                extraer_filas(item, program)
-
-    extraer_filas(raw_json)
-
-    if not filas:
-        return pd.DataFrame()
-
-    df = pd.DataFrame(filas)
+    """Aplana una respuesta de /api/results (results -> program -> filas)
+    con el aplanador por columnas de medux_api."""
+    return normalizar_resultados(pagina_a_bloque(raw_json))
 
+def normalizar_resultados(df):
+    """Columnas comunes y fechas en zona local, sobre el DataFrame plano
+    (una fila por muestra) que arma medux_store o flatten_results."""
+    if df.empty:
+        return df
     if "program" not in df.columns:
         df["program"] = "network"
 
@@ -330,8 +265,9 @@ def flatten_results(raw_json):
         if col in df.columns:
             df[col] = pd.to_datetime(df[col], errors="coerce", utc=True).dt.tz_convert(zona_local)
 
-
-    return df
+    # Tipos compactos una sola vez (category/float32): los graficos y el
+    # resumen de KPIs ya no re-convierten en cada rerun.
+    return compactar_tipos(df)
     
 
 def filtrar_por_backpack(df, opcion, col_probe):
@@ -361,19 +297,22 @@ def resumen_kpis_por_isp(df, kpi_def, isp_map=None):
             if field not in df_test.columns:
                 continue
 
-            df_test[field] = pd.to_numeric(df_test[field], errors="coerce")
-            
-            # Convertir a porcentaje SOLO para call setup success
-            if field == "callSetUpSuccessL3":
-                df_test[field] = df_test[field] * 100
-
+            # Los KPIs de CAMPOS_KPI ya vienen numericos (compactar_tipos):
+            # no se re-convierten ni se copia la columna, se agrega directo.
+            valores = df_test[["isp", field]]
+            if field not in CAMPOS_KPI:
+                valores = valores.assign(**{field: pd.to_numeric(valores[field], errors="coerce")})
             resumen = (
-                df_test
-                .dropna(subset=["isp", field])
-                .groupby("isp")[field]
+                valores
+                .dropna()
+                .groupby("isp", observed=True)[field]
                 .mean()
             )
 
+            # Convertir a porcentaje SOLO para call setup success
+            if field == "callSetUpSuccessL3":
+                resumen = resumen * 100
+
             for isp, value in resumen.items():
                 filas.append({
                     "KPI": label,
@@ -393,6 +332,59 @@ def resumen_kpis_por_isp(df, kpi_def, isp_map=None):
     )
 
 
+# ===========================================================
+# ⚡ MODO DELTA (solo realtime)
+# ===========================================================
+# En realtime NO se vuelve a pedir toda la ventana de REALTIME_HOURS en cada
+# refresco: se piden solo los resultados posteriores al ultimo dateStart que
+# ya esta en st.session_state.df (menos un pequeño solape, para no perder
+# muestras que la sonda sube con algo de retraso), se agregan al df existente
+# y se descartan las filas que ya salieron de la ventana. El boton
+# "Consultar API" siempre hace la descarga completa.
+DELTA_SOLAPE_SEG = 120
+# Una sonda que sube con retraso (resultados en buffer) queda atras de las
+# demas: el delta arranca en el ultimo dateStart de la sonda MAS atrasada,
+# pero nunca mas de DELTA_ATRASO_MAX_SEG antes del mas nuevo (una sonda
+# apagada no debe volver descarga completa cada refresco). Lo que llegue
+# aun mas tarde lo recupera la descarga completa que se fuerza cada
+# DELTA_CICLOS_RESYNC refrescos delta.
+DELTA_ATRASO_MAX_SEG = 30 * 60
+DELTA_CICLOS_RESYNC = 10
+COLUMNAS_CLAVE_DELTA = ["probeId", "program", "test", "dateStart"]
+
+def ts_inicio_delta(df_prev, ts_inicio_ventana):
+    """tsStart (ms) para pedir solo lo nuevo (desde la sonda mas atrasada,
+    ver DELTA_ATRASO_MAX_SEG), o None si no hay un df previo con dateStart
+    valido (en ese caso toca descarga completa)."""
+    if df_prev.empty or "dateStart" not in df_prev.columns:
+        return None
+    fechas = pd.to_datetime(df_prev["dateStart"], errors="coerce", utc=True)
+    ultimo = fechas.max()
+    if pd.isna(ultimo):
+        return None
+    if "probeId" in df_prev.columns:
+        mas_atrasada = fechas.groupby(df_prev["probeId"], observed=True).max().min()
+        if not pd.isna(mas_atrasada):
+            ultimo = max(mas_atrasada, ultimo - pd.Timedelta(seconds=DELTA_ATRASO_MAX_SEG))
+    ts = int(ultimo.timestamp() * 1000) - DELTA_SOLAPE_SEG * 1000
+    return max(ts, ts_inicio_ventana)
+
+def fusionar_delta(df_prev, df_delta, ts_inicio_ventana):
+    """Agrega las filas nuevas al df previo, elimina las repetidas por el
+    solape (misma sonda/program/test/dateStart) y descarta las que quedaron
+    antes del inicio de la ventana."""
+    df = pd.concat([df_prev, df_delta], ignore_index=True) if not df_delta.empty else df_prev
+    if df.empty or "dateStart" not in df.columns:
+        return df
+    fechas = pd.to_datetime(df["dateStart"], errors="coerce", utc=True)
+    df = df[fechas >= pd.Timestamp(ts_inicio_ventana, unit="ms", tz="UTC")]
+    clave = [c for c in COLUMNAS_CLAVE_DELTA if c in df.columns]
+    if clave:
+        df = df.drop_duplicates(subset=clave, keep="last")
+    # El concat de dos df con categorias distintas vuelve a object.
+    return compactar_tipos(df.reset_index(drop=True))
+
+
 # ===========================================================
 # 🚀 CONSULTAR API
 # ===========================================================
@@ -414,18 +406,39 @@ time_trigger = (
 
 should_fetch = manual_trigger or time_trigger
 
-if should_fetch:
-    raw = (
-        obtener_datos_pag_no_cache(url, headers, body)
-        if usar_real_time
-        else obtener_datos_pag(url, headers, body)
-    )
+# Si cambian los programas o la zona horaria, el df previo ya no sirve como
+# base del delta (otras columnas / fechas en otra zona) -> descarga completa.
+clave_delta = (tuple(programas), tz_label)
 
-    if not raw:
-        st.warning("⚠️ No se recibieron datos de la API.")
-        st.stop()
+ts_delta = None
+if should_fetch and usar_real_time and not manual_trigger \
+        and st.session_state.get("delta_clave") == clave_delta \
+        and st.session_state.get("delta_ciclos", 0) < DELTA_CICLOS_RESYNC:
+    ts_delta = ts_inicio_delta(st.session_state.df, ts_start)
 
-    df = flatten_results(raw)
+if should_fetch and ts_delta is not None:
+    raw = obtener_datos_pag_no_cache(url, headers, {**body, "tsStart": ts_delta})
+    df_delta = flatten_results(raw) if raw else pd.DataFrame()
+    df = fusionar_delta(st.session_state.df, df_delta, ts_start)
+    st.session_state.delta_ciclos = st.session_state.get("delta_ciclos", 0) + 1
+
+    st.session_state.df = df
+    st.session_state.last_fetch_ts = now
+
+    st.markdown(
+        f"<span style='font-size:0.9em; color:gray;'> Delta load successfull "
+        f"(+{len(df_delta):,} new, {len(df):,} rows in window)</span>",
+        unsafe_allow_html=True
+    )
+elif should_fetch:
+    if usar_real_time:
+        raw = obtener_datos_pag_no_cache(url, headers, body)
+        if not raw:
+            st.warning("⚠️ No se recibieron datos de la API.")
+            st.stop()
+        df = flatten_results(raw)
+    else:
+        df = normalizar_resultados(obtener_datos_pag(url, headers, body))
 
     if df.empty:
         st.warning("⚠️ No se recibieron datos.")
@@ -433,6 +446,8 @@ if should_fetch:
 
     st.session_state.df = df
     st.session_state.last_fetch_ts = now
+    st.session_state.delta_clave = clave_delta
+    st.session_state.delta_ciclos = 0
 
 
     st.markdown(
@@ -511,7 +526,7 @@ else:
             df_last_present["Último reporte"] = df_last_present["Último reporte"].dt.tz_convert(zona_local).dt.strftime('%Y-%m-%d %H:%M:%S')
 
      
-            df_last_present["ISP"] = df_last_present["ISP"].replace(ISP_NAME_MAP)
+            df_last_present["ISP"] = df_last_present["ISP"].map(lambda v: ISP_NAME_MAP.get(v, v))
 
             # --- Crear dos columnas para mostrar tablas lado a lado ---
             col1, col2 = st.columns(2)
@@ -771,20 +786,20 @@ def grafica_kpi(df, y_field, titulo, freq="5min", agg_func="mean", color_by="isp
     if y_field not in df.columns or "dateStart" not in df.columns or color_by not in df.columns:
         return
 
-    df_plot = df.copy()
+    # Solo las columnas que usa la grafica, no una copia del df entero. La
+    # fecha y los KPIs de CAMPOS_KPI ya vienen tipados (compactar_tipos).
+    df_plot = df[list(dict.fromkeys(["dateStart", y_field, color_by]))].copy()
+    if y_field not in CAMPOS_KPI:
+        df_plot[y_field] = pd.to_numeric(df_plot[y_field], errors="coerce")
     
     # 2. LIMPIEZA DE TIPOS (Evita el TypeError de Plotly)
     # Forzamos que la columna de color sea SIEMPRE string y no tenga nulos
-    df_plot[color_by] = df_plot[color_by].fillna("Unknown").astype(str)
+    df_plot[color_by] = df_plot[color_by].astype(object).fillna("Unknown").astype(str)
     
-    # Fechas
-    df_plot["dateStart"] = pd.to_datetime(df_plot["dateStart"], errors="coerce")
+    # Fechas (hora local sin zona, para el eje)
     if df_plot["dateStart"].dt.tz is not None:
         df_plot["dateStart"] = df_plot["dateStart"].dt.tz_localize(None)
     
-    # KPI numérico
-    df_plot[y_field] = pd.to_numeric(df_plot[y_field], errors="coerce")
-    
     # Quitar filas donde el KPI o la Fecha fallaron
     df_plot = df_plot.dropna(subset=["dateStart", y_field])
 
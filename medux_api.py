@@ -0,0 +1,472 @@
+"""
+Medux API - descarga paginada compartida por los portales de mapa
+=================================================================
+Motor de descarga de /api/results (format=raw, paginado PIT/search_after)
+que usan todos los dashboards (via medux_tramos / medux_store). Antes cada
+script tenia su propia copia de _descargar_paginado, que traia TODOS los
+programs por un unico cursor PIT, una pagina a la vez.
+
+Notas de rendimiento:
+    - La consulta se divide en varios cursores independientes (uno por
+      program, o por grupo de sondas si se pidio un solo program) que corren
+      en paralelo en un pool de hilos. Una pagina lenta en un cursor ya no
+      frena a los demas, y la espera de red se solapa con el armado de
+      resultados en el hilo principal.
+    - La API limita a ~1 req/s: TODOS los cursores (de todas las sesiones
+      del mismo proceso) comparten un unico token bucket (LIMITADOR_API),
+      asi que el paralelismo no sube la tasa de peticiones, solo deja de
+      desperdiciar el turno de un cursor cuando otro esta esperando.
+    - Los hilos NO llaman a streamlit (no tienen contexto de script): le
+      pasan cada pagina al hilo principal por una cola, y es el hilo
+      principal el que acumula, dibuja el diagnostico y corta por limite.
+    - Cada pagina se convierte a DataFrame en el hilo de su cursor apenas
+      llega (pagina_a_bloque) y se concatena todo una sola vez al final.
+      Antes se juntaba el JSON crudo de todas las paginas y recien al final
+      flatten_results lo recorria recursivamente copiando cada dict: el pico
+      de memoria era JSON + copias + DataFrame; ahora es bloques + una
+      pagina en vuelo.
+    - El aplanado no es recursivo: la forma de la respuesta es conocida
+      (results -> program -> lista de filas planas), asi que cada program se
+      arma de una vez con DataFrame.from_records y sus tipos se fijan UNA vez
+      segun un esquema declarado (CAMPOS_COMUNES + ESQUEMAS_PROGRAM). Todos
+      los scripts usan este aplanador (tambien para las respuestas sin
+      paginar); `python medux_api.py` corre un micro-benchmark contra el
+      extraer_filas recursivo que tenia cada script.
+    - Todas las llamadas HTTP de los dashboards (API MedUX y WFS del IGN)
+      pasan por peticion(): una requests.Session por proceso con pool de
+      conexiones keep-alive (un solo handshake TLS por host, no uno por
+      pagina), gzip, timeout SIEMPRE, y reintentos con backoff exponencial
+      + jitter ante 429/5xx/caidas de conexion. Los reintentos a la API
+      tambien pasan por el token bucket, y un 429 frena a todos los
+      cursores (LimitadorTasa.penalizar), no solo al que lo recibio.
+    - El JSON de cada pagina se decodifica con orjson (o msgspec) si esta
+      instalado, directo de los bytes de la respuesta; si no, con el json
+      de la libreria estandar. El diagnostico de paginacion muestra por
+      separado el tiempo de red, el de decodificacion y el de armado.
+    - Los dashboards en vivo (desde su normalizar_resultados) y los mapas
+      (despues del spatial join) pasan el DataFrame final por
+      compactar_tipos(): category para isp/test/program/tecnologia/
+      distrito..., float32 para los KPIs y fechas ya parseadas. El df que
+      queda en st.session_state ocupa varias veces menos, y los graficos y
+      tablas ya no vuelven a convertir con pd.to_numeric/pd.to_datetime en
+      cada rerun.
+"""
+import json
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+# Decodificador JSON opcional (mas rapido que el json estandar que usa
+# r.json() en paginas de 10.000 filas). Se prueba orjson, luego msgspec.
+try:
+    import orjson
+
+    _decodificar = orjson.loads
+    DECODIFICADOR_JSON = "orjson"
+except ImportError:
+    try:
+        import msgspec
+
+        _decodificar = msgspec.json.Decoder().decode
+        DECODIFICADOR_JSON = "msgspec"
+    except ImportError:
+        _decodificar = json.loads
+        DECODIFICADOR_JSON = "json"
+
+# La API limita a ~1 req/s. Se deja un margen minimo (1.02s) igual que el
+# sleep que usaba cada script antes.
+INTERVALO_MIN_PETICIONES = 1.02
+MAX_PAGINAS_POR_CURSOR = 100
+MAX_CURSORES = 4
+
+# (conexion, lectura) en segundos; ninguna llamada queda sin timeout.
+TIMEOUT_API = (10, 60)
+ESTADOS_REINTENTABLES = {429, 500, 502, 503, 504}
+MAX_REINTENTOS = 4
+ESPERA_BASE_REINTENTO = 1.0
+ESPERA_MAX_REINTENTO = 30.0
+
+# Tipos declarados por campo: "fecha" -> datetime UTC, "num" -> numerico
+# (lo que no se pueda convertir queda NaT/NaN). Los campos que no figuran
+# aca se dejan como los infiere pandas (texto, ids, args, etc.).
+CAMPOS_COMUNES = {
+    "dateStart": "fecha",
+    "dateEnd": "fecha",
+    "latitude": "num",
+    "longitude": "num",
+    "success": "num",
+    "exitCode": "num",
+}
+ESQUEMAS_PROGRAM = {
+    "ping-test": {"avgLatency": "num", "jitter": "num", "packetLoss": "num"},
+    "http-down-burst-test": {"speedDl": "num"},
+    "http-upload-burst-test": {"speedUl": "num"},
+    "cloud-download": {"speedDl": "num"},
+    "cloud-upload": {"speedUl": "num"},
+    "voice-out": {"callSetUpTimeL3": "num", "callSetUpSuccessL3": "num"},
+    "confess-chrome": {"loadingTime": "num"},
+    "youtube-test": {"avgVideoResolution": "num", "bufferingTime": "num", "speedDl": "num"},
+    "twitter-download": {"connectionTime": "num", "loadingTime": "num"},
+    "facebook-download": {"connectionTime": "num", "loadingTime": "num"},
+}
+
+# Pasada de tipos compactos (compactar_tipos) sobre el DataFrame ya unido:
+# texto de pocos valores distintos -> category (un codigo int8/int16 por fila
+# en vez de un str de Python, y los groupby/filtros van sobre los codigos),
+# KPIs -> float32. latitude/longitude quedan en float64: en float32 se
+# pierde ~1 m, y eso cambia el distrito de las muestras junto a un limite.
+CAMPOS_CATEGORIA = (
+    "program", "test", "isp", "technology", "subtechnology", "probeId",
+    "distrito", "canton", "provincia",
+)
+FRACCION_MAX_CATEGORIA = 0.5
+CAMPOS_KPI = frozenset(campo for esquema in ESQUEMAS_PROGRAM.values() for campo in esquema)
+
+
+class LimitadorTasa:
+    """Token bucket thread-safe: como mucho 'capacidad' peticiones seguidas y
+    luego una cada 'intervalo' segundos, compartido por todos los cursores."""
+
+    def __init__(self, intervalo=INTERVALO_MIN_PETICIONES, capacidad=1):
+        self.intervalo = intervalo
+        self.capacidad = capacidad
+        self._tokens = float(capacidad)
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def adquirir(self, detener=None):
+        """Bloquea hasta que haya un token. Devuelve False (sin consumir
+        token) si 'detener' (threading.Event) se activa mientras espera."""
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) / self.intervalo)
+                self._ultimo = ahora
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                espera = (1 - self._tokens) * self.intervalo
+            if detener is None:
+                time.sleep(espera)
+            elif detener.wait(espera):
+                return False
+
+    def penalizar(self, segundos):
+        """Nadie obtiene token durante los proximos 'segundos' (p. ej. tras
+        un 429): vacia el bucket lo necesario para esa espera. Primero se
+        recarga hasta ahora (como en adquirir); si no, el proximo adquirir
+        sumaria todo el tiempo desde el ultimo token y esperaria de menos."""
+        with self._lock:
+            ahora = time.monotonic()
+            self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) / self.intervalo)
+            self._ultimo = ahora
+            self._tokens = min(self._tokens, 1 - segundos / self.intervalo)
+
+
+# Un solo bucket por proceso: la cuota de la API es por token, no por sesion.
+LIMITADOR_API = LimitadorTasa()
+
+
+def _crear_sesion():
+    sesion = requests.Session()
+    # pool_maxsize >= cursores en paralelo: cada cursor reusa su conexion.
+    adaptador = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CURSORES * 2)
+    sesion.mount("https://", adaptador)
+    sesion.mount("http://", adaptador)
+    sesion.headers.update({"Accept-Encoding": "gzip, deflate"})
+    return sesion
+
+
+# Una sola sesion por proceso (thread-safe para peticiones concurrentes).
+SESION = _crear_sesion()
+
+
+def _espera_reintento(intento, r):
+    """Backoff exponencial con jitter completo; si la respuesta trae
+    Retry-After (tipico en 429) se espera al menos eso."""
+    espera = random.uniform(0, min(ESPERA_MAX_REINTENTO, ESPERA_BASE_REINTENTO * 2 ** intento))
+    if r is not None:
+        try:
+            espera = max(espera, float(r.headers.get("Retry-After", 0)))
+        except ValueError:
+            pass
+    return espera
+
+
+def peticion(metodo, url, limitador=None, detener=None, timeout=TIMEOUT_API,
+             reintentos=MAX_REINTENTOS, **kwargs):
+    """Peticion HTTP por la sesion compartida, reintentando 429/5xx y
+    errores de conexion/timeout. Con 'limitador', cada intento consume un
+    token. Devuelve la respuesta (la ultima, si se agotaron los reintentos
+    con un estado reintentable), o None si 'detener' se activo esperando."""
+    for intento in range(reintentos + 1):
+        if limitador is not None and not limitador.adquirir(detener):
+            return None
+        try:
+            r = SESION.request(metodo, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if intento == reintentos:
+                raise
+            r = None
+        if r is not None and (r.status_code not in ESTADOS_REINTENTABLES or intento == reintentos):
+            return r
+        espera = _espera_reintento(intento, r)
+        if limitador is not None and r is not None and r.status_code == 429:
+            # El bucket es compartido: que esperen todos, no solo este cursor.
+            limitador.penalizar(espera)
+            continue
+        if detener is None:
+            time.sleep(espera)
+        elif detener.wait(espera):
+            return None
+    return r
+
+
+def post_api(url, headers, body, timeout=TIMEOUT_API, detener=None):
+    """POST a la API MedUX bajo el limite compartido de ~1 req/s."""
+    return peticion("POST", url, limitador=LIMITADOR_API, detener=detener, timeout=timeout,
+                    headers=headers, json=body)
+
+
+def dividir_body(body, max_cursores=MAX_CURSORES):
+    """Parte la consulta en sub-consultas independientes (una por cursor):
+    una por program si hay varios; si hay un solo program, en grupos de
+    sondas. Devuelve lista de (etiqueta, body)."""
+    programs = list(body.get("programs") or [])
+    if len(programs) > 1:
+        return [(p, dict(body, programs=[p])) for p in programs]
+    probes = list(body.get("probes") or [])
+    n_grupos = min(max_cursores, len(probes))
+    if n_grupos > 1:
+        grupos = [probes[i::n_grupos] for i in range(n_grupos)]
+        return [(f"sondas {i + 1}/{n_grupos}", dict(body, probes=g)) for i, g in enumerate(grupos)]
+    return [(programs[0] if programs else "todo", body)]
+
+
+def _recorrer_cursor(url, headers, body, etiqueta, limitador, salida, detener):
+    """Loop PIT/search_after de UN cursor (corre en un hilo del pool). Cada
+    pagina se convierte a DataFrame (pagina_a_bloque) y se manda a 'salida'
+    como ("pagina", etiqueta, bloque, tiempos), con tiempos = {"red",
+    "decodificacion", "armado"} en segundos; al final manda ("fin",
+    etiqueta, motivo) o ("error", etiqueta, mensaje)."""
+    payload = body.copy()
+    payload["paginate"] = True
+    payload.setdefault("size", 10000)
+    pagina = 1
+    try:
+        while not detener.is_set():
+            t0 = time.perf_counter()
+            r = peticion("POST", url, limitador=limitador, detener=detener, headers=headers, json=payload)
+            t1 = time.perf_counter()
+            if r is None:
+                break
+            if r.status_code != 200:
+                salida.put(("error", etiqueta, f"pagina {pagina}: {r.status_code} — {r.text[:500]}"))
+                return
+            data = decodificar_json(r)
+            t2 = time.perf_counter()
+            bloque = pagina_a_bloque(data)
+            tiempos = {"red": t1 - t0, "decodificacion": t2 - t1, "armado": time.perf_counter() - t2}
+            salida.put(("pagina", etiqueta, bloque, tiempos))
+            pagina_vacia = bloque.empty
+            # El cursor de paginacion viene ANIDADO en "next_pagination_data".
+            cursor = data.get("next_pagination_data") or {}
+            pit = cursor.get("pit")
+            if pagina_vacia or not pit:
+                break
+            payload["pit"] = pit
+            if cursor.get("search_after"):
+                payload["search_after"] = cursor.get("search_after")
+            pagina += 1
+            if pagina > MAX_PAGINAS_POR_CURSOR:
+                salida.put(("fin", etiqueta, "limite_paginas"))
+                return
+    except Exception as e:
+        salida.put(("error", etiqueta, f"pagina {pagina}: {e}"))
+        return
+    salida.put(("fin", etiqueta, "ok"))
+
+
+def ejecutar_cursores(url, headers, sub_consultas, max_cursores=MAX_CURSORES, limitador=None):
+    """Lanza un cursor PIT por cada (etiqueta, body) de sub_consultas en un
+    pool de hilos y va entregando, EN EL HILO QUE ITERA (el del script), los
+    eventos que mandan los cursores: ("pagina", etiqueta, bloque, tiempos),
+    ("fin", etiqueta, motivo) o ("error", etiqueta, mensaje). Si quien itera
+    corta antes (break / limite de filas), al cerrar el generador se avisa a
+    los cursores vivos que paren."""
+    limitador = limitador or LIMITADOR_API
+    salida = queue.Queue()
+    detener = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=max(1, min(max_cursores, len(sub_consultas))))
+    for etiqueta, sub_body in sub_consultas:
+        pool.submit(_recorrer_cursor, url, headers, sub_body, etiqueta, limitador, salida, detener)
+    activos = len(sub_consultas)
+    try:
+        while activos:
+            evento = salida.get()
+            if evento[0] != "pagina":
+                activos -= 1
+            yield evento
+    finally:
+        # Los cursores que sigan vivos salen solos en su proxima vuelta (o al
+        # esperar token); no se espera a que terminen su peticion en curso.
+        detener.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def decodificar_json(r):
+    """Cuerpo JSON de una respuesta de requests, con el decodificador mas
+    rapido disponible (ver DECODIFICADOR_JSON). Reemplaza a r.json()."""
+    return _decodificar(r.content)
+
+
+def aplicar_esquema(bloque, program):
+    """Fija los tipos declarados para 'program' (ver ESQUEMAS_PROGRAM) en un
+    bloque recien armado. Se hace una sola vez por bloque, en el hilo del
+    cursor: despues nadie necesita volver a convertir fechas ni KPIs."""
+    esquema = {**CAMPOS_COMUNES, **ESQUEMAS_PROGRAM.get(program, {})}
+    for col, tipo in esquema.items():
+        if col not in bloque.columns:
+            continue
+        if tipo == "fecha":
+            bloque[col] = pd.to_datetime(bloque[col], errors="coerce", utc=True, format="ISO8601")
+        else:
+            bloque[col] = pd.to_numeric(bloque[col], errors="coerce")
+    return bloque
+
+
+def compactar_tipos(df):
+    """Tipos compactos (ver CAMPOS_CATEGORIA / CAMPOS_KPI) sobre el
+    DataFrame YA unido de todas las paginas: hacerlo por pagina daria
+    categorias distintas en cada bloque y el concat las volveria a object.
+    Las fechas ya vienen como datetime UTC de aplicar_esquema; solo se
+    parsean aca si llegan como texto (p. ej. de un df armado a mano).
+    Los KPIs que lleguen como texto se convierten a numerico.
+    Modifica y devuelve 'df'. Los groupby sobre columnas category deben ir
+    con observed=True (si no, salen tambien las combinaciones vacias)."""
+    if df.empty:
+        return df
+    for col in CAMPOS_CATEGORIA:
+        # object (pandas < 3) o el dtype "str" de pandas >= 3.
+        if col not in df.columns or not (
+            pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_string_dtype(df[col])
+        ):
+            continue
+        if df[col].nunique() <= FRACCION_MAX_CATEGORIA * len(df):
+            df[col] = df[col].astype("category")
+    for col in CAMPOS_KPI:
+        if col not in df.columns:
+            continue
+        # Un KPI que en algun bloque quedo como texto (program sin esquema
+        # para ese campo) vuelve object del concat: se convierte aca.
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], errors="coerce")
+        if df[col].dtype == "float64":
+            df[col] = df[col].astype("float32")
+    for col, tipo in CAMPOS_COMUNES.items():
+        if tipo == "fecha" and col in df.columns and not isinstance(df[col].dtype, pd.DatetimeTZDtype):
+            df[col] = pd.to_datetime(df[col], errors="coerce", utc=True, format="ISO8601")
+    return df
+
+
+def pagina_a_bloque(data):
+    """Convierte los resultados de UNA respuesta de /api/results
+    ({program: [filas...]}, o una lista suelta para 'network') en un
+    DataFrame con columna 'program' y tipos segun el esquema declarado.
+    En la descarga paginada corre en el hilo del cursor apenas llega la
+    pagina: el armado se solapa con la espera de ~1s hasta la peticion
+    siguiente, y el JSON crudo se libera enseguida."""
+    results = data.get("results", {})
+    if isinstance(results, list):
+        listas = [("network", results)]
+    elif isinstance(results, dict):
+        listas = [(prog, res) for prog, res in results.items() if isinstance(res, list)]
+    else:
+        listas = []
+    bloques = []
+    for prog, res in listas:
+        if not res:
+            continue
+        bloque = pd.DataFrame.from_records(res)
+        # Igual que antes en flatten_results: el program de la fila manda,
+        # el de la clave de 'results' solo completa el que falte.
+        bloque["program"] = bloque["program"].fillna(prog) if "program" in bloque.columns else prog
+        bloques.append(aplicar_esquema(bloque, prog))
+    return concatenar_bloques(bloques)
+
+
+def concatenar_bloques(bloques):
+    """Une los DataFrames de varias paginas/tramos (ignora los vacios)."""
+    bloques = [b for b in bloques if b is not None and not b.empty]
+    if not bloques:
+        return pd.DataFrame()
+    if len(bloques) == 1:
+        return bloques[0]
+    return pd.concat(bloques, ignore_index=True)
+
+
+if __name__ == "__main__":
+    # Micro-benchmark: aplanador por columnas vs el extraer_filas recursivo
+    # que tenia cada script, sobre 100k filas sinteticas con forma de
+    # ping-test. Ambos lados incluyen la conversion de fechas (antes la hacia
+    # flatten_results despues de armar el DataFrame).
+    def _flatten_recursivo(raw_json):
+        filas = []
+
+        def extraer_filas(obj, program=None):
+            if isinstance(obj, dict):
+                if "results" in obj:
+                    extraer_filas(obj["results"], program)
+                else:
+                    tiene_lista = False
+                    for k, v in obj.items():
+                        if isinstance(v, list):
+                            tiene_lista = True
+                            extraer_filas(v, k)
+                    if not tiene_lista:
+                        fila = obj.copy()
+                        if program:
+                            fila["program"] = fila.get("program", program)
+                        filas.append(fila)
+            elif isinstance(obj, list):
+                for item in obj:
+                    extraer_filas(item, program)
+
+        extraer_filas(raw_json)
+        df = pd.DataFrame(filas)
+        for col in ["dateStart", "dateEnd"]:
+            df[col] = pd.to_datetime(df[col], errors="coerce", utc=True)
+        return df
+
+    def _fila(i):
+        fila = {
+            "probeId": 1000 + i % 40,
+            "dateStart": f"2026-03-{1 + i % 28:02d}T{i % 24:02d}:{i % 60:02d}:00Z",
+            "dateEnd": f"2026-03-{1 + i % 28:02d}T{i % 24:02d}:{i % 60:02d}:05Z",
+            "latitude": 9.5 + random.random(),
+            "longitude": -84.5 + random.random(),
+            "success": 1,
+            "exitCode": 0,
+            "isp": random.choice(["kolbi", "claro", "liberty"]),
+            "technology": random.choice(["LTE", "5G", "UMTS"]),
+            "test": "ping-test",
+            "args": {"target": random.choice(["8.8.8.8", "1.1.1.1"])},
+            "avgLatency": random.random() * 80,
+            "jitter": random.random() * 5,
+            "packetLoss": 0.0,
+        }
+        fila.update({f"campo{k}": random.random() for k in range(10)})
+        return fila
+
+    random.seed(0)
+    respuesta = {"results": {"ping-test": [_fila(i) for i in range(100_000)]}}
+    for nombre, funcion in [("recursivo (extraer_filas)", _flatten_recursivo), ("por columnas + esquema", pagina_a_bloque)]:
+        t0 = time.perf_counter()
+        df = funcion(respuesta)
+        print(f"{nombre:<28} {time.perf_counter() - t0:6.3f}s  {df.shape[0]:,} filas x {df.shape[1]} columnas")
@@ -0,0 +1,867 @@
+"""
+Medux Geo - poligonos de distritos (IGN) guardados en disco
+===========================================================
+Antes cada mapa bajaba la capa completa IGN_5_CO:limitedistrital_5k del WFS
+del SNIT (geos.snitcr.go.cr, timeout 90 s) en cada arranque en frio: el
+@st.cache_data(ttl=24h) vivia solo en la memoria del proceso, asi que cada
+reinicio del contenedor repetia la descarga, y una caida del WFS dejaba sin
+mapa a RACSA y Sutel.
+
+Ahora:
+    - La capa se guarda UNA vez en disco como Parquet (geometria en WKB a
+      precision completa + distrito/canton/provincia/codigo_dta), con un
+      sello de version (hash del contenido) en el nombre del archivo:
+          <DIRECTORIO_GEO>/distritos_<version>.parquet
+      y un manifiesto "distritos.json" que apunta a la version vigente
+      (capa, url, fecha de descarga, cantidad de distritos).
+    - distritos_base() lee ese archivo (milisegundos: shapely.from_wkb sobre
+      toda la columna de una vez) y solo va al WFS si no hay ninguna version
+      local. Para volver a bajarla hay que pedirlo explicitamente
+      (actualizar_distritos, boton "Actualizar poligonos (WFS)" de cada
+      mapa); si el WFS falla, sigue vigente la version local anterior.
+    - Ademas del cache (MEDUX_CACHE_DIR) se busca una copia versionada junto
+      al codigo (geo/): `python medux_geo.py` baja la capa y la deja ahi,
+      para desplegar con los poligonos ya incluidos aunque el WFS no
+      responda en el primer arranque.
+    - version_distritos() lee solo el manifiesto: los mapas la pasan como
+      clave de distritos_version() / topologia_distritos() /
+      indice_distritos(), asi que al actualizar la capa se rearman sin
+      reiniciar nada.
+    - Para dibujar, la capa se guarda como topologia (Topologia: cada borde
+      compartido entre dos distritos, una sola vez), armada una sola vez
+      desde la geometria completa y compartida entre sesiones. Cada nivel
+      del slider de simplificacion (0, 5, 10, ... 100 m) se precalcula al
+      armarla simplificando los arcos, no los poligonos (mover el slider no
+      hace ningun trabajo de GEOS, solo elige un nivel): los vecinos
+      comparten exactamente el mismo borde simplificado y el mapa lo manda
+      una vez (TopoJSON, ver medux_mapa.topojson). Lo mismo para las
+      manchas del KMZ de RACSA. Se simplifica en CRS_METRICO (CRTM05): la
+      tolerancia del slider es en metros reales, no grados * 111 km.
+    - Las reproyecciones usan un Transformer cacheado por par de CRS
+      (transformador) y transforman todas las coordenadas de un array de
+      geometrias en una llamada (reproyectar).
+    - El indice espacial (IndiceEspacial: STRtree + poligonos preparados)
+      tambien se arma una sola vez por version, no en cada spatial join. El
+      de distritos (IndiceConCeldas) ademas recuerda, por celda de ~110 m,
+      las que caen enteras dentro de un distrito: solo las muestras en
+      celdas de borde pasan por el point-in-polygon exacto.
+    - Con millones de muestras (consolidado anual) asignar_distritos puede
+      repartir el join entre varios procesos (procesos=N): los distritos se
+      pasan una vez por proceso como WKB y cada bloque solo lleva lon/lat.
+      Solo si hay mas de una CPU disponible (cpus_disponibles) y si, medido
+      el primer bloque, el arranque de los procesos se paga.
+
+Si pyarrow no esta instalado no se guarda nada y se baja del WFS como antes.
+"""
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytz
+import shapely
+import streamlit as st
+from pyproj import Transformer
+from shapely.geometry import shape
+from shapely.strtree import STRtree
+
+from medux_api import decodificar_json, peticion
+from medux_store import DIRECTORIO_CACHE
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # sin copia local: se baja del WFS en cada arranque
+    pa = pq = None
+
+WFS_URL = "https://geos.snitcr.go.cr/be/IGN_5_CO/wfs"
+WFS_LAYER = "IGN_5_CO:limitedistrital_5k"
+WFS_SRS_NATIVE = "EPSG:8908"   # CR-SIRGAS / CRTM05 (metros)
+WFS_SRS_OUTPUT = "EPSG:4326"   # WGS84 lat/lon (lo que trae la API MedUX)
+TIMEOUT_WFS = 90
+
+DIRECTORIO_GEO = os.path.join(DIRECTORIO_CACHE, "geo")
+# Copia incluida en el repo (la deja `python medux_geo.py`); se usa si el
+# cache esta vacio, p. ej. recien desplegado.
+DIRECTORIO_GEO_INCLUIDO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "geo")
+MANIFIESTO_DISTRITOS = "distritos.json"
+CAMPOS_DISTRITO = ("distrito", "canton", "provincia", "codigo_dta")
+
+# CRS proyectado (metros) en el que se simplifica: las tolerancias de los
+# sliders quedan en metros reales en vez de grados * 111 km (que en lon/lat
+# deforma distinto en cada eje).
+CRS_METRICO = WFS_SRS_NATIVE
+# Niveles de simplificacion de la topologia = los valores posibles de cada
+# slider ("Simplificacion de poligonos" y "Simplificacion de manchas KMZ").
+NIVELES_DISTRITOS_M = tuple(range(0, 101, 5))
+NIVELES_MANCHAS_M = tuple(range(0, 201, 10))
+# Celda de grilla del cache punto -> distrito (IndiceConCeldas): 0.001 grados
+# ~ 110 m. Mas chica = mas celdas enteras dentro de un distrito pero menos
+# muestras por celda.
+TAMANO_CELDA_GRADOS = 0.001
+CELDA_FRONTERA = -2
+CELDA_DESCONOCIDA = -3
+# Spatial join en varios procesos (asignar_distritos(procesos=...)). Cada
+# proceso "spawn" re-importa streamlit/pandas/shapely y arma su indice desde
+# el WKB: ARRANQUE_PROCESOS_SEG medido con `python medux_geo.py bench`
+# (~1.4 s). El costo por fila va de ~0.2 us (recorrido, casi todo en celdas
+# ya resueltas) a ~3.5 us (puntos dispersos, todos a GEOS): aun en el peor
+# caso y con muchas CPUs el punto de equilibrio (arranque / costo por fila)
+# anda por 470k filas, de ahi MIN_FILAS_PARALELO. Por encima se decide
+# midiendo el primer bloque (ver _primer_poligono_adaptativo).
+MIN_FILAS_PARALELO = 500_000
+ARRANQUE_PROCESOS_SEG = 1.5
+FILAS_POR_BLOQUE = 250_000
+# Topologia (arcos compartidos): grilla con la que se reconocen los vertices
+# comunes a dos poligonos vecinos. 1e-7 grados ~ 1 cm: absorbe el ruido de
+# punto flotante sin juntar vertices que de verdad son distintos.
+PASO_TOPOLOGIA_GRADOS = 1e-7
+
+
+def descargar_distritos_wfs():
+    """Baja la capa de distritos del WFS y devuelve una lista de dicts
+    {distrito, canton, provincia, codigo_dta, geometry} en WGS84 a
+    precision completa (sin simplificar)."""
+    params = {
+        "service": "WFS",
+        "version": "2.0.0",
+        "request": "GetFeature",
+        "typeName": WFS_LAYER,
+        "outputFormat": "application/json",
+        "srsName": WFS_SRS_OUTPUT,  # se pide directamente en WGS84
+    }
+    r = peticion("GET", WFS_URL, params=params, timeout=TIMEOUT_WFS)
+    r.raise_for_status()
+    geojson = decodificar_json(r)
+
+    features = geojson.get("features", [])
+    geoms = np.empty(len(features), dtype=object)
+    geoms[:] = [shape(feat["geometry"]) for feat in features]
+    # Salvaguarda: si el servidor NO reproyecto (coords fuera de rango lat/lon),
+    # se reproyecta en el cliente desde el CRS nativo (EPSG:8908), todas las
+    # geometrias en una sola llamada.
+    bounds = shapely.bounds(geoms).reshape(-1, 4)
+    nativas = (np.abs(bounds[:, [0, 2]]) > 180).any(axis=1) | (np.abs(bounds[:, [1, 3]]) > 90).any(axis=1)
+    if nativas.any():
+        geoms[nativas] = reproyectar(geoms[nativas], WFS_SRS_NATIVE, WFS_SRS_OUTPUT)
+
+    distritos = []
+    for feat, geom in zip(features, geoms):
+        props = feat.get("properties", {}) or {}
+        distritos.append({
+            "distrito": props.get("DISTRITO") or "N/D",
+            "canton": props.get("CANTÓN") or "N/D",
+            "provincia": props.get("PROVINCIA") or "N/D",
+            "codigo_dta": props.get("CÓDIGO_DTA"),
+            "geometry": geom,
+        })
+    return distritos
+
+
+@functools.lru_cache(maxsize=None)
+def transformador(origen, destino):
+    """Transformer de pyproj (orden x=lon, y=lat) para un par de CRS, armado
+    una sola vez: crearlo consulta la base de datos de PROJ y cuesta mas que
+    reproyectar la capa entera. Desde pyproj 3.1 es seguro compartirlo entre
+    los hilos de las sesiones de Streamlit."""
+    return Transformer.from_crs(origen, destino, always_xy=True)
+
+
+def reproyectar(geoms, origen, destino):
+    """Reproyecta un array de geometrias en UNA llamada: shapely.transform
+    junta todas sus coordenadas en un array (n, 2) y pyproj las transforma
+    de una vez (en vez de un shapely.ops.transform por geometria, que llama
+    a pyproj por cada una)."""
+    t = transformador(origen, destino)
+    return shapely.transform(geoms, lambda xy: np.column_stack(t.transform(xy[:, 0], xy[:, 1])))
+
+
+def huella_archivo(ruta):
+    """Hash (12 hex) del contenido de 'ruta': version de un archivo fuente
+    (p.ej. el KMZ de RACSA) para nombrar lo que se calcula a partir de el."""
+    huella = hashlib.sha1()
+    with open(ruta, "rb") as fh:
+        for bloque in iter(lambda: fh.read(1 << 20), b""):
+            huella.update(bloque)
+    return huella.hexdigest()[:12]
+
+
+def guardar_geometrias(registros, campos, ruta):
+    """Escribe 'registros' (dicts con 'geometry' + 'campos') como Parquet:
+    geometria en WKB a precision completa y cada campo como texto. Se
+    escribe a un .tmp y se renombra, para no dejar nunca un archivo a
+    medias. Sin pyarrow no guarda nada (devuelve False)."""
+    if pq is None:
+        return False
+    tabla = pa.table({
+        **{
+            c: pa.array([None if r[c] is None else str(r[c]) for r in registros], type=pa.string())
+            for c in campos
+        },
+        "geometry": pa.array(list(shapely.to_wkb([r["geometry"] for r in registros])), type=pa.binary()),
+    })
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    tmp = f"{ruta}.tmp"
+    pq.write_table(tabla, tmp)
+    os.replace(tmp, ruta)
+    return True
+
+
+def leer_geometrias(ruta, campos):
+    """Inverso de guardar_geometrias: lista de dicts con 'campos' +
+    'geometry' (codigo_dta vuelve a int si es numerico). None si el archivo
+    no existe o no hay pyarrow."""
+    if pq is None or not os.path.exists(ruta):
+        return None
+    tabla = pq.read_table(ruta).to_pydict()
+    geoms = shapely.from_wkb(np.asarray(tabla["geometry"], dtype=object))
+    if "codigo_dta" in campos:
+        tabla["codigo_dta"] = [int(v) if v is not None and v.isdigit() else v for v in tabla["codigo_dta"]]
+    return [{**{c: tabla[c][i] for c in campos}, "geometry": geoms[i]} for i in range(len(geoms))]
+
+
+def _leer_manifiesto(directorio):
+    try:
+        with open(os.path.join(directorio, MANIFIESTO_DISTRITOS), encoding="utf-8") as fh:
+            manifiesto = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if not os.path.exists(os.path.join(directorio, manifiesto.get("archivo", ""))):
+        return None
+    return manifiesto
+
+
+def _manifiesto_vigente():
+    """(directorio, manifiesto) de la copia local a usar: la del cache, o
+    si no hay, la incluida en el repo. (None, None) si no hay ninguna."""
+    if pq is None:
+        return None, None
+    for directorio in (DIRECTORIO_GEO, DIRECTORIO_GEO_INCLUIDO):
+        manifiesto = _leer_manifiesto(directorio)
+        if manifiesto:
+            return directorio, manifiesto
+    return None, None
+
+
+def version_distritos():
+    """Version de la copia local vigente (o None si todavia no hay)."""
+    _, manifiesto = _manifiesto_vigente()
+    return manifiesto["version"] if manifiesto else None
+
+
+def guardar_distritos(distritos, directorio=DIRECTORIO_GEO):
+    """Escribe 'distritos' (lista de descargar_distritos_wfs) como
+    distritos_<version>.parquet y apunta el manifiesto a esa version. La
+    version es un hash del contenido: volver a bajar una capa sin cambios
+    no crea un archivo nuevo. Devuelve el manifiesto."""
+    wkb = shapely.to_wkb([d["geometry"] for d in distritos])
+    columnas = {c: [d[c] for d in distritos] for c in CAMPOS_DISTRITO}
+    columnas["codigo_dta"] = [None if v is None else str(v) for v in columnas["codigo_dta"]]
+
+    huella = hashlib.sha1()
+    for i, geom_wkb in enumerate(wkb):
+        huella.update(json.dumps([columnas[c][i] for c in CAMPOS_DISTRITO]).encode("utf-8"))
+        huella.update(geom_wkb)
+    version = huella.hexdigest()[:12]
+
+    archivo = f"distritos_{version}.parquet"
+    ruta = os.path.join(directorio, archivo)
+    if not os.path.exists(ruta):
+        guardar_geometrias(distritos, CAMPOS_DISTRITO, ruta)
+
+    manifiesto = {
+        "version": version,
+        "archivo": archivo,
+        "capa": WFS_LAYER,
+        "url": WFS_URL,
+        "descargado": datetime.now(pytz.utc).isoformat(timespec="seconds"),
+        "n_distritos": len(distritos),
+    }
+    ruta_manifiesto = os.path.join(directorio, MANIFIESTO_DISTRITOS)
+    tmp = f"{ruta_manifiesto}.tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(manifiesto, fh, indent=2)
+    os.replace(tmp, ruta_manifiesto)
+    return manifiesto
+
+
+def leer_distritos(directorio, manifiesto):
+    """Lee la version apuntada por 'manifiesto' (mismo formato de lista de
+    dicts que descargar_distritos_wfs)."""
+    return leer_geometrias(os.path.join(directorio, manifiesto["archivo"]), CAMPOS_DISTRITO)
+
+
+def distritos_base():
+    """Distritos a precision completa: de la copia local si existe; si no,
+    del WFS (y se guarda como primera version). Devuelve (distritos,
+    manifiesto o None)."""
+    directorio, manifiesto = _manifiesto_vigente()
+    if manifiesto:
+        return leer_distritos(directorio, manifiesto), manifiesto
+    distritos = descargar_distritos_wfs()
+    if pq is None:
+        return distritos, None
+    return distritos, guardar_distritos(distritos)
+
+
+def actualizar_distritos():
+    """Vuelve a bajar la capa del WFS (solo a pedido, boton "Actualizar
+    poligonos (WFS)") y la deja como version vigente. Si el WFS falla el
+    error se propaga y la copia local anterior sigue vigente. Devuelve el
+    manifiesto nuevo (None si no hay pyarrow para guardarlo)."""
+    distritos = descargar_distritos_wfs()
+    if pq is None:
+        return None
+    return guardar_distritos(distritos)
+
+
+@st.cache_resource(show_spinner="Cargando poligonos de distritos...")
+def distritos_version(version=None):
+    """Distritos a precision completa (lista de dicts de distritos_base) UNA
+    vez por version de la capa (version_distritos()) y por proceso,
+    compartida entre sesiones. No modificar lo que devuelve."""
+    distritos, _ = distritos_base()
+    return distritos
+
+
+@st.cache_resource(show_spinner="Armando la topologia y los niveles de simplificacion de los distritos...")
+def topologia_distritos(version=None):
+    """Topologia de los distritos de distritos_version(version) (mismo
+    orden), UNA vez por version y por proceso. No modificar."""
+    return Topologia([d["geometry"] for d in distritos_version(version)], NIVELES_DISTRITOS_M)
+
+
+class Topologia:
+    """Poligonos como arcos compartidos (el modelo de TopoJSON): cada borde
+    comun a dos poligonos (distritos vecinos, una mancha y sus pedazos por
+    distrito) se guarda UNA vez, y cada anillo es una lista de indices de
+    arco (~i = el arco i recorrido al reves). Se arma una vez desde la
+    geometria completa: los vertices se comparan en una grilla de
+    PASO_TOPOLOGIA_GRADOS y los anillos se cortan en las "uniones" (vertices
+    que aparecen en varios anillos con vecinos distintos), todo vectorizado
+    salvo el corte y la deduplicacion, que van por anillo y por arco.
+
+    Todos los 'niveles' de simplificacion se precalculan al armarla (una
+    llamada vectorizada por nivel sobre los ARCOS, en CRS_METRICO; en
+    paralelo en hilos si hay varias CPUs, GEOS suelta el GIL), asi que
+    arcos() es solo una busqueda. Como cada borde compartido se simplifica
+    una vez, cuesta menos que simplificar los poligonos (la mitad con
+    distritos sinteticos de 750k vertices). Las uniones quedan fijas y los
+    dos vecinos siguen compartiendo el mismo borde simplificado, sin huecos
+    ni solapes entre ellos. Se comparte entre sesiones (st.cache_resource):
+    no modificar lo que devuelve."""
+
+    def __init__(self, geoms, niveles):
+        originales = np.empty(len(geoms), dtype=object)
+        originales[:] = geoms
+        self.niveles = tuple(sorted(niveles))
+        partes, geom_de_parte = shapely.get_parts(originales, return_index=True)
+        poligonos = shapely.get_type_id(partes) == 3
+        partes, geom_de_parte = partes[poligonos], geom_de_parte[poligonos]
+        anillos, parte_de_anillo = shapely.get_rings(partes, return_index=True)
+        coords, anillo_de_punto = shapely.get_coordinates(anillos, return_index=True)
+        claves, inicio, largo = self._vertices(coords, anillo_de_punto, len(anillos))
+        coords = coords[claves.index]
+        claves = claves.to_numpy()
+        uniones = self._uniones(claves, inicio, largo)
+
+        self._arcos = []
+        arco_por_clave = {}
+
+        def indice_arco(puntos):
+            adelante = claves[puntos]
+            clave = adelante.tobytes()
+            if clave in arco_por_clave:
+                return arco_por_clave[clave]
+            clave_reves = adelante[::-1].tobytes()
+            if clave_reves in arco_por_clave:
+                return ~arco_por_clave[clave_reves]
+            arco_por_clave[clave] = len(self._arcos)
+            self._arcos.append(coords[puntos])
+            return len(self._arcos) - 1
+
+        arcos_de_anillo = []
+        for ini, n in zip(inicio, largo):
+            if n < 3:
+                arcos_de_anillo.append(None)
+                continue
+            puntos = np.arange(ini, ini + n)
+            cortes = np.flatnonzero(uniones[ini:ini + n])
+            if len(cortes) == 0:
+                # Anillo sin uniones (isla, o enclave = hueco de su vecino):
+                # un solo arco cerrado, rotado para empezar en su vertice de
+                # clave minima, asi el mismo anillo da el mismo arco.
+                puntos = np.roll(puntos, -np.argmin(claves[puntos]))
+                cortes = np.zeros(1, dtype=np.int64)
+            else:
+                puntos = np.roll(puntos, -cortes[0])
+                cortes = cortes - cortes[0]
+            puntos = np.append(puntos, puntos[0])
+            bordes = np.append(cortes, n)
+            arcos_de_anillo.append([indice_arco(puntos[a:b + 1]) for a, b in zip(bordes[:-1], bordes[1:])])
+
+        # geometrias[i] = lista de partes (poligonos) de geoms[i]; cada parte
+        # = lista de anillos (exterior primero), cada anillo = lista de arcos.
+        # Una parte sin exterior valido (colapso a < 3 vertices) se descarta.
+        self.geometrias = [[] for _ in range(len(originales))]
+        anillos_de_parte = [[] for _ in range(len(partes))]
+        for i_anillo, i_parte in enumerate(parte_de_anillo):
+            anillos_de_parte[i_parte].append(arcos_de_anillo[i_anillo])
+        for i_parte, i_geom in enumerate(geom_de_parte):
+            anillos_parte = anillos_de_parte[i_parte]
+            if anillos_parte and anillos_parte[0] is not None:
+                self.geometrias[i_geom].append([a for a in anillos_parte if a is not None])
+
+        lineas = shapely.linestrings(
+            np.concatenate(self._arcos) if self._arcos else np.empty((0, 2)),
+            indices=np.repeat(np.arange(len(self._arcos)), [len(a) for a in self._arcos]),
+        )
+        self._cerrados = np.array([np.array_equal(a[0], a[-1]) for a in self._arcos], dtype=bool)
+        self._lineas_metricas = reproyectar(lineas, WFS_SRS_OUTPUT, CRS_METRICO)
+        a_simplificar = [nivel for nivel in self.niveles if nivel > 0]
+        with ThreadPoolExecutor(max_workers=max(1, min(cpus_disponibles(), len(a_simplificar)))) as pool:
+            self._arcos_nivel = dict(zip(a_simplificar, pool.map(self._simplificar, a_simplificar)))
+        if 0 in self.niveles:
+            self._arcos_nivel[0] = self._arcos
+
+    @staticmethod
+    def _vertices(coords, anillo_de_punto, n_anillos):
+        """(claves, inicio, largo): una clave int64 por vertice (x, y en la
+        grilla de PASO_TOPOLOGIA_GRADOS), sin el punto de cierre ni vertices
+        repetidos seguidos, y el inicio/largo de cada anillo en ese array.
+        'claves' es una Series cuyo index apunta a la fila de 'coords'."""
+        base = coords.min(axis=0) if len(coords) else np.zeros(2)
+        grilla = np.round((coords - base) / PASO_TOPOLOGIA_GRADOS).astype(np.int64)
+        claves = (grilla[:, 0] << 32) + grilla[:, 1]
+        nuevo_anillo = np.ones(len(claves), dtype=bool)
+        nuevo_anillo[1:] = anillo_de_punto[1:] != anillo_de_punto[:-1]
+        repetido = np.zeros(len(claves), dtype=bool)
+        repetido[1:] = claves[1:] == claves[:-1]
+        # El punto de cierre repite el primero del anillo: cae como repetido
+        # salvo por el corte de anillo; se marca aparte.
+        ultimo = np.append(nuevo_anillo[1:], True)
+        primero = np.flatnonzero(nuevo_anillo)
+        primero_de = primero[np.cumsum(nuevo_anillo) - 1]
+        cierre = ultimo & (claves == claves[primero_de])
+        conservar = (nuevo_anillo | ~repetido) & ~(cierre & ~nuevo_anillo)
+        anillos = anillo_de_punto[conservar]
+        largo = np.bincount(anillos, minlength=n_anillos)
+        inicio = np.concatenate([[0], np.cumsum(largo)[:-1]]).astype(np.int64)
+        return pd.Series(claves[conservar], index=np.flatnonzero(conservar)), inicio, largo
+
+    @staticmethod
+    def _uniones(claves, inicio, largo):
+        """Mascara de los vertices donde hay que cortar arcos: los que
+        aparecen en mas de un lugar con pares de vecinos distintos (ahi se
+        separan los bordes de dos poligonos)."""
+        anillo = np.repeat(np.arange(len(largo)), largo)
+        pos = np.arange(len(claves))
+        ini = inicio[anillo]
+        fin = ini + largo[anillo] - 1
+        anterior = claves[np.where(pos == ini, fin, pos - 1)]
+        siguiente = claves[np.where(pos == fin, ini, pos + 1)]
+        vecinos = pd.DataFrame({
+            "clave": claves,
+            "a": np.minimum(anterior, siguiente),
+            "b": np.maximum(anterior, siguiente),
+        }).drop_duplicates()
+        distintos = vecinos["clave"].value_counts()
+        return np.isin(claves, distintos.index[distintos > 1].to_numpy())
+
+    def nivel(self, tolerancia_m):
+        """Nivel de 'niveles' mas cercano a 'tolerancia_m'."""
+        return min(self.niveles, key=lambda n: abs(n - tolerancia_m))
+
+    def _simplificar(self, nivel):
+        """Arcos (lon/lat) simplificados con tolerancia 'nivel' metros."""
+        simples = shapely.simplify(self._lineas_metricas, nivel, preserve_topology=True)
+        # Un anillo de un solo arco que colapsa (< 4 puntos) queda
+        # como estaba: no hay vecino con el que quedar desparejo.
+        colapsados = self._cerrados & (shapely.get_num_coordinates(simples) < 4)
+        simples[colapsados] = self._lineas_metricas[colapsados]
+        simples = reproyectar(simples, CRS_METRICO, WFS_SRS_OUTPUT)
+        coords, arco = shapely.get_coordinates(simples, return_index=True)
+        cortes = np.cumsum(np.bincount(arco, minlength=len(simples)))[:-1]
+        return np.split(coords, cortes)
+
+    def arcos(self, tolerancia_m):
+        """Lista de arcos (arrays (n, 2) de lon/lat) del nivel mas cercano a
+        'tolerancia_m', con los mismos indices que self.geometrias."""
+        return self._arcos_nivel[self.nivel(tolerancia_m)]
+
+
+class IndiceEspacial:
+    """STRtree + geometrias preparadas (shapely.prepare) de una lista de
+    poligonos, construido UNA vez por version de las geometrias (ver
+    indice_distritos y las manchas KMZ de RACSA) en vez de en cada llamada
+    a asignar_distritos / manchas_con_muestras / dividir_manchas_por_distrito.
+
+    Los puntos se resuelven en dos pasos vectorizados: el arbol da los
+    candidatos por bounding box y shapely.intersects los confirma contra
+    el poligono PREPARADO (el predicado del STRtree prepararia los puntos,
+    que no sirve de nada). Thread-safe para consultas."""
+
+    def __init__(self, geoms):
+        self.geoms = np.empty(len(geoms), dtype=object)
+        self.geoms[:] = geoms
+        shapely.prepare(self.geoms)
+        self.arbol = STRtree(self.geoms)
+
+    def puntos_en_poligonos(self, lon, lat):
+        """Pares (i_punto, i_poligono) de cada punto (arrays lon/lat) con
+        cada poligono que lo contiene (borde incluido), ordenados por punto."""
+        puntos = shapely.points(lon, lat)
+        i_pt, i_geom = self.arbol.query(puntos)
+        if len(i_pt):
+            dentro = shapely.intersects(self.geoms[i_geom], puntos[i_pt])
+            i_pt, i_geom = i_pt[dentro], i_geom[dentro]
+        return i_pt, i_geom
+
+    def primer_poligono(self, lon, lat):
+        """Para cada punto, el indice del primer poligono que lo contiene
+        (-1 si ninguno; un punto en el borde compartido de dos poligonos
+        matchea ambos y se queda con el primero). "Primer match" sale de
+        np.unique(return_index=True) sobre los pares, sin loop de Python."""
+        resultado = np.full(len(lon), -1, dtype=np.intp)
+        i_pt, i_geom = self.puntos_en_poligonos(lon, lat)
+        puntos_con_match, primero = np.unique(i_pt, return_index=True)
+        resultado[puntos_con_match] = i_geom[primero]
+        return resultado
+
+    def intersectan(self, geom):
+        """Indices de los poligonos que intersectan 'geom'."""
+        return self.arbol.query(geom, predicate="intersects")
+
+
+class IndiceConCeldas(IndiceEspacial):
+    """IndiceEspacial con cache por celda de grilla para primer_poligono.
+
+    Las sondas de drive-test mandan muchisimas muestras casi en el mismo
+    lugar. Cada punto se lleva a su celda (TAMANO_CELDA_GRADOS, ~110 m) y
+    cada celda se clasifica UNA vez: si cae entera dentro de un unico
+    poligono, todos sus puntos son de ese poligono sin consultar GEOS; si no
+    toca ninguno, todos quedan en -1; solo los puntos de celdas de FRONTERA
+    (que tocan un borde) van al point-in-polygon exacto. El resultado es
+    identico al de IndiceEspacial.
+
+    El cache (claves de celda ordenadas + valor, busqueda con searchsorted)
+    vive lo que vive el indice, y se comparte entre sesiones y consultas."""
+
+    def __init__(self, geoms, tamano_celda=None):
+        super().__init__(geoms)
+        self.tamano_celda = tamano_celda or TAMANO_CELDA_GRADOS
+        self._cache = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.intp))
+        self._lock = threading.Lock()
+
+    def _celdas(self, lon, lat):
+        ix = np.floor((np.asarray(lon) + 180.0) / self.tamano_celda).astype(np.int64)
+        iy = np.floor((np.asarray(lat) + 90.0) / self.tamano_celda).astype(np.int64)
+        return ix, iy, (ix << 32) | iy
+
+    def _clasificar(self, ix, iy):
+        """Valor de cada celda nueva: i si cae entera dentro del poligono i
+        (y no toca ningun otro), -1 si no toca ninguno, CELDA_FRONTERA si no."""
+        t = self.tamano_celda
+        cajas = shapely.box(ix * t - 180.0, iy * t - 90.0, (ix + 1) * t - 180.0, (iy + 1) * t - 90.0)
+        i_caja, i_geom = self.arbol.query(cajas, predicate="intersects")
+        n_toques = np.bincount(i_caja, minlength=len(cajas))
+        valores = np.where(n_toques == 0, -1, CELDA_FRONTERA).astype(np.intp)
+        unico = n_toques[i_caja] == 1
+        i_caja, i_geom = i_caja[unico], i_geom[unico]
+        # contains_properly (no solo contains): deja margen para el redondeo
+        # entre el floor de los puntos y los bordes de la caja.
+        dentro = shapely.contains_properly(self.geoms[i_geom], cajas[i_caja])
+        valores[i_caja[dentro]] = i_geom[dentro]
+        return valores
+
+    def _buscar(self, claves):
+        conocidas, valores_conocidos = self._cache
+        valores = np.full(len(claves), CELDA_DESCONOCIDA, dtype=np.intp)
+        if len(conocidas):
+            pos = np.minimum(np.searchsorted(conocidas, claves), len(conocidas) - 1)
+            encontradas = conocidas[pos] == claves
+            valores[encontradas] = valores_conocidos[pos[encontradas]]
+        return valores
+
+    def _guardar(self, claves, valores):
+        with self._lock:
+            conocidas, valores_conocidos = self._cache
+            todas, primera = np.unique(np.concatenate([conocidas, claves]), return_index=True)
+            self._cache = (todas, np.concatenate([valores_conocidos, valores])[primera])
+
+    def primer_poligono(self, lon, lat):
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        ix, iy, claves = self._celdas(lon, lat)
+        celdas, primera, inversa = np.unique(claves, return_index=True, return_inverse=True)
+        valores = self._buscar(celdas)
+        nuevas = valores == CELDA_DESCONOCIDA
+        if nuevas.any():
+            valores[nuevas] = self._clasificar(ix[primera[nuevas]], iy[primera[nuevas]])
+            self._guardar(celdas[nuevas], valores[nuevas])
+        resultado = valores[inversa]
+        frontera = resultado == CELDA_FRONTERA
+        if frontera.any():
+            resultado[frontera] = super().primer_poligono(lon[frontera], lat[frontera])
+        return resultado
+
+
+@st.cache_resource(show_spinner=False)
+def indice_distritos(version=None):
+    """IndiceConCeldas de los distritos de distritos_version(version), en
+    el mismo orden (los indices que devuelve sirven para la lista de
+    cargar_distritos_wfs de esa version)."""
+    return IndiceConCeldas([d["geometry"] for d in distritos_version(version)])
+
+
+# Indice de cada proceso del pool de _primer_poligono_en_procesos (se arma
+# una vez por proceso, en el initializer, a partir del WKB de los distritos).
+_INDICE_PROCESO = None
+
+
+def _iniciar_proceso(geoms_wkb):
+    global _INDICE_PROCESO
+    _INDICE_PROCESO = IndiceConCeldas(shapely.from_wkb(geoms_wkb))
+
+
+def _primer_poligono_bloque(lon, lat):
+    return _INDICE_PROCESO.primer_poligono(lon, lat)
+
+
+def _primer_poligono_en_procesos(geoms, lon, lat, procesos):
+    """IndiceConCeldas.primer_poligono repartido en un pool de 'procesos'.
+    Los distritos viajan UNA vez por proceso (como WKB, en el initializer)
+    y cada bloque solo lleva sus arrays lon/lat; executor.map devuelve los
+    bloques en orden, asi que el resultado es el mismo que en un proceso.
+    Se usa "spawn": hacer fork del servidor de Streamlit (con hilos vivos)
+    puede dejar locks tomados en el hijo."""
+    geoms_wkb = shapely.to_wkb(geoms)
+    cortes = range(0, len(lon), FILAS_POR_BLOQUE)
+    with ProcessPoolExecutor(
+        max_workers=procesos, mp_context=multiprocessing.get_context("spawn"),
+        initializer=_iniciar_proceso, initargs=(geoms_wkb,),
+    ) as pool:
+        bloques = pool.map(
+            _primer_poligono_bloque,
+            [lon[i:i + FILAS_POR_BLOQUE] for i in cortes],
+            [lat[i:i + FILAS_POR_BLOQUE] for i in cortes],
+        )
+        return np.concatenate(list(bloques))
+
+
+def _primer_poligono_adaptativo(indice, lon, lat, procesos):
+    """indice.primer_poligono resolviendo el primer bloque (FILAS_POR_BLOQUE)
+    aca y midiendo cuanto tardo: el resto se reparte entre hasta 'procesos'
+    solo si lo estimado en paralelo (ARRANQUE_PROCESOS_SEG + resto /
+    procesos) sale menos que seguir en este proceso. Se mide en vez de fijar
+    un umbral de filas porque el costo por fila cambia ~20x segun lo
+    concentradas que esten las muestras."""
+    t0 = time.perf_counter()
+    primero = indice.primer_poligono(lon[:FILAS_POR_BLOQUE], lat[:FILAS_POR_BLOQUE])
+    por_fila = (time.perf_counter() - t0) / max(len(primero), 1)
+    lon_resto, lat_resto = lon[FILAS_POR_BLOQUE:], lat[FILAS_POR_BLOQUE:]
+    estimado_aca = por_fila * len(lon_resto)
+    procesos = min(procesos, -(-len(lon_resto) // FILAS_POR_BLOQUE))
+    if procesos > 1 and ARRANQUE_PROCESOS_SEG + estimado_aca / procesos < estimado_aca:
+        resto = _primer_poligono_en_procesos(indice.geoms, lon_resto, lat_resto, procesos)
+    else:
+        resto = indice.primer_poligono(lon_resto, lat_resto)
+    return np.concatenate([primero, resto])
+
+
+def cpus_disponibles():
+    """CPUs que este proceso puede usar de verdad: las de su afinidad
+    (os.cpu_count() cuenta todas las del host) y, en un contenedor con
+    limite de CPU (cgroup v2, cpu.max), la cuota redondeada hacia abajo."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # macOS / Windows
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            cuota, periodo = f.read().split()
+        if cuota != "max":
+            cpus = min(cpus, max(1, int(cuota) // int(periodo)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def _columna_por_poligono(poligonos, campo, poligono_por_fila):
+    """Columna category con poligonos[i][campo] para cada fila (i =
+    poligono_por_fila, -1 = sin poligono -> NaN), armada con un take de
+    NumPy sobre los codigos: sin loop por fila."""
+    codigos, categorias = pd.factorize(pd.Series([p[campo] for p in poligonos], dtype=object))
+    codigos = np.append(codigos, -1)  # posicion extra para las filas sin poligono (-1)
+    return pd.Categorical.from_codes(codigos[poligono_por_fila], categories=categorias)
+
+
+def asignar_distritos(df, distritos, col_lat="latitude", col_lon="longitude", indice=None, procesos=1):
+    """Spatial join: asigna cada muestra a su distrito (columnas distrito,
+    canton, provincia y codigo_dta, como category; NaN si la muestra no
+    tiene coordenadas validas o cae fuera de todos los distritos). Es
+    asignar_poligonos con los campos de CAMPOS_DISTRITO.
+
+    Todo el camino es vectorizado: los puntos se arman de una vez
+    (shapely.points, en C), el indice los resuelve en un solo batch, el
+    "primer match gana" sale de np.unique(return_index=True) sobre los pares
+    (ordenados por punto) y los atributos se copian con un take de NumPy.
+    Antes esos dos ultimos pasos eran un loop de Python por par y por fila,
+    que en las consultas anuales (cientos de miles de muestras) era lo que
+    mas tardaba; `python medux_geo.py bench` compara ambos.
+
+    'indice' (indice_distritos, de la misma version que 'distritos') evita
+    rearmar el STRtree en cada llamada, y con su cache por celda la mayoria
+    de las muestras de un recorrido ni siquiera llegan a GEOS; sin el se
+    arma un IndiceEspacial para 'distritos'.
+
+    Con procesos > 1 (acotado a cpus_disponibles()) y al menos
+    MIN_FILAS_PARALELO muestras validas (el consolidado anual), el join se
+    puede repartir en bloques entre varios procesos si compensa (ver
+    _primer_poligono_adaptativo); el resultado es el mismo.
+    """
+    return asignar_poligonos(
+        df, distritos, {campo: campo for campo in CAMPOS_DISTRITO},
+        col_lat=col_lat, col_lon=col_lon, indice=indice, procesos=procesos,
+    )
+
+
+def asignar_poligonos(df, poligonos, columnas, col_lat="latitude", col_lon="longitude", indice=None, procesos=1):
+    """Spatial join generico de asignar_distritos: para cada muestra, el
+    primer poligono de 'poligonos' (dicts con 'geometry') que la contiene, y
+    por cada {columna: campo} de 'columnas' una columna category con
+    poligono[campo] (NaN si no cae en ninguno). 'indice' debe ser de las
+    mismas geometrias, en el mismo orden."""
+    df = df.copy()
+    poligono_por_fila = np.full(len(df), -1, dtype=np.intp)
+    if len(df) and poligonos and col_lat in df.columns and col_lon in df.columns:
+        lat_arr = pd.to_numeric(df[col_lat], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+        lon_arr = pd.to_numeric(df[col_lon], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+        validos = ~np.isnan(lat_arr) & ~np.isnan(lon_arr) & ~((lat_arr == 0) & (lon_arr == 0))
+        if validos.any():
+            idx_validos = np.flatnonzero(validos)
+            lon_validos, lat_validos = lon_arr[idx_validos], lat_arr[idx_validos]
+            if indice is None:
+                indice = IndiceEspacial([p["geometry"] for p in poligonos])
+            procesos = min(procesos, cpus_disponibles())
+            if procesos > 1 and len(idx_validos) >= MIN_FILAS_PARALELO:
+                poligono_por_fila[idx_validos] = _primer_poligono_adaptativo(indice, lon_validos, lat_validos, procesos)
+            else:
+                poligono_por_fila[idx_validos] = indice.primer_poligono(lon_validos, lat_validos)
+    for columna, campo in columnas.items():
+        df[columna] = _columna_por_poligono(poligonos, campo, poligono_por_fila)
+    return df
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ["bench"]:
+        # Micro-benchmark de asignar_distritos: resolucion de matches con el
+        # loop de Python que tenia cada script vs el camino NumPy, sobre una
+        # grilla sintetica de 500 "distritos" que cubre Costa Rica; y punto ->
+        # distrito exacto vs con cache por celda en un recorrido movil.
+        from shapely.geometry import box
+
+        def _resolver_con_loop(df, distritos, indice, idx_validos, lat_arr, lon_arr):
+            pares = indice.puntos_en_poligonos(lon_arr[idx_validos], lat_arr[idx_validos])
+            asignado = {}
+            for i_pt, i_geom in zip(pares[0], pares[1]):
+                idx_original = idx_validos[i_pt]
+                if idx_original not in asignado:
+                    asignado[idx_original] = i_geom
+            columnas = {campo: [None] * len(df) for campo in CAMPOS_DISTRITO}
+            for idx_original, i_geom in asignado.items():
+                for campo in CAMPOS_DISTRITO:
+                    columnas[campo][idx_original] = distritos[i_geom][campo]
+            for campo, valores in columnas.items():
+                df[campo] = valores
+            return df
+
+        lon0, lat0, paso = -86.0, 8.0, 0.15
+        distritos = [
+            {
+                "distrito": f"D{i}-{j}", "canton": f"C{i}", "provincia": f"P{i // 5}", "codigo_dta": 10_000 + 25 * i + j,
+                "geometry": box(lon0 + j * paso, lat0 + i * paso, lon0 + (j + 1) * paso, lat0 + (i + 1) * paso),
+            }
+            for i in range(20) for j in range(25)
+        ]
+        indice = IndiceEspacial([d["geometry"] for d in distritos])
+        rng = np.random.default_rng(0)
+        for n in (30_000, 300_000, 3_000_000):
+            df = pd.DataFrame({
+                "latitude": rng.uniform(lat0, lat0 + 20 * paso, n),
+                "longitude": rng.uniform(lon0, lon0 + 25 * paso, n),
+            })
+            idx = np.arange(n)
+            t0 = time.perf_counter()
+            _resolver_con_loop(df.copy(), distritos, indice, idx, df["latitude"].to_numpy(), df["longitude"].to_numpy())
+            t_loop = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            asignar_distritos(df, distritos, indice=indice)
+            t_numpy = time.perf_counter() - t0
+            print(f"{n:>10,} puntos   loop {t_loop:7.3f}s   numpy {t_numpy:7.3f}s   ({t_loop / t_numpy:4.1f}x)")
+
+        # Cache por celda (IndiceConCeldas) sobre un recorrido de drive-test
+        # (caminata aleatoria: muchas muestras casi en el mismo lugar).
+        print()
+        for n in (300_000, 3_000_000):
+            pasos = rng.normal(0.0, 0.0003, (n, 2)).cumsum(axis=0)
+            lon, lat = -84.5 + pasos[:, 0], 9.8 + pasos[:, 1]
+            t0 = time.perf_counter()
+            exacto = indice.primer_poligono(lon, lat)
+            t_exacto = time.perf_counter() - t0
+            con_celdas = IndiceConCeldas([d["geometry"] for d in distritos])
+            tiempos = []
+            for _ in range(2):  # cache vacio, cache ya poblado
+                t0 = time.perf_counter()
+                resultado = con_celdas.primer_poligono(lon, lat)
+                tiempos.append(time.perf_counter() - t0)
+            assert (resultado == exacto).all()
+            print(f"{n:>10,} puntos (recorrido)   exacto {t_exacto:7.3f}s   "
+                  f"celdas {tiempos[0]:7.3f}s (frio) / {tiempos[1]:7.3f}s (cache)")
+
+        # Join en varios procesos: arranque de un proceso "spawn" (import +
+        # indice desde WKB, con un bloque minimo) y costo por fila en un solo
+        # proceso, para puntos dispersos (peor caso) y un recorrido. El punto
+        # de equilibrio con P procesos es arranque / (costo * (1 - 1/P)).
+        print()
+        geoms = [d["geometry"] for d in distritos]
+        t0 = time.perf_counter()
+        _primer_poligono_en_procesos(geoms, np.array([-84.5]), np.array([9.8]), 1)
+        arranque = time.perf_counter() - t0
+        n = 1_000_000
+        pasos = rng.normal(0.0, 0.0003, (n, 2)).cumsum(axis=0)
+        casos = {
+            "dispersos": (rng.uniform(lon0, lon0 + 25 * paso, n), rng.uniform(lat0, lat0 + 20 * paso, n)),
+            "recorrido": (-84.5 + pasos[:, 0], 9.8 + pasos[:, 1]),
+        }
+        cpus = cpus_disponibles()
+        print(f"arranque de un proceso {arranque:6.3f}s   (ARRANQUE_PROCESOS_SEG = {ARRANQUE_PROCESOS_SEG}), "
+              f"{cpus} CPU(s) disponibles")
+        for nombre, (lon, lat) in casos.items():
+            t0 = time.perf_counter()
+            IndiceConCeldas(geoms).primer_poligono(lon, lat)
+            por_fila = (time.perf_counter() - t0) / n
+            equilibrio = "  ".join(
+                f"P={p}: {arranque / (por_fila * (1 - 1 / p)):>12,.0f} filas" for p in (2, 4, 8)
+            )
+            print(f"{nombre:<10} {por_fila * 1e6:6.2f} us/fila   equilibrio  {equilibrio}")
+            if cpus > 1:
+                df = pd.DataFrame({"latitude": np.tile(lat, 3), "longitude": np.tile(lon, 3)})
+                for procesos in (1, cpus):
+                    t0 = time.perf_counter()
+                    asignar_distritos(df, distritos, indice=IndiceConCeldas(geoms), procesos=procesos)
+                    print(f"    {len(df):,} filas   procesos={procesos}   {time.perf_counter() - t0:7.3f}s")
+    else:
+        # Baja la capa y la deja en geo/ (junto al codigo) para incluirla en el
+        # despliegue.
+        info = guardar_distritos(descargar_distritos_wfs(), directorio=DIRECTORIO_GEO_INCLUIDO)
+        print(f"{info['n_distritos']} distritos -> {os.path.join(DIRECTORIO_GEO_INCLUIDO, info['archivo'])}")
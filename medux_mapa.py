@@ -0,0 +1,796 @@
+"""
+Medux Mapa - capas de folium compartidas por los mapas de distritos
+===================================================================
+Piezas de construir_mapa que son iguales en Conteo_Agregado_mapa.py,
+Muestras_Mapa_Conteo.py y Mapa_seguimiento_RACSA.py.
+
+Muestras individuales ("Mostrar muestras individuales sobre el mapa"):
+antes cada script armaba un Feature de GeoJSON por muestra con
+df.iterrows() (un dict de Python por fila, hasta 200k) y folium.GeoJson lo
+volvia a recorrer llamando a style_function por feature para armar su
+mapa de estilos; con 100k+ puntos eso eran varios segundos antes de que se
+viera el mapa.
+
+Ahora:
+    - agregar_puntos() arma la capa como COLUMNAS (lon, lat y un codigo
+      entero de ISP/program/distrito por muestra, mas las listas de valores
+      y el color de cada ISP) directamente de los arrays de NumPy, sin loop
+      por fila en Python, y las serializa en una sola llamada (orjson si
+      esta instalado).
+    - En el navegador, CapaPuntos recorre esas columnas y crea los
+      circleMarker sobre el canvas del mapa (prefer_canvas=True) con el
+      color ya resuelto: no hay style_function por feature, y el tooltip es
+      uno solo para toda la capa (se arma al pasar el cursor).
+    - Por encima de 'limite_puntos_mapa' (ese JSON sigue creciendo ~26
+      bytes por muestra) queda el modo WebGL, agregar_puntos_webgl(): las
+      muestras viajan como un buffer binario (Float32 lon, Float32 lat y un
+      uint8 con el codigo de ISP = 9 bytes por muestra, en base64) y las
+      dibuja la GPU (CapaPuntosWebGL, sin librerias externas), asi que un
+      consolidado anual de 1M+ muestras se puede ver entero. No tiene
+      tooltip por muestra.
+    - Modo agregado, agregar_celdas(): en vez de muestras sueltas, celdas
+      hexagonales con el conteo y el desglose por ISP de cada una,
+      calculadas con NumPy sobre latitude/longitude (Web Mercator, varios
+      tamanos de celda). El navegador muestra el tamano que corresponde al
+      zoom, asi que la densidad se ve igual con cientos de miles de
+      muestras y el HTML depende de las celdas, no de las muestras.
+
+Capa de distritos (choropleth): antes, en cada rerun (cualquier click en un
+filtro), folium.GeoJson volvia a serializar los 494 poligonos a un JSON de
+varios MB aunque solo cambiaran los conteos o el resaltado.
+
+Ahora:
+    - geometria_distritos() serializa la geometria (TopoJSON, ver abajo)
+      UNA vez por version de la capa y nivel de simplificacion, con solo
+      las propiedades fijas de cada distrito, y queda compartida entre
+      sesiones (st.cache_resource).
+    - agregar_distritos() le agrega por rerun solo arrays chicos (conteo,
+      color de relleno, opacidad, resaltado: un valor por distrito) y
+      CapaDistritos los aplica en el navegador por indice de distrito.
+    - Los JSON grandes (geometria, columnas de puntos) no pasan por el
+      render de folium: branca vuelve a compilar como plantilla de jinja
+      cada script ya renderizado, y con varios MB eso era la mayor parte
+      del tiempo. Quedan como un marcador que renderizar_mapa() reemplaza
+      en el HTML final (usar renderizar_mapa(m), no m.get_root().render()).
+    - La geometria va como TopoJSON (topojson(), a partir de una
+      medux_geo.Topologia): cada borde compartido entre dos distritos viaja
+      una sola vez, en enteros cuantizados a PASO_TOPOJSON_GRADOS (~1 m) y
+      con cada vertice como diferencia del anterior, en vez de anillos
+      completos en dobles de 17 digitos. El navegador lo vuelve a GeoJSON
+      (un decodificador de ~30 lineas, sin librerias externas) antes de
+      dibujar. Lo mismo para las manchas de cobertura de RACSA
+      (agregar_topologia): la mancha y sus pedazos por distrito comparten
+      los arcos en una sola topologia.
+"""
+import base64
+import json
+import uuid
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from branca.element import MacroElement
+from jinja2 import Template
+
+from medux_geo import distritos_version, topologia_distritos
+
+try:
+    import orjson
+except ImportError:  # json estandar: mismo resultado, algo mas lento
+    orjson = None
+
+COLOR_ISP_DEFECTO = "#333333"
+COLOR_SIN_MUESTRAS = "#eeeeee"
+# Propiedades fijas de cada distrito que viajan con la geometria (tooltip).
+PROPIEDADES_DISTRITO = ("codigo_dta", "distrito", "canton", "provincia")
+# Tope del modo WebGL (~9 bytes por muestra en el buffer, ~12 en base64:
+# 2M muestras ~ 24 MB de HTML).
+LIMITE_PUNTOS_WEBGL = 2_000_000
+# Colores distintos que acepta el shader (uniform vec3[]): el ultimo queda
+# para las muestras sin ISP o con un ISP fuera de la paleta.
+MAX_COLORES_WEBGL = 32
+# Decimales de lon/lat en el HTML: 6 ~ 0.1 m, de sobra para dibujar.
+DECIMALES_COORDENADAS = 6
+# Modo agregado (agregar_celdas): radio de las celdas hexagonales en metros
+# de Web Mercator, de la mas gruesa a la mas fina (cada nivel la mitad del
+# anterior, siempre la misma grilla para que las celdas no "salten" al
+# cambiar el filtro). Se dejan de agregar niveles finos cuando uno pasa de
+# MAX_CELDAS_NIVEL celdas (poligonos en el navegador).
+TAMANOS_CELDA_M = tuple(250 * 2 ** k for k in range(7, -1, -1))
+MAX_CELDAS_NIVEL = 30_000
+# Radio minimo en pantalla (px) del nivel que se muestra para cada zoom.
+RADIO_MIN_CELDA_PX = 12
+ETIQUETA_SIN_ISP = "(sin ISP)"
+RADIO_TIERRA_M = 6378137.0
+# Cuantizacion de las coordenadas del TopoJSON: 1e-5 grados ~ 1.1 m, de
+# sobra para poligonos simplificados a metros.
+PASO_TOPOJSON_GRADOS = 1e-5
+
+# Decodificador de TopoJSON (arcos cuantizados + delta) a GeoJSON, comun a
+# CapaDistritos y CapaTopologia.
+_JS_TOPOJSON = """
+            function arcos_topojson(t) {
+                var sx = t.transform.scale[0], sy = t.transform.scale[1];
+                var tx = t.transform.translate[0], ty = t.transform.translate[1];
+                return t.arcs.map(function (arco) {
+                    var x = 0, y = 0;
+                    return arco.map(function (p) {
+                        x += p[0];
+                        y += p[1];
+                        return [x * sx + tx, y * sy + ty];
+                    });
+                });
+            }
+            function geojson_topojson(t, arcos, objeto) {
+                function anillo(indices) {
+                    var puntos = [];
+                    for (var k = 0; k < indices.length; k++) {
+                        var i = indices[k], a = i < 0 ? arcos[~i].slice().reverse() : arcos[i];
+                        for (var j = k > 0 ? 1 : 0; j < a.length; j++) { puntos.push(a[j]); }
+                    }
+                    return puntos;
+                }
+                return {type: "FeatureCollection", features: t.objects[objeto].geometries.map(function (g) {
+                    var geometria = null;
+                    if (g.type === "Polygon") {
+                        geometria = {type: "Polygon", coordinates: g.arcs.map(anillo)};
+                    } else if (g.type === "MultiPolygon") {
+                        geometria = {type: "MultiPolygon", coordinates: g.arcs.map(function (p) { return p.map(anillo); })};
+                    }
+                    return {type: "Feature", properties: g.properties, geometry: geometria};
+                })};
+            }
+"""
+
+
+def _diferir(m, texto):
+    """Guarda 'texto' en el mapa 'm' y devuelve el marcador que lo
+    reemplaza en renderizar_mapa (ver docstring del modulo)."""
+    marcador = f"__medux_{uuid.uuid4().hex}__"
+    m.__dict__.setdefault("_textos_diferidos", {})[marcador] = texto
+    return marcador
+
+
+def renderizar_mapa(m):
+    """HTML de pagina completa de 'm' (m.get_root().render()) con los
+    textos diferidos ya en su lugar."""
+    html = m.get_root().render()
+    for marcador, texto in m.__dict__.get("_textos_diferidos", {}).items():
+        html = html.replace(marcador, texto, 1)
+    return html
+
+
+def _a_json(datos):
+    """JSON de 'datos' (dicts/listas con arrays de NumPy) listo para
+    incrustar en un <script>."""
+    if orjson is not None:
+        texto = orjson.dumps(datos, option=orjson.OPT_SERIALIZE_NUMPY).decode("utf-8")
+    else:
+        texto = json.dumps(datos, default=lambda valor: valor.tolist())
+    return texto.replace("</", "<\\/")
+
+
+def _base64(array):
+    return base64.b64encode(np.ascontiguousarray(array).tobytes()).decode("ascii")
+
+
+def _rgb(color_hex):
+    """'#rrggbb' -> [r, g, b] en 0..1 (lo que espera el shader)."""
+    color_hex = color_hex.lstrip("#")
+    return [int(color_hex[i:i + 2], 16) / 255 for i in (0, 2, 4)]
+
+
+def _coordenadas(df_puntos):
+    """(lon, lat, validos) como arrays float de NumPy."""
+    lat = pd.to_numeric(df_puntos["latitude"], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+    lon = pd.to_numeric(df_puntos["longitude"], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+    return lon, lat, ~np.isnan(lat) & ~np.isnan(lon)
+
+
+def _codificar(serie, renombrar=None):
+    """(codigos int32 con -1 para NaN, lista de valores) de una columna, via
+    pd.factorize (sirve igual para object, str o category). 'renombrar'
+    (dict) se aplica a los valores distintos, no fila por fila."""
+    codigos, valores = pd.factorize(serie)
+    valores = [str(v) for v in valores]
+    if renombrar and valores:
+        codigos_nuevos, valores = pd.factorize(pd.Series([renombrar.get(v, v) for v in valores], dtype=object))
+        codigos = np.where(codigos >= 0, codigos_nuevos[codigos], -1)
+        valores = list(valores)
+    return codigos.astype(np.int32), valores
+
+
+class CapaPuntos(MacroElement):
+    """Capa de muestras a partir de columnas (ver agregar_puntos): un
+    circleMarker por muestra creado en JS, con el color de su ISP, y un
+    unico tooltip para toda la capa."""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function () {
+            var d = {{ this.datos }};
+            var capa = L.featureGroup();
+            for (var i = 0; i < d.lon.length; i++) {
+                var color = d.isp[i] < 0 ? d.color_defecto : d.colores[d.isp[i]];
+                var punto = L.circleMarker([d.lat[i], d.lon[i]], {
+                    radius: 3, color: color, fillColor: color, weight: 1, fillOpacity: 0.8
+                });
+                punto.i = i;
+                capa.addLayer(punto);
+            }
+            function texto(valores, codigo) {
+                var v = codigo < 0 ? "" : String(valores[codigo]);
+                return v.replace(/[&<>"]/g, function (c) {
+                    return {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"}[c];
+                });
+            }
+            capa.bindTooltip(function (punto) {
+                var i = punto.i;
+                return "<table>"
+                    + "<tr><th>ISP</th><td>" + texto(d.isps, d.isp[i]) + "</td></tr>"
+                    + "<tr><th>Program</th><td>" + texto(d.tests, d.test[i]) + "</td></tr>"
+                    + "<tr><th>Distrito</th><td>" + texto(d.distritos, d.distrito[i]) + "</td></tr>"
+                    + "</table>";
+            }, {sticky: true});
+            capa.addTo({{ this._parent.get_name() }});
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, datos):
+        super().__init__()
+        self._name = "CapaPuntos"
+        self.datos = datos
+
+
+def agregar_puntos(m, df_puntos, isp_nombres, isp_colores):
+    """Agrega a 'm' las muestras de df_puntos (latitude/longitude, con isp,
+    test y distrito para el tooltip) como una CapaPuntos. 'isp_nombres' y
+    'isp_colores' son el ISP_NAME_MAP / ISP_COLOR_MAP del script. Devuelve
+    la lista ordenada de ISPs dibujados (para la leyenda)."""
+    lon, lat, validos = _coordenadas(df_puntos)
+    if not validos.any():
+        return []
+    vacia = pd.Series(np.nan, index=df_puntos.index, dtype=object)
+    codigos = {}
+    valores = {}
+    for columna, renombrar in (("isp", isp_nombres), ("test", None), ("distrito", None)):
+        serie = df_puntos[columna] if columna in df_puntos.columns else vacia
+        codigos[columna], valores[columna] = _codificar(serie[validos], renombrar)
+
+    datos = {
+        "lon": np.round(lon[validos], DECIMALES_COORDENADAS),
+        "lat": np.round(lat[validos], DECIMALES_COORDENADAS),
+        "isp": codigos["isp"],
+        "test": codigos["test"],
+        "distrito": codigos["distrito"],
+        "isps": valores["isp"],
+        "tests": valores["test"],
+        "distritos": valores["distrito"],
+        "colores": [isp_colores.get(isp, COLOR_ISP_DEFECTO) for isp in valores["isp"]],
+        "color_defecto": COLOR_ISP_DEFECTO,
+    }
+    CapaPuntos(_diferir(m, _a_json(datos))).add_to(m)
+    return sorted(valores["isp"])
+
+
+class CapaPuntosWebGL(MacroElement):
+    """Capa de muestras dibujada con WebGL (gl.POINTS) a partir de los
+    buffers en base64 de agregar_puntos_webgl. El canvas cubre el mapa (sin
+    capturar el mouse) y se redibuja entero en cada move/zoom: las
+    posiciones se pasan una vez a Web Mercator relativas a la primera
+    muestra (Float32 sin perder precision), y el shader solo las escala y
+    desplaza. Sin WebGL cae a un canvas 2D (mas lento, mismo dibujo)."""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function () {
+            var mapa = {{ this._parent.get_name() }};
+            function decodificar(b64, Tipo) {
+                var bin = atob(b64), bytes = new Uint8Array(bin.length);
+                for (var i = 0; i < bin.length; i++) { bytes[i] = bin.charCodeAt(i); }
+                return new Tipo(bytes.buffer);
+            }
+            var lon = decodificar("{{ this.lon }}", Float32Array);
+            var lat = decodificar("{{ this.lat }}", Float32Array);
+            var isp = decodificar("{{ this.isp }}", Uint8Array);
+            var colores = {{ this.colores }};
+            var n = lon.length, radio = {{ this.radio }};
+
+            // Web Mercator normalizado (0..1, igual que L.CRS.EPSG3857 / 256 px),
+            // relativo a la primera muestra para no perder precision en Float32.
+            function mx(lo) { return (lo + 180) / 360; }
+            function my(la) {
+                var s = Math.sin(la * Math.PI / 180);
+                return 0.5 - Math.log((1 + s) / (1 - s)) / (4 * Math.PI);
+            }
+            var x0 = mx(lon[0]), y0 = my(lat[0]);
+            var pos = new Float32Array(2 * n);
+            for (var i = 0; i < n; i++) {
+                pos[2 * i] = mx(lon[i]) - x0;
+                pos[2 * i + 1] = my(lat[i]) - y0;
+            }
+
+            var canvas = document.createElement("canvas");
+            canvas.style.cssText = "position:absolute;top:0;left:0;pointer-events:none;z-index:450;";
+            mapa.getContainer().appendChild(canvas);
+            var gl = canvas.getContext("webgl", {premultipliedAlpha: true, antialias: false});
+            var programa = null;
+            if (gl) {
+                var vs = "attribute vec2 a_pos; attribute float a_isp;"
+                    + "uniform float u_escala; uniform vec2 u_desplazamiento; uniform vec2 u_tamano;"
+                    + "uniform float u_punto; uniform vec3 u_colores[{{ this.max_colores }}];"
+                    + "varying vec3 v_color;"
+                    + "void main() {"
+                    + "  vec2 px = a_pos * u_escala + u_desplazamiento;"
+                    + "  gl_Position = vec4(px.x / u_tamano.x * 2.0 - 1.0, 1.0 - px.y / u_tamano.y * 2.0, 0.0, 1.0);"
+                    + "  gl_PointSize = u_punto;"
+                    + "  v_color = u_colores[int(a_isp)];"
+                    + "}";
+                var fs = "precision mediump float; varying vec3 v_color;"
+                    + "void main() {"
+                    + "  if (length(gl_PointCoord - vec2(0.5)) > 0.5) { discard; }"
+                    + "  gl_FragColor = vec4(v_color * 0.8, 0.8);"
+                    + "}";
+                function shader(tipo, fuente) {
+                    var sh = gl.createShader(tipo);
+                    gl.shaderSource(sh, fuente);
+                    gl.compileShader(sh);
+                    return sh;
+                }
+                programa = gl.createProgram();
+                gl.attachShader(programa, shader(gl.VERTEX_SHADER, vs));
+                gl.attachShader(programa, shader(gl.FRAGMENT_SHADER, fs));
+                gl.linkProgram(programa);
+                if (!gl.getProgramParameter(programa, gl.LINK_STATUS)) { programa = null; }
+            }
+            if (programa) {
+                gl.useProgram(programa);
+                var buf = gl.createBuffer();
+                gl.bindBuffer(gl.ARRAY_BUFFER, buf);
+                gl.bufferData(gl.ARRAY_BUFFER, pos, gl.STATIC_DRAW);
+                var a_pos = gl.getAttribLocation(programa, "a_pos");
+                gl.enableVertexAttribArray(a_pos);
+                gl.vertexAttribPointer(a_pos, 2, gl.FLOAT, false, 0, 0);
+                var buf_isp = gl.createBuffer();
+                gl.bindBuffer(gl.ARRAY_BUFFER, buf_isp);
+                gl.bufferData(gl.ARRAY_BUFFER, isp, gl.STATIC_DRAW);
+                var a_isp = gl.getAttribLocation(programa, "a_isp");
+                gl.enableVertexAttribArray(a_isp);
+                gl.vertexAttribPointer(a_isp, 1, gl.UNSIGNED_BYTE, false, 0, 0);
+                gl.uniform3fv(gl.getUniformLocation(programa, "u_colores"), new Float32Array([].concat.apply([], colores)));
+                gl.enable(gl.BLEND);
+                gl.blendFunc(gl.ONE, gl.ONE_MINUS_SRC_ALPHA);
+            } else {
+                gl = null;
+                var ctx = canvas.getContext("2d");
+                var estilos = colores.map(function (c) {
+                    return "rgba(" + c.map(function (v) { return Math.round(v * 255); }).join(",") + ",0.8)";
+                });
+            }
+
+            function dibujar() {
+                var tam = mapa.getSize(), dpr = window.devicePixelRatio || 1;
+                if (canvas.width !== tam.x * dpr || canvas.height !== tam.y * dpr) {
+                    canvas.width = tam.x * dpr;
+                    canvas.height = tam.y * dpr;
+                    canvas.style.width = tam.x + "px";
+                    canvas.style.height = tam.y + "px";
+                }
+                var escala = 256 * Math.pow(2, mapa.getZoom());
+                var origen = mapa.getPixelBounds().min;
+                var dx = x0 * escala - origen.x, dy = y0 * escala - origen.y;
+                if (gl) {
+                    gl.viewport(0, 0, canvas.width, canvas.height);
+                    gl.clearColor(0, 0, 0, 0);
+                    gl.clear(gl.COLOR_BUFFER_BIT);
+                    gl.uniform1f(gl.getUniformLocation(programa, "u_escala"), escala);
+                    gl.uniform2f(gl.getUniformLocation(programa, "u_desplazamiento"), dx, dy);
+                    gl.uniform2f(gl.getUniformLocation(programa, "u_tamano"), tam.x, tam.y);
+                    gl.uniform1f(gl.getUniformLocation(programa, "u_punto"), 2 * radio * dpr);
+                    gl.drawArrays(gl.POINTS, 0, n);
+                } else {
+                    ctx.setTransform(dpr, 0, 0, dpr, 0, 0);
+                    ctx.clearRect(0, 0, tam.x, tam.y);
+                    for (var i = 0; i < n; i++) {
+                        var px = pos[2 * i] * escala + dx, py = pos[2 * i + 1] * escala + dy;
+                        if (px < -radio || py < -radio || px > tam.x + radio || py > tam.y + radio) { continue; }
+                        ctx.fillStyle = estilos[isp[i]];
+                        ctx.fillRect(px - radio, py - radio, 2 * radio, 2 * radio);
+                    }
+                }
+            }
+            var pendiente = false;
+            function redibujar() {
+                if (pendiente) { return; }
+                pendiente = true;
+                window.requestAnimationFrame(function () { pendiente = false; dibujar(); });
+            }
+            // Durante la animacion de zoom el resto del mapa se escala por CSS:
+            // el canvas se oculta y se vuelve a dibujar al terminar.
+            mapa.on("zoomstart", function () { canvas.style.visibility = "hidden"; });
+            mapa.on("zoomend", function () { canvas.style.visibility = "visible"; redibujar(); });
+            mapa.on("move resize viewreset", redibujar);
+            mapa.whenReady(redibujar);
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, lon, lat, isp, colores, radio=2):
+        super().__init__()
+        self._name = "CapaPuntosWebGL"
+        self.lon = lon
+        self.lat = lat
+        self.isp = isp
+        self.colores = colores
+        self.radio = radio
+        self.max_colores = MAX_COLORES_WEBGL
+
+
+def agregar_puntos_webgl(m, df_puntos, isp_nombres, isp_colores):
+    """Como agregar_puntos pero en modo WebGL (ver CapaPuntosWebGL): solo
+    posicion y color de ISP, sin tooltip, en un buffer binario de 9 bytes
+    por muestra. Devuelve la lista ordenada de ISPs dibujados."""
+    lon, lat, validos = _coordenadas(df_puntos)
+    if not validos.any():
+        return []
+    serie = df_puntos["isp"] if "isp" in df_puntos.columns else pd.Series(np.nan, index=df_puntos.index, dtype=object)
+    codigos, isps = _codificar(serie[validos], isp_nombres)
+    # El ultimo color de la paleta = sin ISP (o ISP de mas).
+    sin_isp = min(len(isps), MAX_COLORES_WEBGL - 1)
+    codigos = np.where((codigos < 0) | (codigos >= sin_isp), sin_isp, codigos).astype(np.uint8)
+    colores = [_rgb(isp_colores.get(isp, COLOR_ISP_DEFECTO)) for isp in isps[:sin_isp]]
+    colores += [_rgb(COLOR_ISP_DEFECTO)] * (MAX_COLORES_WEBGL - len(colores))
+    CapaPuntosWebGL(
+        _diferir(m, _base64(lon[validos].astype(np.float32))),
+        _diferir(m, _base64(lat[validos].astype(np.float32))),
+        _diferir(m, _base64(codigos)),
+        json.dumps(colores),
+    ).add_to(m)
+    return sorted(isps[:sin_isp])
+
+
+def _mercator(lon, lat):
+    """(x, y) en metros de Web Mercator (EPSG:3857, la proyeccion del mapa)."""
+    lat = np.clip(lat, -85.0511, 85.0511)
+    x = RADIO_TIERRA_M * np.radians(lon)
+    y = RADIO_TIERRA_M * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+
+def _celdas_hexagonales(x, y, tamano):
+    """Coordenadas axiales (q, r) enteras de la celda hexagonal (punta
+    arriba, radio 'tamano') que contiene cada punto x/y (redondeo cubico)."""
+    qf = (np.sqrt(3) / 3 * x - y / 3) / tamano
+    rf = 2 / 3 * y / tamano
+    sf = -qf - rf
+    q, r, s = np.round(qf), np.round(rf), np.round(sf)
+    dq, dr, ds = np.abs(q - qf), np.abs(r - rf), np.abs(s - sf)
+    corregir_q = (dq > dr) & (dq > ds)
+    corregir_r = ~corregir_q & (dr > ds)
+    q = np.where(corregir_q, -r - s, q)
+    r = np.where(corregir_r, -q - s, r)
+    return q.astype(np.int64), r.astype(np.int64)
+
+
+class CapaCeldas(MacroElement):
+    """Muestras agregadas en celdas hexagonales (ver agregar_celdas): un
+    nivel por tamano de celda; en cada zoom se muestra el mas fino cuyo
+    radio en pantalla llega a RADIO_MIN_CELDA_PX (los poligonos de cada
+    nivel se arman la primera vez que se usa). Color del ISP con mas
+    muestras en la celda, opacidad por conteo (escala logaritmica)."""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function () {
+            var mapa = {{ this._parent.get_name() }};
+            var d = {{ this.datos }};
+            var nisp = d.isps.length, raiz3 = Math.sqrt(3);
+            var metros_por_px_z0 = 2 * Math.PI * {{ this.radio_tierra }} / 256;
+            function texto(v) {
+                return String(v).replace(/[&<>"]/g, function (c) {
+                    return {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"}[c];
+                });
+            }
+            function vertices(q, r, s) {
+                var cx = s * raiz3 * (q + r / 2), cy = s * 1.5 * r, v = [];
+                for (var k = 0; k < 6; k++) {
+                    var a = Math.PI / 180 * (60 * k + 30);
+                    v.push(L.Projection.SphericalMercator.unproject(
+                        L.point(cx + s * Math.cos(a), cy + s * Math.sin(a))));
+                }
+                return v;
+            }
+            var capas = [];
+            function capa(j) {
+                if (capas[j]) { return capas[j]; }
+                var n = d.niveles[j], grupo = L.featureGroup(), log_max = Math.log(1 + n.maximo);
+                for (var c = 0; c < n.q.length; c++) {
+                    var total = 0, dominante = 0;
+                    for (var k = 0; k < nisp; k++) {
+                        var v = n.por_isp[c * nisp + k];
+                        total += v;
+                        if (v > n.por_isp[c * nisp + dominante]) { dominante = k; }
+                    }
+                    var color = d.colores[dominante];
+                    var celda = L.polygon(vertices(n.q[c], n.r[c], n.tamano), {
+                        color: color, weight: 0.5, fillColor: color,
+                        fillOpacity: 0.25 + 0.55 * Math.log(1 + total) / log_max
+                    });
+                    celda.c = c;
+                    celda.total = total;
+                    grupo.addLayer(celda);
+                }
+                grupo.bindTooltip(function (celda) {
+                    var filas = [];
+                    for (var k = 0; k < nisp; k++) {
+                        var v = n.por_isp[celda.c * nisp + k];
+                        if (v > 0) { filas.push([v, k]); }
+                    }
+                    filas.sort(function (a, b) { return b[0] - a[0]; });
+                    return "<table>"
+                        + "<tr><th>Muestras</th><td>" + celda.total + "</td></tr>"
+                        + filas.map(function (f) {
+                            return "<tr><th>" + texto(d.isps[f[1]]) + "</th><td>" + f[0] + "</td></tr>";
+                        }).join("")
+                        + "<tr><th>Celda</th><td>~" + texto(n.etiqueta) + "</td></tr>"
+                        + "</table>";
+                }, {sticky: true});
+                capas[j] = grupo;
+                return grupo;
+            }
+            var actual = null;
+            function elegir() {
+                var metros_por_px = metros_por_px_z0 / Math.pow(2, mapa.getZoom()), j = 0;
+                for (var k = 0; k < d.niveles.length; k++) {
+                    if (d.niveles[k].tamano / metros_por_px >= d.radio_min_px) { j = k; }
+                }
+                var nueva = capa(j);
+                if (nueva === actual) { return; }
+                if (actual) { mapa.removeLayer(actual); }
+                nueva.addTo(mapa);
+                actual = nueva;
+            }
+            mapa.on("zoomend", elegir);
+            mapa.whenReady(elegir);
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, datos):
+        super().__init__()
+        self._name = "CapaCeldas"
+        self.datos = datos
+        self.radio_tierra = RADIO_TIERRA_M
+
+
+def agregar_celdas(m, df_puntos, isp_nombres, isp_colores):
+    """Agrega a 'm' las muestras de df_puntos agregadas en celdas
+    hexagonales (CapaCeldas): por celda, el conteo por ISP, en cada tamano
+    de TAMANOS_CELDA_M hasta MAX_CELDAS_NIVEL. Todo con NumPy/pandas sobre
+    latitude/longitude, sin loop por muestra. Devuelve la lista ordenada de
+    ISPs presentes (para la leyenda: cada celda va del color de su ISP
+    dominante)."""
+    lon, lat, validos = _coordenadas(df_puntos)
+    if not validos.any():
+        return []
+    serie = df_puntos["isp"] if "isp" in df_puntos.columns else pd.Series(np.nan, index=df_puntos.index, dtype=object)
+    codigos, isps = _codificar(serie[validos], isp_nombres)
+    colores = [isp_colores.get(isp, COLOR_ISP_DEFECTO) for isp in isps]
+    if (codigos < 0).any():
+        codigos = np.where(codigos < 0, len(isps), codigos)
+        isps = isps + [ETIQUETA_SIN_ISP]
+        colores.append(COLOR_ISP_DEFECTO)
+    nisp = len(isps)
+    x, y = _mercator(lon[validos], lat[validos])
+
+    niveles = []
+    for tamano in TAMANOS_CELDA_M:
+        q, r = _celdas_hexagonales(x, y, tamano)
+        # Una clave int64 por celda (r cabe de sobra en 32 bits) y
+        # pd.factorize (hash, sin ordenar) para numerarlas.
+        celda, claves = pd.factorize((q << 32) + r)
+        if niveles and len(claves) > MAX_CELDAS_NIVEL:
+            break
+        por_isp = np.bincount(celda * nisp + codigos, minlength=len(claves) * nisp)
+        q_celda = (claves + (1 << 31)) >> 32
+        niveles.append({
+            "tamano": tamano,
+            "etiqueta": f"{tamano / 1000:g} km" if tamano >= 1000 else f"{tamano} m",
+            "q": q_celda,
+            "r": claves - (q_celda << 32),
+            "por_isp": por_isp,
+            "maximo": int(por_isp.reshape(-1, nisp).sum(axis=1).max()),
+        })
+
+    datos = {
+        "niveles": niveles,
+        "isps": isps,
+        "colores": colores,
+        "radio_min_px": RADIO_MIN_CELDA_PX,
+    }
+    CapaCeldas(_diferir(m, _a_json(datos))).add_to(m)
+    return sorted(isp for isp in isps if isp != ETIQUETA_SIN_ISP)
+
+
+def topojson(topologia, tolerancia_m, objetos):
+    """Texto TopoJSON del nivel de 'topologia' (medux_geo.Topologia) mas
+    cercano a 'tolerancia_m'. 'objetos' = {nombre: lista de propiedades, una
+    por geometria}: las geometrias de la topologia se reparten en ese orden
+    (la suma de los largos debe dar el total). Coordenadas cuantizadas a
+    PASO_TOPOJSON_GRADOS y delta-codificadas (TopoJSON estandar)."""
+    arcos = topologia.arcos(tolerancia_m)
+    base = np.floor(np.concatenate(arcos).min(axis=0) / PASO_TOPOJSON_GRADOS) if arcos else np.zeros(2)
+    cuantizados = []
+    for arco in arcos:
+        grilla = np.round(arco / PASO_TOPOJSON_GRADOS - base).astype(np.int64)
+        deltas = np.diff(grilla, axis=0)
+        deltas = deltas[deltas.any(axis=1)]
+        if not len(deltas):  # arco de menos de un paso: queda de 2 puntos
+            deltas = np.zeros((1, 2), dtype=np.int64)
+        cuantizados.append(np.concatenate([grilla[:1], deltas]))
+
+    geometrias = iter(topologia.geometrias)
+    objetos_topojson = {}
+    for nombre, propiedades in objetos.items():
+        lista = []
+        for p in propiedades:
+            partes = next(geometrias)
+            if not partes:
+                g = {"type": None}
+            elif len(partes) == 1:
+                g = {"type": "Polygon", "arcs": partes[0]}
+            else:
+                g = {"type": "MultiPolygon", "arcs": partes}
+            g["properties"] = p
+            lista.append(g)
+        objetos_topojson[nombre] = {"type": "GeometryCollection", "geometries": lista}
+    return _a_json({
+        "type": "Topology",
+        "transform": {
+            "scale": [PASO_TOPOJSON_GRADOS, PASO_TOPOJSON_GRADOS],
+            "translate": [float(v) * PASO_TOPOJSON_GRADOS for v in base],
+        },
+        "objects": objetos_topojson,
+        "arcs": cuantizados,
+    })
+
+
+def _propiedades_distritos(distritos):
+    return [dict({c: d.get(c) for c in PROPIEDADES_DISTRITO}, i=i) for i, d in enumerate(distritos)]
+
+
+@st.cache_resource(show_spinner=False)
+def _geometria_distritos(version, nivel):
+    propiedades = _propiedades_distritos(distritos_version(version))
+    return topojson(topologia_distritos(version), nivel, {"distritos": propiedades})
+
+
+def geometria_distritos(version, tolerancia_m):
+    """TopoJSON (texto, objeto "distritos") de los distritos de
+    distritos_version(version) en el nivel de simplificacion mas cercano a
+    'tolerancia_m', con PROPIEDADES_DISTRITO + 'i' (su posicion en la
+    lista). Se serializa una vez por (version, nivel) y se comparte entre
+    sesiones: mismo orden que cargar_distritos_wfs de cada script."""
+    return _geometria_distritos(version, topologia_distritos(version).nivel(tolerancia_m))
+
+
+class CapaDistritos(MacroElement):
+    """Choropleth de distritos: la geometria (TopoJSON ya serializado, ver
+    geometria_distritos) y los arrays de estilo por distrito van por
+    separado; el estilo y el tooltip de cada poligono salen de su indice."""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function () {
+            {{ this.js_topojson }}
+            var e = {{ this.estilos }};
+            var t = {{ this.geometria }};
+            var geometria = geojson_topojson(t, arcos_topojson(t), "distritos");
+            function texto(v) {
+                return (v === null || v === undefined ? "" : String(v)).replace(/[&<>"]/g, function (c) {
+                    return {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"}[c];
+                });
+            }
+            var capa = L.geoJson(geometria, {
+                style: function (f) {
+                    var i = f.properties.i, r = e.resaltado[i];
+                    return {
+                        fillColor: e.relleno[i], fillOpacity: e.opacidad[i],
+                        color: r ? "#2b6cb0" : "#555555", weight: r ? 3 : 0.4
+                    };
+                }
+            });
+            capa.bindTooltip(function (poligono) {
+                var p = poligono.feature.properties;
+                return "<table>"
+                    + "<tr><th>Codigo DTA</th><td>" + texto(p.codigo_dta) + "</td></tr>"
+                    + "<tr><th>Distrito</th><td>" + texto(p.distrito) + "</td></tr>"
+                    + "<tr><th>Canton</th><td>" + texto(p.canton) + "</td></tr>"
+                    + "<tr><th>Provincia</th><td>" + texto(p.provincia) + "</td></tr>"
+                    + "<tr><th>Pruebas</th><td>" + e.conteo[p.i] + "</td></tr>"
+                    + "</table>";
+            }, {sticky: true});
+            capa.addTo({{ this._parent.get_name() }});
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, geometria, estilos):
+        super().__init__()
+        self._name = "CapaDistritos"
+        self.geometria = geometria
+        self.estilos = estilos
+        self.js_topojson = _JS_TOPOJSON
+
+
+def agregar_distritos(m, distritos, conteo_por_distrito, distritos_resaltados, colormap, geometria):
+    """Agrega el choropleth de 'distritos' a 'm'. Por rerun solo se calcula
+    el estilo de cada distrito (conteo_por_distrito y distritos_resaltados
+    usan la clave (distrito, canton, provincia); 'colormap' de branca da el
+    color por conteo). 'geometria' = geometria_distritos(...) de la misma
+    version que 'distritos' (mismo orden)."""
+    conteo, relleno, opacidad, resaltado = [], [], [], []
+    for d in distritos:
+        clave = (d["distrito"], d["canton"], d["provincia"])
+        cantidad = int(conteo_por_distrito.get(clave, 0))
+        conteo.append(cantidad)
+        relleno.append(colormap(cantidad) if cantidad > 0 else COLOR_SIN_MUESTRAS)
+        opacidad.append(0.65 if cantidad > 0 else 0.12)
+        resaltado.append(1 if clave in distritos_resaltados else 0)
+    estilos = {"conteo": conteo, "relleno": relleno, "opacidad": opacidad, "resaltado": resaltado}
+    CapaDistritos(_diferir(m, geometria), json.dumps(estilos)).add_to(m)
+
+
+class CapaTopologia(MacroElement):
+    """Una o mas capas de poligonos de una misma topologia (texto TopoJSON,
+    ver topojson): los arcos viajan y se decodifican una sola vez, y cada
+    capa dibuja un objeto con estilo fijo y, si tiene campos, un tooltip de
+    tabla (alias: valor, como folium.GeoJsonTooltip). Las capas se agregan
+    en orden (la ultima queda arriba)."""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function () {
+            {{ this.js_topojson }}
+            var mapa = {{ this._parent.get_name() }};
+            var t = {{ this.topologia }};
+            var capas = {{ this.capas }};
+            var arcos = arcos_topojson(t);
+            function texto(v) {
+                return (v === null || v === undefined ? "" : String(v)).replace(/[&<>"]/g, function (c) {
+                    return {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"}[c];
+                });
+            }
+            capas.forEach(function (c) {
+                var capa = L.geoJson(geojson_topojson(t, arcos, c.objeto), {
+                    style: function () { return c.estilo; }
+                });
+                if (c.campos.length) {
+                    capa.bindTooltip(function (poligono) {
+                        var p = poligono.feature.properties;
+                        return "<table>" + c.campos.map(function (campo, k) {
+                            return "<tr><th>" + texto(c.alias[k]) + "</th><td>" + texto(p[campo]) + "</td></tr>";
+                        }).join("") + "</table>";
+                    }, {sticky: true});
+                }
+                capa.addTo(mapa);
+            });
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, topologia, capas):
+        super().__init__()
+        self._name = "CapaTopologia"
+        self.topologia = topologia
+        self.capas = capas
+        self.js_topojson = _JS_TOPOJSON
+
+
+def agregar_topologia(m, topologia, capas):
+    """Agrega a 'm' los objetos de 'topologia' (texto de topojson()) como
+    una CapaTopologia. 'capas' = lista de dicts {"objeto", "estilo" (dict
+    de estilo de Leaflet), "campos" y "alias" (tooltip; listas vacias = sin
+    tooltip)}, de abajo hacia arriba."""
+    CapaTopologia(_diferir(m, topologia), _a_json(capas)).add_to(m)
@@ -0,0 +1,370 @@
+"""
+Medux API - store local en disco (Parquet) de resultados ya descargados
+======================================================================
+Antes el unico cache era @st.cache_data(ttl=1800) sobre obtener_datos_pag:
+en memoria, por proceso, se perdia en cada redeploy y usaba el body literal
+como clave, asi que dos rangos solapados no compartian nada.
+
+Ahora todos los dashboards piden sus datos historicos por
+obtener_resultados(), que:
+    - Guarda lo descargado en archivos Parquet particionados por filtros de
+      la consulta (sondas + condiciones + formato), program y dia:
+          <DIRECTORIO_STORE>/<clave filtros>/<program>/dia=YYYY-MM-DD/<a>_<b>.parquet
+      donde <a>_<b> es el tramo (ms) de la peticion que lo trajo.
+    - Lleva por cada (filtros, program) un manifiesto "cobertura.json" con
+      los intervalos de tiempo YA descargados completos. Solo se piden a la
+      API los huecos que faltan (partidos en tramos, ver medux_tramos), y lo
+      demas se lee de disco.
+    - Solo se guardan tramos "cerrados" (anteriores a ahora menos
+      MARGEN_TRAMO_ABIERTO_SEG): la ultima hora puede seguir recibiendo
+      muestras que las sondas suben con retraso, asi que siempre se re-baja
+      y nunca se marca como cubierta.
+    - Cada tramo se guarda apenas TODOS sus cursores terminan bien: una
+      consulta cortada (error, limite de filas, redeploy) conserva los
+      tramos completos y la proxima vez solo baja el resto.
+    - La ultima hora (que no va a disco) queda en memoria por
+      TTL_COLA_ABIERTA_SEG: si en ese lapso se vuelve a consultar con el fin
+      del rango corrido unos minutos, solo se pide el borde nuevo.
+    - Devuelve UN DataFrame (una fila por muestra, columna 'program') armado
+      de los bloques por pagina de medux_api y de lo leido de disco, sin
+      pasar nunca por listas de dicts.
+
+Con esto el cache entiende tsStart/tsEnd/programs: un rango mas angosto, o
+uno que se solapa con otro ya bajado, sale del store filtrando por _ts; un
+program que se saca del multiselect no invalida los demas (cada program
+tiene su propia cobertura), y uno que se agrega solo baja lo suyo.
+
+Las filas se guardan como las arma medux_api.pagina_a_bloque: una columna
+por campo con los tipos del esquema ya aplicados (fechas como datetime UTC,
+KPIs numericos; ver medux_api.aplicar_esquema), asi que al leer no hay nada
+que volver a parsear, mas una columna interna _ts (dateStart en ms UTC, para
+particionar/filtrar). Las category de compactar_tipos NO se guardan: se
+aplican despues, sobre el DataFrame ya unido, en cada script. Las columnas
+con valores anidados (dict/list) o de tipos mezclados se guardan como JSON
+y se decodifican al leer.
+
+Si pyarrow no esta instalado el store queda desactivado y todo se baja de la
+API como antes (por tramos, sin persistir).
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import quote
+
+import pandas as pd
+import pytz
+import streamlit as st
+
+from medux_api import MAX_CURSORES, concatenar_bloques
+from medux_tramos import descargar_tramos, planificar_tramos
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # store desactivado: se baja todo de la API
+    pa = pq = None
+
+DIRECTORIO_CACHE = os.environ.get(
+    "MEDUX_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".medux_cache"),
+)
+DIRECTORIO_STORE = os.path.join(DIRECTORIO_CACHE, "store")
+MARGEN_TRAMO_ABIERTO_SEG = 60 * 60
+TTL_COLA_ABIERTA_SEG = 5 * 60
+MS_POR_DIA = 86_400_000
+HILOS_LECTURA = 8
+
+# Tipos (pd.api.types.infer_dtype) que pyarrow guarda sin ayuda en una
+# columna object; cualquier otro (dicts, listas, mezclas) va como JSON.
+_TIPOS_DIRECTOS = {"string", "boolean", "integer", "floating", "empty"}
+_EPOCH = pd.Timestamp(0, tz="UTC")
+
+
+def clave_consulta(body):
+    """Hash estable de todo lo que define la consulta MENOS el rango de
+    fechas y los programs (sondas, condiciones, formato, timezone): el
+    store guarda cada program por separado, asi que sacar o agregar uno en
+    el multiselect no invalida lo ya bajado de los demas."""
+    sin_rango = {k: v for k, v in body.items() if k not in ("tsStart", "tsEnd", "programs")}
+    if "probes" in sin_rango:
+        sin_rango["probes"] = sorted(str(v) for v in sin_rango["probes"])
+    texto = json.dumps(sin_rango, sort_keys=True, default=str)
+    return hashlib.sha1(texto.encode("utf-8")).hexdigest()[:16]
+
+
+def _unir_intervalos(intervalos):
+    unidos = []
+    for a, b in sorted(intervalos):
+        if unidos and a <= unidos[-1][1]:
+            unidos[-1][1] = max(unidos[-1][1], b)
+        else:
+            unidos.append([a, b])
+    return [tuple(i) for i in unidos]
+
+
+def _restar_intervalos(a, b, intervalos):
+    """Partes de [a, b) que NO cubre ninguno de 'intervalos' (unidos)."""
+    huecos = []
+    for x, y in intervalos:
+        if y <= a or x >= b:
+            continue
+        if x > a:
+            huecos.append((a, x))
+        a = max(a, y)
+    if a < b:
+        huecos.append((a, b))
+    return huecos
+
+
+def _ms_desde_fechas(fechas, defecto):
+    """dateStart (datetime UTC de aplicar_esquema, o texto ISO) -> ms UTC
+    (int64); las que no se pueden interpretar quedan en 'defecto'."""
+    fechas = pd.to_datetime(pd.Series(fechas, dtype=object), errors="coerce", utc=True)
+    return ((fechas - _EPOCH) // pd.Timedelta(milliseconds=1)).fillna(defecto).astype("int64").to_numpy()
+
+
+def _a_tabla(df):
+    """DataFrame de filas crudas -> pa.Table, pasando a JSON las columnas
+    que pyarrow no puede tipar (anidadas o mezcladas)."""
+    columnas_json = []
+    for col in df.columns:
+        if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True) not in _TIPOS_DIRECTOS:
+            df[col] = df[col].map(lambda v: json.dumps(v, default=str), na_action="ignore")
+            columnas_json.append(col)
+    tabla = pa.Table.from_pandas(df, preserve_index=False)
+    meta = dict(tabla.schema.metadata or {})
+    meta[b"medux_json"] = json.dumps(columnas_json).encode("utf-8")
+    return tabla.replace_schema_metadata(meta)
+
+
+def _de_tabla(tabla):
+    df = tabla.to_pandas()
+    meta = tabla.schema.metadata or {}
+    for col in json.loads(meta.get(b"medux_json", b"[]")):
+        if col in df.columns:
+            df[col] = df[col].map(json.loads, na_action="ignore")
+    return df
+
+
+class AlmacenResultados:
+    """Store Parquet + manifiestos de cobertura (ver docstring del modulo).
+    Thread-safe dentro del proceso; las escrituras son atomicas (os.replace)
+    para que un proceso muerto a mitad no deje archivos a medias."""
+
+    def __init__(self, directorio=DIRECTORIO_STORE):
+        self.directorio = directorio
+        self.disponible = pq is not None
+        self._lock = threading.Lock()
+
+    def _dir_program(self, clave, program):
+        return os.path.join(self.directorio, clave, quote(program or "_todos", safe=""))
+
+    def cobertura(self, clave, program):
+        ruta = os.path.join(self._dir_program(clave, program), "cobertura.json")
+        try:
+            with open(ruta, encoding="utf-8") as fh:
+                return [tuple(i) for i in json.load(fh)["intervalos"]]
+        except (OSError, ValueError, KeyError):
+            return []
+
+    def _guardar_cobertura(self, clave, program, intervalos):
+        directorio = self._dir_program(clave, program)
+        os.makedirs(directorio, exist_ok=True)
+        ruta = os.path.join(directorio, "cobertura.json")
+        tmp = f"{ruta}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump({"intervalos": [list(i) for i in intervalos]}, fh)
+        os.replace(tmp, ruta)
+
+    def huecos(self, clave, program, a, b):
+        """Intervalos de [a, b) (ms) que todavia no estan en disco."""
+        return _restar_intervalos(a, b, self.cobertura(clave, program))
+
+    def _archivos(self, clave, program, a, b):
+        """(ruta, x, y) de los archivos cuyo tramo [x, y) se solapa con
+        [a, b), buscando en las particiones de dia de ese rango."""
+        base = self._dir_program(clave, program)
+        encontrados = []
+        for dia in range(a // MS_POR_DIA, (b - 1) // MS_POR_DIA + 1):
+            nombre_dia = datetime.fromtimestamp(dia * 86_400, tz=pytz.utc).strftime("dia=%Y-%m-%d")
+            directorio = os.path.join(base, nombre_dia)
+            if not os.path.isdir(directorio):
+                continue
+            for nombre in os.listdir(directorio):
+                if not nombre.endswith(".parquet"):
+                    continue
+                x, y = (int(v) for v in nombre[:-len(".parquet")].split("_"))
+                if x < b and y > a:
+                    encontrados.append((os.path.join(directorio, nombre), x, y))
+        return encontrados
+
+    def guardar(self, clave, program, a, b, df):
+        """Persiste el tramo [a, b) de 'program' (DataFrame tal como lo armo
+        medux_api) y lo marca como cubierto. Un tramo sin filas tambien se
+        marca: "no hubo muestras" es un resultado valido."""
+        if not df.empty:
+            df = df.assign(_ts=_ms_desde_fechas(df["dateStart"], a) if "dateStart" in df.columns else a)
+
+        with self._lock:
+            # Si el tramo pisa archivos de una descarga anterior (re-descarga
+            # forzada o un tramo guardado pero sin llegar a marcarse), se
+            # borran enteros y su rango deja de contar como cubierto: si
+            # sobresalian de [a, b) esa parte se vuelve a pedir la proxima vez.
+            pisados = {(x, y) for _, x, y in self._archivos(clave, program, a, b)}
+            for x, y in pisados:
+                for ruta, x2, y2 in self._archivos(clave, program, x, y):
+                    if (x2, y2) == (x, y):
+                        os.remove(ruta)
+
+            if not df.empty:
+                base = self._dir_program(clave, program)
+                for dia, grupo in df.groupby(df["_ts"] // MS_POR_DIA, sort=False):
+                    nombre_dia = datetime.fromtimestamp(int(dia) * 86_400, tz=pytz.utc).strftime("dia=%Y-%m-%d")
+                    directorio = os.path.join(base, nombre_dia)
+                    os.makedirs(directorio, exist_ok=True)
+                    ruta = os.path.join(directorio, f"{a}_{b}.parquet")
+                    tmp = f"{ruta}.tmp"
+                    pq.write_table(_a_tabla(grupo.reset_index(drop=True)), tmp)
+                    os.replace(tmp, ruta)
+
+            cobertura = self.cobertura(clave, program)
+            for x, y in pisados:
+                cobertura = [
+                    h for c, d in cobertura for h in _restar_intervalos(c, d, [(x, y)])
+                ]
+            self._guardar_cobertura(clave, program, _unir_intervalos(cobertura + [(a, b)]))
+
+    def leer(self, clave, program, a, b):
+        """DataFrame con las filas guardadas de 'program' con dateStart en
+        [a, b). Los archivos se leen en paralelo (pyarrow suelta el GIL al
+        decodificar)."""
+        archivos = [ruta for ruta, _, _ in self._archivos(clave, program, a, b)]
+        if not archivos:
+            return pd.DataFrame()
+
+        def leer_archivo(ruta):
+            # partitioning=None: el "dia=..." de la ruta no debe volver como columna.
+            tabla = pq.read_table(ruta, filters=[("_ts", ">=", a), ("_ts", "<", b)], partitioning=None)
+            return _de_tabla(tabla)
+
+        with ThreadPoolExecutor(max_workers=min(HILOS_LECTURA, len(archivos))) as pool:
+            df = concatenar_bloques(list(pool.map(leer_archivo, archivos)))
+        return df.drop(columns="_ts", errors="ignore")
+
+
+# Un solo store por proceso (lo comparten todas las sesiones).
+ALMACEN = AlmacenResultados()
+
+# Tramo abierto (ultima hora) mas reciente por (clave, program):
+# {"a", "b", "hora", "df"} con "df" ya indexado por _ts (ms).
+# "hora" es cuando se bajo la parte MAS VIEJA de la cola: al reusarla y
+# extenderla no se renueva, asi que a los TTL_COLA_ABIERTA_SEG se re-baja
+# entera y entran las muestras que las sondas subieron con retraso.
+_COLAS_ABIERTAS = {}
+_LOCK_COLAS = threading.Lock()
+
+
+def _cola_vigente(clave, program, desde):
+    with _LOCK_COLAS:
+        cola = _COLAS_ABIERTAS.get((clave, program))
+    if cola is None or time.time() - cola["hora"] > TTL_COLA_ABIERTA_SEG:
+        return None
+    return cola if cola["a"] <= desde < cola["b"] else None
+
+
+def _filas_de_cola(cola, a, b):
+    """Filas de la cola con dateStart en [a, b)."""
+    df = cola["df"]
+    if df.empty:
+        return df
+    return df[(df["_ts"] >= a) & (df["_ts"] < b)].drop(columns="_ts")
+
+
+def _guardar_cola(clave, program, a, b, hora, df):
+    if not df.empty:
+        df = df.assign(_ts=_ms_desde_fechas(df["dateStart"], a) if "dateStart" in df.columns else a)
+    with _LOCK_COLAS:
+        _COLAS_ABIERTAS[(clave, program)] = {"a": a, "b": b, "hora": hora, "df": df}
+
+
+def obtener_resultados(url, headers, body, zona=pytz.utc, tamano_tramo="dia", debug=False,
+                       limite_filas=0, usar_store=True, almacen=None, max_cursores=MAX_CURSORES):
+    """Resultados de body["tsStart"]..body["tsEnd"] leyendo de disco lo ya
+    descargado y pidiendo a la API solo los huecos (mas la ultima hora).
+
+    usar_store=False ignora lo guardado (en disco y en memoria) y re-baja
+    todo el rango (los tramos cerrados que se bajen reemplazan a los que
+    habia en disco).
+
+    Devuelve (DataFrame, resumen) con resumen = {tramos, descargados,
+    truncados, con_error, filas_store, filas_memoria}."""
+    almacen = almacen or ALMACEN
+    persistir = almacen.disponible
+    leer_store = usar_store and persistir
+    clave = clave_consulta(body)
+    a_pedido, b_pedido = body["tsStart"], body["tsEnd"] + 1
+    hora_consulta = time.time()
+    cerrado_hasta = min(b_pedido, int(hora_consulta * 1000) - MARGEN_TRAMO_ABIERTO_SEG * 1000)
+    inicio_abierto = max(a_pedido, cerrado_hasta)
+
+    bloques = []
+    filas_store = filas_memoria = 0
+    consultas = []
+    colas_reusadas = {}
+    for program in list(body.get("programs") or []) or [None]:
+        huecos = [(a_pedido, cerrado_hasta)] if cerrado_hasta > a_pedido else []
+        if leer_store:
+            huecos = almacen.huecos(clave, program, a_pedido, cerrado_hasta)
+            guardado = almacen.leer(clave, program, a_pedido, cerrado_hasta)
+            bloques.append(guardado)
+            filas_store += len(guardado)
+        tramos = [(ta, tb, persistir) for a, b in huecos for ta, tb in planificar_tramos(a, b, tamano_tramo, zona)]
+        if b_pedido > cerrado_hasta:
+            # Tramo abierto: lo que ya este en la cola en memoria se reusa y
+            # solo se pide el borde que falta (si la cola ya cubre hasta
+            # b_pedido no se pide nada).
+            desde = inicio_abierto
+            cola = _cola_vigente(clave, program, inicio_abierto) if usar_store else None
+            if cola is not None:
+                desde = min(b_pedido, cola["b"])
+                reusadas = _filas_de_cola(cola, inicio_abierto, desde)
+                colas_reusadas[program] = (reusadas, cola["hora"])
+                bloques.append(reusadas)
+                filas_memoria += len(reusadas)
+            if desde < b_pedido:
+                tramos.append((desde, b_pedido, False))
+        for ta, tb, guardable in tramos:
+            sub_body = dict(body, tsStart=ta, tsEnd=tb - 1)
+            if program is not None:
+                sub_body["programs"] = [program]
+            etiqueta = f"{program or 'todo'} {datetime.fromtimestamp(ta / 1000, tz=zona):%Y-%m-%d %H:%M}"
+            consultas.append(((program, ta, tb, guardable), etiqueta, sub_body))
+
+    def al_completar(clave_tramo, df_tramo):
+        program, ta, tb, guardable = clave_tramo
+        if guardable:
+            almacen.guardar(clave, program, ta, tb, df_tramo)
+            return
+        reusadas, hora = colas_reusadas.get(program, (None, hora_consulta))
+        _guardar_cola(clave, program, inicio_abierto, tb, hora, concatenar_bloques([reusadas, df_tramo]))
+
+    if limite_filas and filas_store + filas_memoria >= limite_filas:
+        st.warning(
+            f"⏹️ Lo ya guardado (disco/memoria) supera el limite de {limite_filas:,} filas: no se "
+            f"piden los {len(consultas)} tramo(s) que faltan. Sube el limite para completarlos."
+        )
+        consultas = []
+
+    resultados_por_tramo, resumen = descargar_tramos(
+        url, headers, consultas, debug=debug, limite_filas=limite_filas,
+        total_previo=filas_store + filas_memoria, al_completar=al_completar, max_cursores=max_cursores,
+    )
+    for bloques_tramo in resultados_por_tramo.values():
+        bloques.extend(bloques_tramo)
+    resumen["filas_store"] = filas_store
+    resumen["filas_memoria"] = filas_memoria
+    return concatenar_bloques(bloques), resumen
@@ -0,0 +1,149 @@
+"""
+Medux API - descarga de rangos largos por tramos
+================================================
+Pensado para la pestana "Agregado (Ano)" de Conteo_Agregado_mapa.py, que
+antes pedia 1-ene-a-hoy en UN solo stream paginado: todo-o-nada (si se
+cortaba a la mitad se perdia todo) y ademas topado en 100 paginas, asi que un
+ano con mucha actividad podia volver truncado sin que se notara.
+
+Ahora:
+    - planificar_tramos() parte tsStart..tsEnd en tramos de un dia o una
+      semana (cortes a medianoche local, semanas de lunes a lunes).
+    - descargar_tramos() baja cada tramo como su propio grupo de cursores
+      PIT (uno por program, ver medux_api.dividir_body); todos los cursores
+      de todos los tramos corren en el mismo pool y bajo el mismo limite de
+      ~1 req/s, y apenas TODOS los cursores de un tramo terminan bien se
+      avisa a 'al_completar' (medux_store lo usa para guardarlo en disco).
+    - El tope de paginas aplica POR tramo y program (no al ano entero); si
+      igual se alcanza, ese tramo queda marcado como truncado, se avisa y NO
+      se da por completo (se reintenta en la proxima corrida).
+    - Que tramos hace falta pedir (y cuales ya estan en disco) lo decide
+      medux_store.obtener_resultados, no este modulo.
+"""
+import time
+from datetime import datetime, timedelta, time as dtime
+
+import pytz
+import streamlit as st
+
+from medux_api import (
+    DECODIFICADOR_JSON, MAX_CURSORES, MAX_PAGINAS_POR_CURSOR, concatenar_bloques, dividir_body, ejecutar_cursores,
+)
+
+TAMANOS_TRAMO = {"dia": 1, "semana": 7}
+
+
+def planificar_tramos(ts_start, ts_end, tamano="semana", zona=pytz.utc):
+    """Parte [ts_start, ts_end] (ms) en tramos consecutivos (a, b) alineados
+    a medianoche local de 'zona' (semanas: de lunes a lunes). El primer y el
+    ultimo tramo pueden quedar incompletos (recortados al rango pedido)."""
+    dias = TAMANOS_TRAMO[tamano]
+    inicio_local = datetime.fromtimestamp(ts_start / 1000, tz=zona)
+    dia = inicio_local.date()
+    if dias == 7:
+        dia -= timedelta(days=dia.weekday())
+    tramos = []
+    a = ts_start
+    while a < ts_end:
+        dia += timedelta(days=dias)
+        corte = zona.localize(datetime.combine(dia, dtime()))
+        b = min(ts_end, int(corte.timestamp() * 1000))
+        if b > a:
+            tramos.append((a, b))
+        a = b
+    return tramos
+
+
+def descargar_tramos(url, headers, consultas, debug=False, limite_filas=0, total_previo=0,
+                     al_completar=None, max_cursores=MAX_CURSORES):
+    """Descarga una lista de tramos ya planificados.
+
+    consultas: lista de (clave, etiqueta, body) -- un body por tramo, con su
+    propio tsStart/tsEnd. 'clave' identifica el tramo ante quien llama;
+    'etiqueta' es solo para los mensajes.
+    al_completar(clave, df_tramo): se llama en el hilo principal
+    cuando TODOS los cursores del tramo terminaron bien (ni error ni tope de
+    paginas), antes de seguir con las paginas de los demas tramos.
+    total_previo: filas ya disponibles por otra via (cuentan para
+    limite_filas).
+
+    Devuelve ({clave: [bloques DataFrame...]}, resumen) donde resumen =
+    {tramos, descargados, truncados, con_error}. Los tramos incompletos
+    tambien se devuelven (con lo que alcanzo a bajar)."""
+    resumen = {"tramos": len(consultas), "descargados": 0, "truncados": [], "con_error": []}
+    resultados_por_tramo = {clave: [] for clave, _, _ in consultas}
+    if not consultas:
+        return resultados_por_tramo, resumen
+
+    etiquetas = {clave: etiqueta for clave, etiqueta, _ in consultas}
+    sub_consultas = []
+    cursores_por_tramo = {}
+    for clave, _, sub_body in consultas:
+        partes = dividir_body(sub_body, max_cursores)
+        cursores_por_tramo[clave] = len(partes)
+        sub_consultas.extend(((clave, etiqueta), parte) for etiqueta, parte in partes)
+
+    cursores_ok = dict.fromkeys(cursores_por_tramo, 0)
+    invalidos = set()
+    total_acumulado = total_previo
+    tiempos_totales = {"red": 0.0, "decodificacion": 0.0, "armado": 0.0}
+    diag = st.empty() if debug else None
+    barra = st.progress(0, text="Descargando tramos...") if debug else None
+    inicio_descarga = time.time()
+
+    eventos = ejecutar_cursores(url, headers, sub_consultas, max_cursores)
+    try:
+        for tipo, (clave, etiqueta), *resto in eventos:
+            desde = etiquetas[clave]
+            if tipo == "error":
+                st.error(f"Error API (tramo {desde}, {etiqueta}) en {resto[0]}")
+                invalidos.add(clave)
+                resumen["con_error"].append(desde)
+                continue
+            if tipo == "fin":
+                if resto[0] == "limite_paginas":
+                    st.warning(
+                        f"Tramo {desde} ({etiqueta}) alcanzo el limite de {MAX_PAGINAS_POR_CURSOR} "
+                        f"paginas: queda truncado y no se guarda. Usa tramos por dia."
+                    )
+                    invalidos.add(clave)
+                    resumen["truncados"].append(desde)
+                    continue
+                cursores_ok[clave] += 1
+                if cursores_ok[clave] == cursores_por_tramo[clave] and clave not in invalidos:
+                    resumen["descargados"] += 1
+                    # Se une el tramo una vez y se queda solo el DataFrame
+                    # unido (no los bloques sueltos + la union).
+                    df_tramo = concatenar_bloques(resultados_por_tramo[clave])
+                    resultados_por_tramo[clave] = [df_tramo]
+                    if al_completar is not None:
+                        al_completar(clave, df_tramo)
+                continue
+            bloque, tiempos = resto
+            resultados_por_tramo[clave].append(bloque)
+            filas_en_pagina = len(bloque)
+            for k, v in tiempos.items():
+                tiempos_totales[k] += v
+            total_acumulado += filas_en_pagina
+            if diag is not None:
+                transcurrido = time.time() - inicio_descarga
+                diag.caption(
+                    f"📥 Tramo {desde} · {etiqueta}: {filas_en_pagina} filas — red "
+                    f"{tiempos['red']:.1f}s, JSON ({DECODIFICADOR_JSON}) {tiempos['decodificacion']:.2f}s, "
+                    f"armado {tiempos['armado']:.2f}s (acumulado {total_acumulado:,} filas; red "
+                    f"{tiempos_totales['red']:.0f}s, JSON {tiempos_totales['decodificacion']:.1f}s, "
+                    f"armado {tiempos_totales['armado']:.1f}s) — {resumen['descargados']} de "
+                    f"{len(consultas)} tramos bajados, {transcurrido:.0f}s transcurridos"
+                )
+            if barra is not None:
+                hechos = resumen["descargados"]
+                barra.progress(min(1.0, hechos / len(consultas)), text=f"{hechos} / {len(consultas)} tramos")
+            if limite_filas and total_acumulado >= limite_filas:
+                st.warning(
+                    f"⏹️ Se alcanzo el limite de {limite_filas:,} filas. Los tramos completos ya "
+                    f"quedaron guardados: al volver a consultar solo se bajan los que faltan."
+                )
+                break
+    finally:
+        eventos.close()
+    return resultados_por_tramo, resumen
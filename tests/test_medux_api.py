@@ -0,0 +1,60 @@
+"""Pruebas de medux_api.LimitadorTasa con un reloj simulado (sin esperas reales)."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import medux_api  # noqa: E402
+
+
+class _Reloj:
+    """Reemplaza al modulo time dentro de medux_api: sleep avanza el reloj
+    y acumula lo esperado."""
+
+    def __init__(self):
+        self.ahora = 0.0
+        self.esperado = 0.0
+
+    def monotonic(self):
+        return self.ahora
+
+    def sleep(self, segundos):
+        self.ahora += segundos
+        self.esperado += segundos
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    reloj = _Reloj()
+    monkeypatch.setattr(medux_api, "time", reloj)
+    return reloj
+
+
+def test_penalizar_tras_inactividad_espera_lo_pedido(reloj):
+    limitador = medux_api.LimitadorTasa(intervalo=1.0, capacidad=1)
+    assert limitador.adquirir()
+    reloj.ahora += 5.0  # bucket inactivo: no debe "prestar" esos 5 s
+    limitador.penalizar(3.0)
+    reloj.esperado = 0.0
+    assert limitador.adquirir()
+    assert reloj.esperado == pytest.approx(3.0)
+
+
+def test_penalizar_justo_despues_de_adquirir(reloj):
+    limitador = medux_api.LimitadorTasa(intervalo=1.02, capacidad=1)
+    assert limitador.adquirir()
+    limitador.penalizar(2.5)
+    reloj.esperado = 0.0
+    assert limitador.adquirir()
+    assert reloj.esperado == pytest.approx(2.5)
+
+
+def test_penalizar_no_acorta_una_espera_mayor(reloj):
+    limitador = medux_api.LimitadorTasa(intervalo=4.0, capacidad=1)
+    assert limitador.adquirir()
+    limitador.penalizar(1.0)
+    reloj.esperado = 0.0
+    assert limitador.adquirir()
+    assert reloj.esperado == pytest.approx(4.0)